@@ -1,6 +1,7 @@
 import sys
 
 from pisync import LocalConfig, RemoteConfig, backup
+from pisync.config import Source
 
 # will need to be root to run rsync for a different users home dir
 
@@ -16,6 +17,7 @@ local_home_directories = LocalConfig(
     source_dir="/home/",
     destination_dir="/media/backup_drive_linux/home_directory_backups/",
     exclude_file_patterns=home_dir_exclude_file_patterns,
+    exclude_caches=True,
     log_file=log_file,
 )
 
@@ -23,18 +25,12 @@ local_large_harddrive = LocalConfig(
     source_dir="/mnt/hd2", destination_dir="/media/backup_drive_linux/hd2_backups/", log_file=log_file
 )
 
-remote_home_directories = RemoteConfig(
+# both directories in one rsync run and one snapshot
+remote_backup = RemoteConfig(
     user_at_hostname="ethan@hydrogen.local",
-    source_dir="/home/",
-    destination_dir="/mnt/hd/sulfur_backups/home_directory_backups",
-    exclude_file_patterns=home_dir_exclude_file_patterns,
-    log_file=log_file,
-)
-
-remote_large_harddrive = RemoteConfig(
-    user_at_hostname="ethan@hydrogen.local",
-    source_dir="/mnt/hd2/",
-    destination_dir="/mnt/hd/sulfur_backups/hd2_backups",
+    source_dir=[Source("/home/", home_dir_exclude_file_patterns), Source("/mnt/hd2/")],
+    destination_dir="/mnt/hd/sulfur_backups/snapshots",
+    exclude_caches=True,
     log_file=log_file,
 )
 
@@ -48,8 +44,7 @@ except Exception as e:
     print(e)
 
 try:
-    backup(remote_home_directories)
-    backup(remote_large_harddrive)
+    backup(remote_backup)
 except Exception as e:
     success = False
     print(e)
@@ -4,7 +4,58 @@ Date        : 2022-05-23
 Description : Incremental backups script using rsync.
 """
 
-from pisync.config import LocalConfig, RemoteConfig
-from pisync.util import backup
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-__all__ = ("backup", "LocalConfig", "RemoteConfig")
+if TYPE_CHECKING:
+    from pisync.config import LocalConfig, PullConfig, RemoteConfig
+    from pisync.diff import diff_snapshots
+    from pisync.pull import apull_many
+    from pisync.restore import restore
+    from pisync.space import snapshot_space
+    from pisync.util import abackup, abackup_many, backup
+    from pisync.verify import verify, verify_against_source
+
+__all__ = (
+    "abackup",
+    "abackup_many",
+    "apull_many",
+    "backup",
+    "diff_snapshots",
+    "restore",
+    "snapshot_space",
+    "verify",
+    "verify_against_source",
+    "LocalConfig",
+    "PullConfig",
+    "RemoteConfig",
+)
+
+# Imported on first use so that local backups never import fabric
+_LAZY_ATTRIBUTES = {
+    "abackup": "pisync.util",
+    "abackup_many": "pisync.util",
+    "apull_many": "pisync.pull",
+    "backup": "pisync.util",
+    "diff_snapshots": "pisync.diff",
+    "restore": "pisync.restore",
+    "snapshot_space": "pisync.space",
+    "verify": "pisync.verify",
+    "verify_against_source": "pisync.verify",
+    "LocalConfig": "pisync.config.local_config",
+    "PullConfig": "pisync.config.pull_config",
+    "RemoteConfig": "pisync.config.remote_config",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_ATTRIBUTES:
+        msg = f"module {__name__!r} has no attribute {name!r}"
+        raise AttributeError(msg)
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted([*globals(), *_LAZY_ATTRIBUTES])
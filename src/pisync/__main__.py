@@ -0,0 +1,5 @@
+import sys
+
+from pisync.cli import main
+
+sys.exit(main())
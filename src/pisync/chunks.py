@@ -0,0 +1,339 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+from typing import IO, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import pisync.util
+from pisync.config.base_config import BaseConfig
+from pisync.jobs import chunks as chunks_job
+from pisync.jobs import run_job
+
+try:
+    # FastCDC content defined chunking, see
+    # https://www.usenix.org/conference/atc16/technical-sessions/presentation/xia
+    # Only the compiled implementation, hashing every byte in python is far too slow.
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # the fastcdc package is optional
+    fastcdc_cy = None
+
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_AVERAGE_SIZE = 1024 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+# how much of a file is read at a time to chunk it with fastcdc
+CHUNK_WINDOW_SIZE = 4 * CHUNK_MAX_SIZE
+CHUNK_CACHE = "chunks.sqlite3"
+GIGABYTE = 1e9
+
+# (sha256 hex digest, length) of every chunk of a file
+Chunks = List[Tuple[str, int]]
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+class ChunkReport(NamedTuple):
+    files: int
+    # total size of the chunked files
+    bytes: int
+    chunks: int
+    # chunks that were not in the store yet and were transferred
+    new_chunks: int
+    new_bytes: int
+    # bytes that were chunked, files that did not change since the last backup are not
+    chunked_bytes: int
+    cpu_seconds: float
+    # total size of the files of all snapshots in the store and of their unique chunks
+    logical_bytes: int
+    store_bytes: int
+
+    @property
+    def dedup_ratio(self) -> float:
+        return self.logical_bytes / self.store_bytes if self.store_bytes else 1.0
+
+    @property
+    def cpu_seconds_per_gb(self) -> float:
+        return self.cpu_seconds / (self.chunked_bytes / GIGABYTE) if self.chunked_bytes else 0.0
+
+
+def iter_chunks(f: IO[bytes]) -> Iterator[bytes]:
+    """
+    :returns: The chunks of the file, in order. They are content defined if the
+    fastcdc package is installed, and blocks of CHUNK_AVERAGE_SIZE otherwise,
+    which still only store the changed blocks of files changed in place.
+    """
+    if fastcdc_cy is None:
+        yield from iter(lambda: f.read(CHUNK_AVERAGE_SIZE), b"")
+        return
+    # fastcdc would mmap a file, which fails for empty files and kills the
+    # process with SIGBUS if the file is truncated while it is chunked, so it
+    # gets windows of the file. A chunk only depends on the CHUNK_MAX_SIZE bytes
+    # from its start, so the chunks are the same as those of the whole file.
+    pending = b""
+    while True:
+        block = f.read(CHUNK_WINDOW_SIZE)
+        data = pending + block
+        if not data:
+            return
+        pending = b""
+        for chunk in fastcdc_cy(
+            data, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVERAGE_SIZE, max_size=CHUNK_MAX_SIZE, fat=True
+        ):
+            if block and chunk.offset + CHUNK_MAX_SIZE > len(data):
+                # the chunk may end in the next window
+                pending = data[chunk.offset :]
+                break
+            yield bytes(chunk.data)
+
+
+def chunk_file(path: str) -> Chunks:
+    with open(path, "rb") as f:
+        return [(hashlib.sha256(chunk).hexdigest(), len(chunk)) for chunk in iter_chunks(f)]
+
+
+def store_large_files(config: BaseConfig, snapshot_path: str) -> ChunkReport:
+    """
+    Split the files in `config.source_dir` larger than `config.chunk_threshold`
+    into chunks, transfer the chunks the store next to `config.destination_dir`
+    does not have yet, and record them in a manifest for the snapshot at
+    `snapshot_path`. Files that change after they were chunked are chunked
+    again while their chunks are sent, in a single read.
+
+    :raises:
+        ChunkStoreError: If the chunks could not be stored
+        ScriptFailedError: If a job on the destination fails
+    """
+    threshold = config.chunk_threshold or 0
+    destination = str(config.destination_dir)
+    snapshot = os.path.basename(snapshot_path)
+    incoming = chunks_job.incoming_path(destination, snapshot)
+
+    cache = ChunkCache(str(pisync.util.get_cache_dir() / CHUNK_CACHE))
+    manifest: Dict[str, Dict] = {}
+    sources: Dict[str, str] = {}
+    chunked_bytes = 0
+    start_cpu = time.process_time()
+    try:
+        for relative_path, path, stat in config.filters.large_files(threshold):
+            key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            chunks = cache.get(key)
+            if chunks is None:
+                try:
+                    chunks = chunk_file(path)
+                except OSError as e:
+                    logging.warning(f"Could not chunk {path}: {e}")
+                    continue
+                chunked_bytes += stat.st_size
+                cache.put(key, chunks)
+            manifest[relative_path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "mode": stat.st_mode & 0o7777,
+                "chunks": chunks,
+            }
+            sources[relative_path] = path
+    finally:
+        cache.close()
+    cpu_seconds = time.process_time() - start_cpu
+
+    _write_tar(config, incoming, lambda tar: _add_bytes(tar, chunks_job.MANIFEST_FILE, json.dumps(manifest).encode()))
+    missing = {event["digest"] for event in run_job(config, chunks_job, ["missing", destination, snapshot])}
+
+    new_chunks, new_bytes = 0, 0
+    # digests that are in the store or already in the archive
+    sent = {digest for entry in manifest.values() for digest, _ in entry["chunks"]} - missing
+
+    def add_missing_chunks(tar: tarfile.TarFile) -> None:
+        nonlocal chunked_bytes
+
+        def add_chunk(digest: str, data: bytes) -> None:
+            nonlocal new_chunks, new_bytes
+            if digest in sent:
+                return
+            sent.add(digest)
+            _add_bytes(tar, f"{chunks_job.CHUNK_DIR}/{digest}", data)
+            new_chunks += 1
+            new_bytes += len(data)
+
+        for relative_path, digest, data in _read_chunks(manifest, sources, missing):
+            if data is None:
+                logging.warning(f"{sources[relative_path]} changed while it was chunked, chunking it again")
+                manifest[relative_path] = _chunk_again(sources[relative_path], add_chunk)
+                chunked_bytes += manifest[relative_path]["size"]
+                continue
+            add_chunk(digest, data)
+        _add_bytes(tar, chunks_job.MANIFEST_FILE, json.dumps(manifest).encode())
+
+    _write_tar(config, incoming, add_missing_chunks)
+
+    summary: Dict = {}
+    for event in run_job(config, chunks_job, ["commit", destination, snapshot]):
+        if event["event"] == "error":
+            logging.error(f"Chunk store: {event['error']}")
+        else:
+            summary = event
+    if not summary:
+        msg = f"Could not store the chunks of {snapshot_path}"
+        raise ChunkStoreError(msg)
+
+    report = ChunkReport(
+        files=len(manifest),
+        bytes=sum(entry["size"] for entry in manifest.values()),
+        chunks=sum(len(entry["chunks"]) for entry in manifest.values()),
+        new_chunks=new_chunks,
+        new_bytes=new_bytes,
+        chunked_bytes=chunked_bytes,
+        cpu_seconds=cpu_seconds,
+        logical_bytes=summary["logical_bytes"],
+        store_bytes=summary["store_bytes"],
+    )
+    logging.info(
+        f"Chunked {report.files} large files ({report.bytes} bytes), transferred {report.new_chunks} new chunks "
+        f"({report.new_bytes} bytes), {report.cpu_seconds_per_gb:.1f} CPU seconds per GB chunked, "
+        f"dedup ratio of the chunk store {report.dedup_ratio:.2f}"
+    )
+    return report
+
+
+def assemble(config: BaseConfig, snapshot: str = "latest", paths: Optional[List[str]] = None) -> List[str]:
+    """
+    Put the chunked files of `snapshot` back together inside the snapshot, so
+    that it can be used like any other snapshot. If given, only the files in
+    `paths` (relative to the snapshot) are assembled.
+
+    :returns: The paths that were assembled
+    """
+    if snapshot == "latest":
+        snapshot = os.path.basename(config.resolve(config.link_dir))
+    args = ["assemble", str(config.destination_dir), snapshot]
+    for path in paths or []:
+        args.extend(["--path", path])
+    assembled = []
+    for event in run_job(config, chunks_job, args):
+        if event["event"] == "error":
+            logging.error(f"Could not assemble {event['path']}: {event['error']}")
+        else:
+            assembled.append(event["path"])
+    return assembled
+
+
+class ChunkCache:
+    """The chunks of files by (device, inode, size, mtime) so unchanged files are not chunked again"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, chunks TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+
+    def get(self, key: Tuple[int, int, int, int]) -> Optional[Chunks]:
+        row = self.connection.execute(
+            "SELECT chunks FROM chunks WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?", key
+        ).fetchone()
+        return None if row is None else [tuple(chunk) for chunk in json.loads(row[0])]  # type: ignore[misc]
+
+    def put(self, key: Tuple[int, int, int, int], chunks: Chunks) -> None:
+        with self.connection:
+            # the inode may be reused by a different file, keep one row per inode
+            self.connection.execute("DELETE FROM chunks WHERE dev = ? AND ino = ?", key[:2])
+            self.connection.execute("INSERT INTO chunks VALUES (?, ?, ?, ?, ?)", (*key, json.dumps(chunks)))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def _read_chunks(
+    manifest: Dict[str, Dict], sources: Dict[str, str], digests: Set[str]
+) -> Iterator[Tuple[str, str, Optional[bytes]]]:
+    """
+    :returns: (relative path, digest, data) for each chunk with one of
+    `digests`, or (relative path, "", None) for a file that no longer matches
+    its chunks.
+    """
+    wanted = set(digests)
+    for relative_path, entry in list(manifest.items()):
+        if wanted.isdisjoint(digest for digest, _ in entry["chunks"]):
+            continue
+        try:
+            with open(sources[relative_path], "rb") as f:
+                for digest, length in entry["chunks"]:
+                    if digest not in wanted:
+                        f.seek(length, io.SEEK_CUR)
+                        continue
+                    data = f.read(length)
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        yield relative_path, "", None
+                        break
+                    wanted.discard(digest)
+                    yield relative_path, digest, data
+        except OSError:
+            yield relative_path, "", None
+
+
+def _chunk_again(path: str, add_chunk: Callable[[str, bytes], None]) -> Dict:
+    """
+    Chunk the file at path and pass every chunk to `add_chunk` as it is read,
+    so the chunks match the manifest entry even if the file keeps changing.
+
+    :returns: The manifest entry of the file
+    :raises:
+        ChunkStoreError: If the file cannot be read anymore
+    """
+    chunks: Chunks = []
+    try:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            for data in iter_chunks(f):
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append((digest, len(data)))
+                add_chunk(digest, data)
+    except OSError as e:
+        msg = f"Could not chunk {path} again: {e}"
+        raise ChunkStoreError(msg) from e
+    return {
+        "size": sum(length for _, length in chunks),
+        "mtime_ns": stat.st_mtime_ns,
+        "mode": stat.st_mode & 0o7777,
+        "chunks": chunks,
+    }
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _write_tar(config: BaseConfig, directory: str, add_members: Callable[[tarfile.TarFile], None]) -> None:
+    """Stream the tar archive built by `add_members` to `directory` with `config.write_tar`"""
+    read_fd, write_fd = os.pipe()
+    errors: List[BaseException] = []
+
+    def write() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as pipe, tarfile.open(fileobj=pipe, mode="w|") as tar:
+                add_members(tar)
+        except BaseException as e:  # re-raised in the calling thread
+            errors.append(e)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    with os.fdopen(read_fd, "rb") as pipe:
+        try:
+            config.write_tar(directory, pipe)
+        finally:
+            # unblock the writer if write_tar stopped reading early
+            pipe.close()
+            thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union, cast
+
+import pisync.config
+from pisync.chunks import assemble
+from pisync.config.base_config import BaseConfig, InvalidPathError, ScriptFailedError
+from pisync.config.config_file import ConfigFileError, default_config_file, load_config_file
+from pisync.diff import diff_snapshots
+from pisync.pull import apull_many
+from pisync.restore import restore
+from pisync.scheduler import default_socket_path, run_daemon, send_command
+from pisync.space import snapshot_space
+from pisync.util import abackup_many
+
+if TYPE_CHECKING:
+    from pisync.config.pull_config import PullConfig
+
+KIBIBYTE = 1024
+
+
+class DaemonNotRunningError(Exception):
+    pass
+
+
+def _destination_config(args: argparse.Namespace) -> BaseConfig:
+    # source_dir is not used when inspecting existing snapshots
+    if args.host is None:
+        return pisync.config.LocalConfig(os.sep, args.destination)
+    else:
+        return pisync.config.RemoteConfig(args.host, os.sep, args.destination)
+
+
+def _selected_configs(args: argparse.Namespace) -> List[Tuple[str, BaseConfig]]:
+    configs = load_config_file(args.config)
+    unknown = [name for name in args.names if name not in configs]
+    if unknown:
+        msg = f"No backup named {', '.join(unknown)} in {args.config or default_config_file()}"
+        raise ConfigFileError(msg)
+    return [(name, config) for name, config in configs.items() if not args.names or name in args.names]
+
+
+def _run(args: argparse.Namespace) -> int:
+    selected = _selected_configs(args)
+    results = asyncio.run(abackup_many([config for _, config in selected], max_concurrency=args.jobs))
+    return _report_results(selected, results)
+
+
+def _pull(args: argparse.Namespace) -> int:
+    selected = _selected_configs(args)
+    pushed = [name for name, config in selected if not isinstance(config, pisync.config.PullConfig)]
+    if args.names and pushed:
+        msg = f"{', '.join(pushed)} do not pull from a client, use pisync run"
+        raise ConfigFileError(msg)
+    selected = [(name, config) for name, config in selected if name not in pushed]
+    results = asyncio.run(
+        apull_many(
+            [cast("PullConfig", config) for _, config in selected],
+            max_concurrency=args.jobs,
+            max_per_client=args.per_client,
+            bwlimit=args.bwlimit,
+            client_bwlimit=args.client_bwlimit,
+        )
+    )
+    return _report_results(selected, results)
+
+
+def _report_results(selected: List[Tuple[str, BaseConfig]], results: List[Union[str, BaseException]]) -> int:
+    exit_code = 0
+    for (name, _), result in zip(selected, results):
+        if isinstance(result, BaseException):
+            sys.stderr.write(f"{name}: failed: {result}\n")
+            exit_code = 1
+        else:
+            sys.stdout.write(f"{name}: {result}\n")
+    return exit_code
+
+
+def _list(args: argparse.Namespace) -> int:
+    for name, config in _selected_configs(args):
+        host = getattr(config, "user_at_hostname", None)
+        destination = config.destination_dir if host is None else f"{host}:{config.destination_dir}"
+        sys.stdout.write(f"{name}\t{', '.join(config.source_paths())} -> {destination}\n")
+    return 0
+
+
+def _validate(args: argparse.Namespace) -> int:
+    selected = _selected_configs(args)
+    exit_code = 0
+    if args.check_paths:
+        for name, config in selected:
+            try:
+                config.check_paths()
+            except InvalidPathError as e:
+                sys.stderr.write(f"{name}: {e}\n")
+                exit_code = 1
+    if exit_code == 0:
+        sys.stdout.write(f"{len(selected)} backups OK\n")
+    return exit_code
+
+
+def _daemon(args: argparse.Namespace) -> int:
+    run_daemon(args.config, args.socket, max_concurrency=args.jobs)
+    return 0
+
+
+def _trigger(args: argparse.Namespace) -> int:
+    exit_code = 0
+    for name in args.names:
+        response = _send_command(args.socket, f"run {name}")
+        if "error" in response:
+            sys.stderr.write(f"{response['error']}\n")
+            exit_code = 1
+        else:
+            sys.stdout.write(f"{name}: {response['result']}\n")
+    return exit_code
+
+
+def _status(args: argparse.Namespace) -> int:
+    backups = _send_command(args.socket, "status")["backups"]
+    if args.json:
+        sys.stdout.write(json.dumps(backups, indent=2) + "\n")
+        return 0
+    sys.stdout.write(f"{'name':<20} {'state':<8} {'next run':<20} {'last finished':<20} last result\n")
+    for name, backup in backups.items():
+        last_result = backup["last_result"] if backup["last_error"] is None else f"failed: {backup['last_error']}"
+        sys.stdout.write(
+            f"{name:<20} {backup['state']:<8} {backup['next_run'] or '-':<20} "
+            f"{backup['last_finished'] or '-':<20} {last_result or '-'}\n"
+        )
+    return 0
+
+
+def _send_command(socket_path: Optional[str], command: str) -> Dict[str, Any]:
+    socket_path = socket_path or default_socket_path()
+    try:
+        return send_command(socket_path, command)
+    except OSError as e:
+        msg = f"Could not connect to the pisync daemon at {socket_path}: {e}"
+        raise DaemonNotRunningError(msg) from e
+
+
+def _diff(args: argparse.Namespace) -> int:
+    config = _destination_config(args)
+    for status, path in diff_snapshots(config, args.old, args.new, include_unchanged=args.unchanged):
+        sys.stdout.write(f"{status[0].upper()} {path}\n")
+    return 0
+
+
+def _restore(args: argparse.Namespace) -> int:
+    config = _destination_config(args)
+    report = restore(config, args.target, args.snapshot, args.patterns, workers=args.workers)
+    sys.stdout.write(f"Restored {report.files} files ({_format_bytes(report.bytes)}) in {report.seconds:.1f}s\n")
+    return 0
+
+
+def _assemble(args: argparse.Namespace) -> int:
+    config = _destination_config(args)
+    assembled = assemble(config, args.snapshot, args.paths)
+    sys.stdout.write(f"Assembled {len(assembled)} files\n")
+    return 0
+
+
+def _space(args: argparse.Namespace) -> int:
+    config = _destination_config(args)
+    sys.stdout.write(f"{'snapshot':<20} {'exclusive':>12} {'shared':>12} {'files':>10}\n")
+    for space in snapshot_space(config):
+        exclusive = _format_bytes(space.exclusive_bytes)
+        shared = _format_bytes(space.shared_bytes)
+        sys.stdout.write(f"{space.snapshot:<20} {exclusive:>12} {shared:>12} {space.files:>10}\n")
+    return 0
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if size < KIBIBYTE or unit == "TiB":
+            break
+        size /= KIBIBYTE
+    return f"{size:.1f} {unit}"
+
+
+def _add_destination_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("destination", help="directory containing the snapshots")
+    parser.add_argument("--host", help="user@hostname if the destination is on a remote machine")
+
+
+def _add_config_file_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("names", nargs="*", help="names of the backups (default: all)")
+    parser.add_argument("-c", "--config", help=f"TOML config file (default: {default_config_file()})")
+
+
+def _add_socket_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--socket", help=f"control socket of the daemon (default: {default_socket_path()})")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pisync", description="Incremental backups using rsync")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run backups from the config file")
+    _add_config_file_arguments(run)
+    run.add_argument("-j", "--jobs", type=int, default=1, help="number of backups to run at once (default: 1)")
+    run.set_defaults(func=_run)
+
+    pull = subparsers.add_parser("pull", help="pull backups from clients in the config file")
+    _add_config_file_arguments(pull)
+    pull.add_argument("-j", "--jobs", type=int, default=4, help="number of pulls to run at once (default: 4)")
+    pull.add_argument(
+        "--per-client", type=int, default=1, help="number of pulls from one client to run at once (default: 1)"
+    )
+    pull.add_argument("--bwlimit", type=int, help="bandwidth limit of all pulls together in KiB/s")
+    pull.add_argument("--client-bwlimit", type=int, help="bandwidth limit of the pulls from one client in KiB/s")
+    pull.set_defaults(func=_pull)
+
+    list_ = subparsers.add_parser("list", help="list backups in the config file")
+    _add_config_file_arguments(list_)
+    list_.set_defaults(func=_list)
+
+    validate = subparsers.add_parser("validate", help="check the config file")
+    _add_config_file_arguments(validate)
+    validate.add_argument("--check-paths", action="store_true", help="also check that all directories exist")
+    validate.set_defaults(func=_validate)
+
+    daemon = subparsers.add_parser("daemon", help="run backups from the config file on their schedules")
+    daemon.add_argument("-c", "--config", help=f"TOML config file (default: {default_config_file()})")
+    daemon.add_argument("-j", "--jobs", type=int, default=4, help="number of backups to run at once (default: 4)")
+    _add_socket_argument(daemon)
+    daemon.set_defaults(func=_daemon)
+
+    trigger = subparsers.add_parser("trigger", help="ask the daemon to run backups now")
+    trigger.add_argument("names", nargs="+", help="names of the backups")
+    _add_socket_argument(trigger)
+    trigger.set_defaults(func=_trigger)
+
+    status = subparsers.add_parser("status", help="show the state of the backups in the daemon")
+    status.add_argument("--json", action="store_true", help="print the status as JSON")
+    _add_socket_argument(status)
+    status.set_defaults(func=_status)
+
+    diff = subparsers.add_parser("diff", help="list what changed between two snapshots")
+    _add_destination_arguments(diff)
+    diff.add_argument("old", help="name of the older snapshot")
+    diff.add_argument("new", nargs="?", default="latest", help="name of the newer snapshot (default: latest)")
+    diff.add_argument("--unchanged", action="store_true", help="also list unchanged files")
+    diff.set_defaults(func=_diff)
+
+    restore = subparsers.add_parser("restore", help="restore a snapshot or part of it")
+    _add_destination_arguments(restore)
+    restore.add_argument("target", help="local directory to restore into")
+    restore.add_argument("patterns", nargs="*", help="only restore paths matching these shell-style patterns")
+    restore.add_argument("--snapshot", default="latest", help="name of the snapshot (default: latest)")
+    restore.add_argument("--workers", type=int, default=4, help="number of parallel streams (default: 4)")
+    restore.set_defaults(func=_restore)
+
+    assemble = subparsers.add_parser("assemble", help="put chunked large files back together in a snapshot")
+    _add_destination_arguments(assemble)
+    assemble.add_argument("paths", nargs="*", help="only assemble these paths relative to the snapshot")
+    assemble.add_argument("--snapshot", default="latest", help="name of the snapshot (default: latest)")
+    assemble.set_defaults(func=_assemble)
+
+    space = subparsers.add_parser("space", help="show how much space deleting each snapshot would free")
+    _add_destination_arguments(space)
+    space.set_defaults(func=_space)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except ConfigFileError as e:
+        sys.stderr.write(f"{e}\n")
+        return 2
+    except (DaemonNotRunningError, ScriptFailedError) as e:
+        sys.stderr.write(f"{e}\n")
+        return 1
@@ -1,5 +1,48 @@
-from pisync.config.base_config import BackupType, InvalidPathError
-from pisync.config.local_config import LocalConfig
-from pisync.config.remote_config import RemoteConfig
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-__all__ = ("InvalidPathError", "BackupType", "LocalConfig", "RemoteConfig")
+from pisync.config.base_config import BackupType, InvalidPathError, ScriptFailedError, Source
+
+if TYPE_CHECKING:
+    from pisync.config.filters import DEFAULT_IGNORE_FILE_NAME, FilterSet, MultiSourceFilterSet, PruneStats
+    from pisync.config.local_config import LocalConfig
+    from pisync.config.pull_config import PullConfig
+    from pisync.config.remote_config import RemoteConfig
+
+__all__ = (
+    "InvalidPathError",
+    "BackupType",
+    "DEFAULT_IGNORE_FILE_NAME",
+    "FilterSet",
+    "LocalConfig",
+    "MultiSourceFilterSet",
+    "PruneStats",
+    "PullConfig",
+    "RemoteConfig",
+    "ScriptFailedError",
+    "Source",
+)
+
+# Imported on first use so that local backups never import fabric
+_LAZY_ATTRIBUTES = {
+    "DEFAULT_IGNORE_FILE_NAME": "pisync.config.filters",
+    "FilterSet": "pisync.config.filters",
+    "MultiSourceFilterSet": "pisync.config.filters",
+    "PruneStats": "pisync.config.filters",
+    "LocalConfig": "pisync.config.local_config",
+    "PullConfig": "pisync.config.pull_config",
+    "RemoteConfig": "pisync.config.remote_config",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_ATTRIBUTES:
+        msg = f"module {__name__!r} has no attribute {name!r}"
+        raise AttributeError(msg)
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted([*globals(), *_LAZY_ATTRIBUTES])
@@ -1,23 +1,149 @@
+import os
+import posixpath
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import List, Optional
+from typing import IO, TYPE_CHECKING, ContextManager, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from pisync.config.filters import FilterSet, MultiSourceFilterSet
+    from pisync.config.resources import ResourcePolicy
 
 
 class InvalidPathError(Exception):
     pass
 
 
+class ScriptFailedError(Exception):
+    pass
+
+
+class DestinationLockedError(Exception):
+    pass
+
+
+# the directory in destination_dir holding the state of pisync, which is not a snapshot
+STATE_DIR = ".pisync"
+# held by the backup writing to destination_dir, in STATE_DIR
+LOCK_FILE = "backup.lock"
+
+# rsync --relative keeps the full path of every source, so the snapshot of
+# several sources is relative to the root directory
+MULTI_SOURCE_ROOT = "/"
+
+TAR_COMPRESSION = {
+    None: [],
+    "gzip": ["-z"],
+    "zstd": ["--use-compress-program=zstd"],
+}
+
+
+def get_tar_create_command(directory: str, *, recursive: bool = True) -> List[str]:
+    """
+    :returns: tar arguments to archive the NUL separated paths read from stdin
+    to stdout, keeping the metadata rsync --archive preserves
+    """
+    recursion = [] if recursive else ["--no-recursion"]
+    return ["tar", "-c", "-f", "-", "-C", directory, "--numeric-owner", *recursion, "--null", "-T", "-"]
+
+
+def get_tar_extract_command(directory: str, compression: Optional[str] = None) -> List[str]:
+    """:returns: tar arguments to extract an archive from stdin into directory keeping metadata"""
+    return ["tar", "-x", "-p", "-f", "-", "-C", directory, "--numeric-owner", *TAR_COMPRESSION[compression]]
+
+
+class Source(NamedTuple):
+    """One of several directories backed up into the same snapshot, with exclude patterns that only apply to it"""
+
+    path: str
+    exclude_file_patterns: Optional[List[str]] = None
+
+
+def split_sources(source_dir: Union[str, "os.PathLike[str]", Sequence[Source]]) -> Tuple[str, List[Source]]:
+    """
+    :returns: The directory the snapshot is relative to, and the sources of a
+    config with several of them (empty for a single `source_dir`)
+    :raises:
+        ValueError: If a source is not absolute or is inside another one
+    """
+    if isinstance(source_dir, (str, os.PathLike)):
+        return str(source_dir), []
+    sources = [Source(str(path), patterns) for path, patterns in source_dir]
+    if not sources:
+        msg = "No source directories"
+        raise ValueError(msg)
+    paths = []
+    for source in sources:
+        if not posixpath.isabs(source.path):
+            msg = f"Source {source.path} must be an absolute path"
+            raise ValueError(msg)
+        paths.append(posixpath.normpath(source.path))
+    for path in paths:
+        for other in paths:
+            if path != other and posixpath.commonpath([path, other]) == other:
+                msg = f"Source {path} is inside source {other}"
+                raise ValueError(msg)
+    if len(set(paths)) != len(paths):
+        msg = "Duplicate source directories"
+        raise ValueError(msg)
+    return MULTI_SOURCE_ROOT, sources
+
+
 class BackupType(Enum):
     Complete = 1
     Incremental = 2
+    # complete backup into a directory already seeded with a tar stream
+    Seeded = 3
 
 
 class BaseConfig(ABC):
     source_dir: str
+    # the directories of a config with several sources, transferred with
+    # --relative in one rsync run; empty for a single source_dir
+    sources: List[Source]
     destination_dir: str
     exclude_file_patterns: Optional[List[str]]
     log_file: str
     link_dir: str
+    seed: bool
+    seed_compression: Optional[str]
+    # files larger than this many bytes go to the chunk store instead of rsync
+    chunk_threshold: Optional[int]
+    resources: Optional["ResourcePolicy"]
+    filters: Union["FilterSet", "MultiSourceFilterSet"]
+
+    def source_paths(self) -> List[str]:
+        """:returns: The directories that are backed up"""
+        return [source.path for source in self.sources] or [self.source_dir]
+
+    def rsync_source_arguments(self) -> List[str]:
+        """:returns: The source arguments of the rsync command"""
+        if not self.sources:
+            return [self.source_dir]
+        return ["--relative", *self.source_paths()]
+
+    @abstractmethod
+    def check_paths(self) -> None:
+        """
+        Make sure source_dir and destination_dir are directories. Only checks
+        once, so it is cheap to call before every backup.
+
+        :raises:
+            InvalidPathError: If either path does not exist or is not a directory
+        """
+        pass
+
+    @abstractmethod
+    def lock_destination(self) -> ContextManager[None]:
+        """
+        Hold an exclusive lock on destination_dir, so that only one backup at a
+        time writes to it, also from other processes and machines. The lock is
+        a file in its STATE_DIR and is released when the context exits or the
+        process dies.
+
+        :raises:
+            DestinationLockedError: If another backup holds the lock
+        """
+        pass
 
     @abstractmethod
     def is_symlink(self, path: str) -> bool:
@@ -26,7 +152,7 @@ class BaseConfig(ABC):
 
     @abstractmethod
     def is_empty_directory(self, path: str) -> bool:
-        """returns true if path is a directory and contains no files"""
+        """returns true if path is a directory and contains no files besides STATE_DIR"""
         pass
 
     @abstractmethod
@@ -73,6 +199,39 @@ class BaseConfig(ABC):
         """
         pass
 
+    @abstractmethod
+    def run_script(self, script: str, args: List[str]) -> Iterator[str]:
+        """
+        Run a python script with args on the machine holding destination_dir.
+
+        :returns: The lines the script writes to stdout as they arrive
+        :raises:
+            ScriptFailedError: If the script exits with a non zero exit code
+        """
+        pass
+
+    @abstractmethod
+    def read_tar(self, directory: str, paths: List[str], out: IO[bytes], *, recursive: bool = True) -> None:
+        """
+        Write a tar archive of paths relative to directory on the machine
+        holding destination_dir to out.
+
+        :raises:
+            ScriptFailedError: If tar exits with a non zero exit code
+        """
+        pass
+
+    @abstractmethod
+    def write_tar(self, directory: str, archive: IO[bytes], *, compression: Optional[str] = None) -> None:
+        """
+        Create directory on the machine holding destination_dir and extract
+        the tar archive read from archive into it.
+
+        :raises:
+            ScriptFailedError: If tar exits with a non zero exit code
+        """
+        pass
+
     @abstractmethod
     def get_rsync_command(self, new_backup_dir: str, backup_method: BackupType):
         pass
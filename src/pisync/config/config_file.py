@@ -0,0 +1,187 @@
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import pisync.config
+from pisync.config.base_config import BaseConfig, Source, split_sources
+from pisync.config.pull_config import is_remote_source
+from pisync.config.resources import ResourcePolicy
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib  # type: ignore[no-redef]
+
+
+class ConfigFileError(Exception):
+    pass
+
+
+# options accepted by both LocalConfig and RemoteConfig
+CONFIG_OPTIONS = {
+    "source_dir",
+    "destination_dir",
+    "exclude_file_patterns",
+    "log_file",
+    "exclude_caches",
+    "ignore_file_name",
+    "seed",
+    "seed_compression",
+    "probe_rsync",
+    "preserve_acls_xattrs",
+    "chunk_threshold",
+    "resources",
+    "sources",
+}
+# options accepted by PullConfig, whose source_dir is on a remote machine
+PULL_OPTIONS = {
+    "source_dir",
+    "destination_dir",
+    "exclude_file_patterns",
+    "log_file",
+    "ignore_file_name",
+    "probe_rsync",
+    "preserve_acls_xattrs",
+    "resources",
+    "bwlimit",
+}
+# options describing the backup itself rather than how to construct its config
+BACKUP_OPTIONS = {"name", "host", "schedule"}
+
+
+def default_config_file() -> Path:
+    xdg_config_home = os.environ.get("XDG_CONFIG_HOME")
+    config_home = Path(xdg_config_home) if xdg_config_home else Path.home() / ".config"
+    return config_home / "pisync" / "pisync.toml"
+
+
+def load_config_file(path: Optional[str] = None) -> Dict[str, BaseConfig]:
+    """
+    Read backups from a TOML file. Values in the optional `[defaults]` table
+    apply to every `[[backup]]`, and a backup with a `host` is a
+    `RemoteConfig`. A backup whose `source_dir` is `user@hostname:/path` is a
+    `PullConfig` that pulls it into the local `destination_dir`. Instead of
+    `source_dir`, a `[backup.sources]` table backs up several directories
+    into one snapshot, each with its own exclude patterns. For example:
+
+        [defaults]
+        log_file = "/var/log/pisync.log"
+
+        [[backup]]
+        name = "home"
+        source_dir = "/home/"
+        destination_dir = "/media/backup_drive/home"
+        exclude_file_patterns = ["**/node_modules/"]
+
+        [[backup]]
+        name = "home-offsite"
+        host = "ethan@hydrogen.local"
+        source_dir = "/home/"
+        destination_dir = "/mnt/hd/home"
+        schedule = "30 2 * * *"
+
+        [[backup]]
+        name = "hydrogen"
+        host = "ethan@hydrogen.local"
+        destination_dir = "/mnt/hd/sulfur"
+
+        [backup.sources]
+        "/home/" = ["/*/.cache/"]
+        "/mnt/hd2/" = []
+
+        [[backup]]
+        name = "laptop"
+        source_dir = "ethan@laptop.local:/home/"
+        destination_dir = "/mnt/hd/laptop"
+        bwlimit = 10240
+
+    The `schedule` of a backup is only used by `pisync daemon`. Paths are not
+    checked until a backup runs, so loading a file never connects to a remote
+    machine.
+
+    :returns: The configs by backup name in the order of the file
+    :raises:
+        ConfigFileError: If the file cannot be read or is not valid
+    """
+    path = str(default_config_file()) if path is None else path
+    return {name: _make_config(path, name, options) for name, options in _read_backups(path).items()}
+
+
+def load_schedules(path: Optional[str] = None) -> Dict[str, str]:
+    """
+    :returns: The cron expression in the `schedule` option of every backup
+    that has one, by backup name
+    :raises:
+        ConfigFileError: If the file cannot be read or is not valid
+    """
+    path = str(default_config_file()) if path is None else path
+    return {name: options["schedule"] for name, options in _read_backups(path).items() if "schedule" in options}
+
+
+def _read_backups(path: str) -> Dict[str, Dict[str, Any]]:
+    """:returns: The options of every backup merged with the defaults, by backup name"""
+    try:
+        with open(path, "rb") as f:
+            document = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        msg = f"Could not read {path}: {e}"
+        raise ConfigFileError(msg) from e
+
+    unknown_tables = set(document) - {"defaults", "backup"}
+    if unknown_tables:
+        msg = f"{path}: unknown tables {sorted(unknown_tables)}"
+        raise ConfigFileError(msg)
+    defaults = document.get("defaults", {})
+
+    backups: Dict[str, Dict[str, Any]] = {}
+    for index, table in enumerate(document.get("backup", [])):
+        options = {**defaults, **table}
+        name = options.pop("name", None)
+        if name is None:
+            msg = f"{path}: backup number {index + 1} has no name"
+            raise ConfigFileError(msg)
+        if name in backups:
+            msg = f"{path}: duplicate backup name {name!r}"
+            raise ConfigFileError(msg)
+        backups[name] = options
+    return backups
+
+
+def _make_config(path: str, name: str, options: Dict[str, Any]) -> BaseConfig:
+    options = dict(options)
+    host = options.pop("host", None)
+    options.pop("schedule", None)
+    pull = host is None and is_remote_source(str(options.get("source_dir", "")))
+    unknown = set(options) - (PULL_OPTIONS if pull else CONFIG_OPTIONS)
+    if unknown:
+        msg = f"{path}: backup {name!r} has unknown options {sorted(unknown)}"
+        raise ConfigFileError(msg)
+    if "sources" in options:
+        if "source_dir" in options:
+            msg = f"{path}: backup {name!r} has both source_dir and sources"
+            raise ConfigFileError(msg)
+        try:
+            sources = [Source(source, patterns or None) for source, patterns in options.pop("sources").items()]
+            split_sources(sources)
+        except (AttributeError, ValueError) as e:
+            msg = f"{path}: backup {name!r} has invalid sources: {e}"
+            raise ConfigFileError(msg) from e
+        options["source_dir"] = sources
+    missing = {"source_dir", "destination_dir"} - set(options)
+    if missing:
+        msg = f"{path}: backup {name!r} is missing {sorted(missing)}"
+        raise ConfigFileError(msg)
+    if "resources" in options:
+        try:
+            options["resources"] = ResourcePolicy(**options["resources"])
+        except (TypeError, ValueError) as e:
+            msg = f"{path}: backup {name!r} has invalid resources: {e}"
+            raise ConfigFileError(msg) from e
+
+    if pull:
+        source = options.pop("source_dir")
+        return pisync.config.PullConfig(source, **options, check_paths=False)
+    elif host is None:
+        return pisync.config.LocalConfig(**options, check_paths=False)
+    else:
+        return pisync.config.RemoteConfig(host, **options, check_paths=False)
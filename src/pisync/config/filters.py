@@ -0,0 +1,486 @@
+import hashlib
+import os
+import posixpath
+import re
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Pattern, Sequence, Tuple, Union
+
+from pisync.config.base_config import MULTI_SOURCE_ROOT, Source
+from pisync.util import get_cache_dir
+
+CACHEDIR_TAG = "CACHEDIR.TAG"
+# https://bford.info/cachedir/
+CACHEDIR_TAG_SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+DEFAULT_IGNORE_FILE_NAME = ".pisyncignore"
+# exclude files that no backup used for this many seconds are deleted
+EXCLUDE_FILE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+class PruneStats(NamedTuple):
+    rule: str
+    files: int
+    bytes: int
+
+
+class FilterRule:
+    """
+    A single rsync exclude pattern compiled to a regular expression that is
+    matched against paths relative to the root of the transfer.
+    """
+
+    def __init__(self, pattern: str, label: Optional[str] = None, base: str = ""):
+        self.pattern = pattern
+        self.label = pattern if label is None else label
+        self.dir_only = pattern.endswith("/")
+        body = pattern.rstrip("/")
+        anchored = body.startswith("/")
+        body = body.lstrip("/")
+        if body.endswith("/***"):
+            body = body[: -len("/***")]
+            suffix = "(?:/.*)?"
+        else:
+            suffix = ""
+        prefix = re.escape(f"{base}/") if base else ""
+        if not anchored:
+            # non-anchored patterns are matched against the end of the path
+            prefix += "(?:.*/)?"
+        self.regex = f"{prefix}{_translate(body)}{suffix}"
+        self.literal = None if anchored or any(c in body for c in "*?[/\\") else body
+        self.base = base
+
+
+class FilterSet:
+    """
+    Normalized exclude patterns for one source directory.
+
+    Patterns are deduplicated and written to a single `--exclude-from` file
+    instead of one `--exclude` argument each. Absolute patterns that point
+    inside `source_dir` are anchored to the root of the transfer. Optionally,
+    directories containing a CACHEDIR.TAG are excluded and per-directory
+    ignore files are merged by rsync.
+    """
+
+    def __init__(
+        self,
+        source_dir: str,
+        exclude_file_patterns: Optional[Sequence[str]] = None,
+        *,
+        exclude_caches: bool = False,
+        ignore_file_name: Optional[str] = None,
+        base: str = "",
+    ):
+        # with a base, the content of source_dir is transferred into the base
+        # directory and the patterns are relative to source_dir
+        self.source_dir = f"{str(source_dir).rstrip('/')}/" if base else str(source_dir)
+        self.base = base.strip("/")
+        self.exclude_caches = exclude_caches
+        self.ignore_file_name = ignore_file_name
+        self.patterns = normalize_patterns(exclude_file_patterns or [], self.source_dir)
+        self._matcher = _RuleMatcher([FilterRule(p, base=self.base) for p in self.patterns])
+
+    def rsync_arguments(self) -> List[str]:
+        arguments = []
+        if self.ignore_file_name is not None:
+            arguments.append(f"--filter=dir-merge,- {self.ignore_file_name}")
+        patterns = self.rsync_patterns()
+        if patterns:
+            arguments.append(f"--exclude-from={write_exclude_file(patterns)}")
+        return arguments
+
+    def rsync_patterns(self) -> List[str]:
+        """:returns: The exclude patterns relative to the root of the transfer"""
+        patterns = [anchored for pattern in self.patterns for anchored in _anchor_pattern(pattern, self.base)]
+        if self.exclude_caches:
+            patterns.extend(f"/{path}/" for path in self.find_cache_directories())
+        return patterns
+
+    def find_cache_directories(self) -> List[str]:
+        """
+        :returns: The directories relative to the root of the transfer that
+        contain a valid CACHEDIR.TAG, outside of cache directories and of
+        directories excluded by name (e.g. `node_modules/`).
+
+        The tree is searched by `find`, which is much faster than walking it
+        in python and only has to read the few CACHEDIR.TAG files it finds.
+        """
+        if self.base:
+            top, first = self.source_dir.rstrip("/") or "/", self.base
+        else:
+            root, first = _transfer_root(self.source_dir)
+            top = os.path.join(root, first) if first else root
+        command = ["find", top, *_prune_arguments(self._matcher.rules), "-type", "f", "-name", CACHEDIR_TAG, "-print0"]
+        # find exits with 1 if a directory is not readable, which rsync reports during the backup
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False).stdout
+        directories: List[str] = []
+        for tag in sorted(os.fsdecode(path) for path in output.split(b"\0") if path):
+            directory = os.path.dirname(tag)
+            if directory == top or any(directory.startswith(f"{found}/") for found in directories):
+                continue
+            if _is_cache_directory(directory):
+                directories.append(directory)
+        return [posixpath.join(first, os.path.relpath(directory, top)) for directory in directories]
+
+    def excluded_paths(self) -> List[str]:
+        """:returns: The top-most excluded files and directories relative to the root of the transfer"""
+        return [relative_path for relative_path, _, _ in self._walk()]
+
+    def prune_report(self) -> List[PruneStats]:
+        """
+        Walk the source directory and count the files and bytes each rule
+        keeps out of the backup, sorted by bytes pruned.
+        """
+        totals: Dict[str, List[int]] = {}
+        for _, rule, path in self._walk():
+            files, size = _tree_size(path)
+            total = totals.setdefault(rule, [0, 0])
+            total[0] += files
+            total[1] += size
+        stats = [PruneStats(rule, files, size) for rule, (files, size) in totals.items()]
+        return sorted(stats, key=lambda s: (s.bytes, s.files), reverse=True)
+
+    def large_files(self, min_size: int) -> Iterator[Tuple[str, str, os.stat_result]]:
+        """
+        :returns: (relative path, absolute path, lstat) for every regular file
+        larger than `min_size` bytes that is not excluded.
+        """
+        for relative_path, rule, entry in self._walk_all():
+            if rule is None and entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_size > min_size:
+                    yield relative_path, entry.path, stat
+
+    def _walk(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        :returns: (relative path, rule label, absolute path) for every
+        top-most file or directory that is excluded.
+        """
+        for relative_path, rule, entry in self._walk_all():
+            if rule is not None:
+                yield relative_path, rule, entry.path
+
+    def _walk_all(self) -> Iterator[Tuple[str, Optional[str], "os.DirEntry[str]"]]:
+        """
+        :returns: (relative path, label of the rule excluding it or None,
+        directory entry) for every entry that is not inside an excluded
+        directory.
+        """
+        if self.base:
+            top, first = self.source_dir, self.base
+        else:
+            root, first = _transfer_root(self.source_dir)
+            top = os.path.join(root, first) if first else root
+        stack: List[Tuple[str, str, _RuleMatcher]] = [(top, first, self._matcher)]
+        while stack:
+            directory, relative_directory, matcher = stack.pop()
+            if self.ignore_file_name is not None:
+                matcher = matcher.merged(directory, relative_directory, self.ignore_file_name)
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                rule = matcher.match(relative_path, entry.name, is_dir=is_dir)
+                if rule is not None:
+                    yield relative_path, rule.label, entry
+                elif is_dir and self.exclude_caches and _is_cache_directory(entry.path):
+                    yield relative_path, CACHEDIR_TAG, entry
+                else:
+                    yield relative_path, None, entry
+                    if is_dir:
+                        stack.append((entry.path, relative_path, matcher))
+
+
+class MultiSourceFilterSet:
+    """
+    The exclude patterns of several sources transferred with `--relative`.
+    Each source has its own `FilterSet` whose patterns are relative to that
+    source and only match inside it. The common `exclude_file_patterns` are
+    relative to the root directory: patterns without a leading slash apply to
+    every source and absolute ones to the source they point into.
+    """
+
+    def __init__(
+        self,
+        sources: Sequence[Tuple[str, Optional[Sequence[str]]]],
+        exclude_file_patterns: Optional[Sequence[str]] = None,
+        *,
+        exclude_caches: bool = False,
+        ignore_file_name: Optional[str] = None,
+    ):
+        self.source_dir = MULTI_SOURCE_ROOT
+        self.exclude_caches = exclude_caches
+        self.ignore_file_name = ignore_file_name
+        common_patterns = normalize_patterns(exclude_file_patterns or [])
+        self.filter_sets = []
+        for path, patterns in sources:
+            root = posixpath.normpath(path)
+            inside = [p for p in common_patterns if not p.startswith("/") or p.startswith(f"{root}/")]
+            self.filter_sets.append(
+                FilterSet(
+                    root,
+                    [*inside, *(patterns or [])],
+                    exclude_caches=exclude_caches,
+                    ignore_file_name=ignore_file_name,
+                    base=root,
+                )
+            )
+
+    @property
+    def patterns(self) -> List[str]:
+        return [pattern for filter_set in self.filter_sets for pattern in filter_set.rsync_patterns()]
+
+    def rsync_arguments(self) -> List[str]:
+        arguments = []
+        if self.ignore_file_name is not None:
+            arguments.append(f"--filter=dir-merge,- {self.ignore_file_name}")
+        patterns = self.patterns
+        if patterns:
+            arguments.append(f"--exclude-from={write_exclude_file(patterns)}")
+        return arguments
+
+    def find_cache_directories(self) -> List[str]:
+        return [path for filter_set in self.filter_sets for path in filter_set.find_cache_directories()]
+
+    def excluded_paths(self) -> List[str]:
+        return [path for filter_set in self.filter_sets for path in filter_set.excluded_paths()]
+
+    def prune_report(self) -> List[PruneStats]:
+        totals: Dict[str, List[int]] = {}
+        for filter_set in self.filter_sets:
+            for rule_stats in filter_set.prune_report():
+                total = totals.setdefault(rule_stats.rule, [0, 0])
+                total[0] += rule_stats.files
+                total[1] += rule_stats.bytes
+        stats = [PruneStats(rule, files, size) for rule, (files, size) in totals.items()]
+        return sorted(stats, key=lambda s: (s.bytes, s.files), reverse=True)
+
+    def large_files(self, min_size: int) -> Iterator[Tuple[str, str, os.stat_result]]:
+        for filter_set in self.filter_sets:
+            yield from filter_set.large_files(min_size)
+
+
+def make_filter_set(
+    source_dir: str,
+    sources: Sequence[Source],
+    exclude_file_patterns: Optional[Sequence[str]] = None,
+    *,
+    exclude_caches: bool = False,
+    ignore_file_name: Optional[str] = None,
+) -> Union[FilterSet, MultiSourceFilterSet]:
+    """:returns: The filters of a config with a single `source_dir` or several `sources`"""
+    if sources:
+        return MultiSourceFilterSet(
+            sources, exclude_file_patterns, exclude_caches=exclude_caches, ignore_file_name=ignore_file_name
+        )
+    return FilterSet(
+        source_dir, exclude_file_patterns, exclude_caches=exclude_caches, ignore_file_name=ignore_file_name
+    )
+
+
+class _RuleMatcher:
+    """Match a path against many rules with a single regular expression"""
+
+    def __init__(self, rules: List[FilterRule]):
+        self.rules = rules
+        self._literals: Dict[str, int] = {}
+        for index, rule in enumerate(rules):
+            if rule.literal is not None and not rule.base:
+                self._literals.setdefault(rule.literal, index)
+        self._any = _compile(rules, dirs=True)
+        self._files = _compile(rules, dirs=False)
+
+    def match(self, relative_path: str, name: str, *, is_dir: bool) -> Optional[FilterRule]:
+        candidates = []
+        literal_index = self._literals.get(name)
+        if literal_index is not None and (is_dir or not self.rules[literal_index].dir_only):
+            candidates.append(literal_index)
+        regex = self._any if is_dir else self._files
+        if regex is not None:
+            match = regex.fullmatch(relative_path)
+            if match is not None and match.lastgroup is not None:
+                candidates.append(int(match.lastgroup[1:]))
+        if not candidates:
+            return None
+        return self.rules[min(candidates)]
+
+    def merged(self, directory: str, relative_directory: str, ignore_file_name: str) -> "_RuleMatcher":
+        try:
+            with open(os.path.join(directory, ignore_file_name)) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return self
+        label_prefix = f"{relative_directory}/{ignore_file_name}" if relative_directory else ignore_file_name
+        rules = [
+            FilterRule(p, label=f"{label_prefix}: {p}", base=relative_directory) for p in normalize_patterns(lines)
+        ]
+        if not rules:
+            return self
+        # like rsync, rules from a per-directory merge file take precedence
+        return _RuleMatcher(rules + self.rules)
+
+
+def normalize_patterns(patterns: Sequence[str], source_dir: Optional[str] = None) -> List[str]:
+    """
+    Strip blank lines and comments, collapse redundant slashes and `**`,
+    anchor absolute patterns inside `source_dir` and drop duplicates while
+    keeping the first occurrence.
+    """
+    root = "/" if source_dir is None else _transfer_root(str(source_dir))[0]
+    seen = set()
+    normalized = []
+    for raw_pattern in patterns:
+        pattern = raw_pattern.strip()
+        if not pattern or pattern.startswith(("#", ";")):
+            continue
+        pattern = re.sub("/{2,}", "/", pattern)
+        pattern = re.sub(r"(\*\*/)+", "**/", pattern)
+        if root != "/" and pattern.startswith(f"{root}/"):
+            pattern = pattern[len(root) :]
+        if pattern not in seen:
+            seen.add(pattern)
+            normalized.append(pattern)
+    return normalized
+
+
+def write_exclude_file(patterns: Sequence[str]) -> str:
+    """
+    Write patterns to a content addressed file for `--exclude-from`
+
+    :returns: The path to the exclude file
+    """
+    content = "".join(f"{pattern}\n" for pattern in patterns)
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    directory = get_cache_dir() / "filters"
+    path = directory / f"{digest}.rules"
+    if path.exists():
+        # the modification time tells _remove_old_exclude_files the file is still used
+        os.utime(path)
+    else:
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = directory / f".{digest}.{os.getpid()}.tmp"
+        tmp_path.write_text(content)
+        tmp_path.replace(path)
+    _remove_old_exclude_files(directory)
+    return str(path)
+
+
+def _remove_old_exclude_files(directory: Path) -> None:
+    """Delete the exclude files that were not used for `EXCLUDE_FILE_MAX_AGE` seconds"""
+    oldest = time.time() - EXCLUDE_FILE_MAX_AGE
+    for path in directory.glob("*.rules"):
+        try:
+            if path.stat().st_mtime < oldest:
+                path.unlink()
+        except OSError:
+            # removed by a concurrent backup
+            continue
+
+
+def _anchor_pattern(pattern: str, base: str) -> List[str]:
+    """:returns: rsync patterns that match what `pattern` matches inside the `base` directory only"""
+    if not base:
+        return [pattern]
+    if pattern.startswith("/"):
+        return [f"/{base}{pattern}"]
+    # a pattern without a leading slash matches at any depth, "**/" may not
+    # match zero directories in every rsync version
+    body = pattern[len("**/") :] if pattern.startswith("**/") else pattern
+    return [f"/{base}/{body}", f"/{base}/**/{body}"]
+
+
+def _translate(pattern: str) -> str:
+    """Translate an rsync wildcard pattern into a regular expression"""
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1 : end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex.append(f"[{body}]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+def _compile(rules: List[FilterRule], *, dirs: bool) -> Optional[Pattern[str]]:
+    alternatives = [
+        f"(?P<r{index}>{rule.regex})"
+        for index, rule in enumerate(rules)
+        if (rule.literal is None or rule.base) and (dirs or not rule.dir_only)
+    ]
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.DOTALL)
+
+
+def _transfer_root(source_dir: str) -> Tuple[str, str]:
+    """
+    rsync copies the contents of a source with a trailing slash and the
+    directory itself otherwise.
+
+    :returns: The directory paths in the transfer are relative to, and the
+    first path component inside of it.
+    """
+    if source_dir.endswith("/"):
+        return source_dir.rstrip("/") or "/", ""
+    path = Path(source_dir)
+    return str(path.parent), path.name
+
+
+def _prune_arguments(rules: List[FilterRule]) -> List[str]:
+    """:returns: find arguments that skip the directories rules exclude by name alone"""
+    tests = []
+    for rule in rules:
+        if rule.literal is not None:
+            tests.append(["-type", "d", "-name", rule.literal] if rule.dir_only else ["-name", rule.literal])
+    if not tests:
+        return []
+    expression = [argument for test in tests for argument in ["-o", "(", *test, ")"]][1:]
+    return ["(", *expression, ")", "-prune", "-o"]
+
+
+def _is_cache_directory(path: str) -> bool:
+    try:
+        with open(os.path.join(path, CACHEDIR_TAG), "rb") as f:
+            return f.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE
+    except OSError:
+        return False
+
+
+def _tree_size(path: str) -> Tuple[int, int]:
+    """:returns: The number of files and their total size in bytes under path"""
+    stat = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return 1, stat.st_size
+    files, size = 0, 0
+    for directory, _, file_names in os.walk(path):
+        for name in file_names:
+            try:
+                size += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                continue
+            files += 1
+    return files, size
@@ -1,28 +1,70 @@
+import contextlib
+import fcntl
+import os
+import subprocess
+import sys
+import tempfile
 from pathlib import Path
 from shutil import rmtree
-from typing import List, Optional
-
-from pisync.config.base_config import BackupType, BaseConfig, InvalidPathError
+from typing import IO, Iterator, List, Optional, Sequence, Union
+
+from pisync.config.base_config import (
+    LOCK_FILE,
+    STATE_DIR,
+    BackupType,
+    BaseConfig,
+    DestinationLockedError,
+    InvalidPathError,
+    ScriptFailedError,
+    Source,
+    get_tar_create_command,
+    get_tar_extract_command,
+    split_sources,
+)
+from pisync.config.filters import make_filter_set
+from pisync.config.probe import choose_rsync_arguments, local_capabilities
+from pisync.config.resources import ResourcePolicy
 from pisync.util import get_time_stamp
 
 
 class LocalConfig(BaseConfig):
     def __init__(
         self,
-        source_dir: str,
+        source_dir: Union[str, Sequence[Source]],
         destination_dir: str,
         exclude_file_patterns: Optional[List[str]] = None,
         log_file: Optional[str] = None,
+        *,
+        exclude_caches: bool = False,
+        ignore_file_name: Optional[str] = None,
+        seed: bool = False,
+        seed_compression: Optional[str] = None,
+        probe_rsync: bool = False,
+        preserve_acls_xattrs: bool = False,
+        chunk_threshold: Optional[int] = None,
+        resources: Optional[ResourcePolicy] = None,
+        check_paths: bool = True,
     ):
-        self.ensure_dir_exists(source_dir)
-        self.ensure_dir_exists(destination_dir)
-        self.source_dir = source_dir
+        self.source_dir, self.sources = split_sources(source_dir)
         self.destination_dir = destination_dir
         self.exclude_file_patterns = exclude_file_patterns
+        self.filters = make_filter_set(
+            self.source_dir,
+            self.sources,
+            exclude_file_patterns,
+            exclude_caches=exclude_caches,
+            ignore_file_name=ignore_file_name,
+        )
         if log_file is None:
             self.log_file = str(Path.home() / ".local/share/backup/rsync-backups.log")
         else:
             self.log_file = log_file
+        self.seed = seed
+        self.seed_compression = seed_compression
+        self.probe_rsync = probe_rsync
+        self.preserve_acls_xattrs = preserve_acls_xattrs
+        self.chunk_threshold = chunk_threshold
+        self.resources = resources
         self.link_dir = str(Path(self.destination_dir) / "latest")
         self._optionless_rsync_arguments = [
             "--delete",  # delete extraneous files from dest dirs
@@ -30,6 +72,29 @@ class LocalConfig(BaseConfig):
             "--verbose",  # increase verbosity
             "--info=stats3",
         ]
+        self._paths_checked = False
+        if check_paths:
+            self.check_paths()
+
+    def check_paths(self) -> None:
+        if not self._paths_checked:
+            for source_path in self.source_paths():
+                self.ensure_dir_exists(source_path)
+            self.ensure_dir_exists(self.destination_dir)
+            self._paths_checked = True
+
+    @contextlib.contextmanager
+    def lock_destination(self) -> Iterator[None]:
+        state_dir = Path(self.destination_dir) / STATE_DIR
+        state_dir.mkdir(exist_ok=True)
+        with open(state_dir / LOCK_FILE, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError as e:
+                msg = f"Another backup to {self.destination_dir} is running"
+                raise DestinationLockedError(msg) from e
+            # closing the file releases the lock
+            yield
 
     def is_symlink(self, path: str) -> bool:
         return Path(path).is_symlink()
@@ -52,7 +117,7 @@ class LocalConfig(BaseConfig):
         return str(Path(path).resolve())
 
     def is_empty_directory(self, path: str) -> bool:
-        return not any(Path(path).iterdir())
+        return all(child.name == STATE_DIR for child in Path(path).iterdir())
 
     def ensure_dir_exists(self, path: str):
         _path = Path(path)
@@ -72,17 +137,70 @@ class LocalConfig(BaseConfig):
         else:
             return str(new_backup_dir)
 
+    def run_script(self, script: str, args: List[str]) -> Iterator[str]:
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                [sys.executable, "-c", script, *args], stdout=subprocess.PIPE, stderr=stderr, text=True
+            )
+            # If the stdout argument was not PIPE, this attribute is None.
+            if process.stdout is not None:
+                for line in process.stdout:
+                    yield line.rstrip("\n")
+            if process.wait() != 0:
+                stderr.seek(0)
+                msg = f"Script failed with exit code {process.returncode}: {stderr.read().decode(errors='replace')}"
+                raise ScriptFailedError(msg)
+
+    def read_tar(self, directory: str, paths: List[str], out: IO[bytes], *, recursive: bool = True) -> None:
+        command = get_tar_create_command(str(directory), recursive=recursive)
+        file_list = b"".join(os.fsencode(path) + b"\0" for path in paths)
+        process = subprocess.run(command, input=file_list, stdout=out, stderr=subprocess.PIPE, check=False)
+        if process.returncode != 0:
+            msg = f"tar failed with exit code {process.returncode}: {process.stderr.decode(errors='replace')}"
+            raise ScriptFailedError(msg)
+
+    def write_tar(self, directory: str, archive: IO[bytes], *, compression: Optional[str] = None) -> None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        command = get_tar_extract_command(str(directory), compression)
+        process = subprocess.run(command, stdin=archive, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+        if process.returncode != 0:
+            msg = f"tar failed with exit code {process.returncode}: {process.stderr.decode(errors='replace')}"
+            raise ScriptFailedError(msg)
+
     def get_rsync_command(self, new_backup_dir: str, backup_method: BackupType) -> List[str]:
         destination = new_backup_dir
-        source = self.source_dir
         link_dest = self.link_dir
         option_arguments = []
 
         if backup_method == BackupType.Incremental:
             option_arguments.append(f"--link-dest={link_dest}")
+        elif backup_method == BackupType.Seeded:
+            # the seed keeps excluded paths with a newline or backslash, and
+            # rsync applies the rules of ignore files more exactly than the seed
+            option_arguments.append("--delete-excluded")
+
+        if self.chunk_threshold is not None:
+            # larger files are stored in the chunk store after rsync
+            option_arguments.append(f"--max-size={self.chunk_threshold}")
+
+        if self.resources is not None:
+            option_arguments.extend(self.resources.rsync_arguments(remote=False))
+
+        if self.probe_rsync:
+            option_arguments.extend(self._probed_rsync_arguments())
+
+        option_arguments.extend(self.filters.rsync_arguments())
+
+        prefix = [] if self.resources is None else self.resources.local_command_prefix()
+        return [
+            *prefix,
+            "rsync",
+            *self._optionless_rsync_arguments,
+            *option_arguments,
+            *self.rsync_source_arguments(),
+            destination,
+        ]
 
-        if self.exclude_file_patterns is not None:
-            for pattern in self.exclude_file_patterns:
-                option_arguments.append(f"--exclude={pattern}")
-
-        return ["rsync", *self._optionless_rsync_arguments, *option_arguments, source, destination]
+    def _probed_rsync_arguments(self) -> List[str]:
+        local = local_capabilities()
+        return [] if local is None else choose_rsync_arguments(local, preserve_acls_xattrs=self.preserve_acls_xattrs)
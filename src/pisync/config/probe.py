@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from pisync.util import get_cache_dir
+
+# probe results are reused for this many seconds
+PROBE_TTL = 24 * 60 * 60
+PROBE_CACHE_FILE = "rsync-capabilities.json"
+RSYNC_VERSION_COMMAND = ["rsync", "--version"]
+LOCALHOST = "localhost"
+
+# fastest first, see the "Checksum list" and "Compress list" of `rsync --version`
+CHECKSUM_PREFERENCE = ("xxh128", "xxh3", "xxh64")
+COMPRESS_PREFERENCE = ("zstd", "lz4")
+
+
+class RsyncCapabilities(NamedTuple):
+    version: Tuple[int, ...]
+    protocol: int
+    checksums: List[str]
+    compressions: List[str]
+    acls: bool
+    xattrs: bool
+
+
+def parse_rsync_version(output: str) -> Optional[RsyncCapabilities]:
+    """
+    :returns: The features listed in the output of `rsync --version`, or None
+    if it is not the output of rsync (for example openrsync on macOS)
+    """
+    match = re.search(r"^rsync\s+version\s+v?([\d.]+)\S*\s+protocol version (\d+)", output, re.MULTILINE)
+    if match is None:
+        return None
+    version = tuple(int(part) for part in match.group(1).strip(".").split("."))
+
+    sections: Dict[str, List[str]] = {}
+    section = None
+    for line in output.splitlines():
+        if line.endswith(":") and not line.startswith(" "):
+            section = line[:-1].strip().lower()
+            sections[section] = []
+        elif section is not None and line.startswith(" "):
+            sections[section].append(line.strip())
+        else:
+            section = None
+
+    capabilities = {item.strip() for item in ",".join(sections.get("capabilities", [])).split(",")}
+    return RsyncCapabilities(
+        version=version,
+        protocol=int(match.group(2)),
+        checksums=_parse_list(sections.get("checksum list", [])),
+        compressions=_parse_list(sections.get("compress list", [])),
+        acls="ACLs" in capabilities,
+        xattrs="xattrs" in capabilities,
+    )
+
+
+def choose_rsync_arguments(
+    local: RsyncCapabilities, remote: Optional[RsyncCapabilities] = None, *, preserve_acls_xattrs: bool = False
+) -> List[str]:
+    """
+    :returns: The fastest options supported by both the local rsync and the
+    rsync on the other side of the transfer. Compression is only used when
+    there is a remote side. `--acls` and `--xattrs` are only added with
+    `preserve_acls_xattrs`: rsync being built with them says nothing about the
+    destination file system, and rsync exits with 23 if it cannot store them.
+    """
+    other = local if remote is None else remote
+    arguments = []
+
+    checksum = _first_common(CHECKSUM_PREFERENCE, local.checksums, other.checksums)
+    if checksum is not None:
+        arguments.append(f"--checksum-choice={checksum}")
+    if remote is not None:
+        compression = _first_common(COMPRESS_PREFERENCE, local.compressions, remote.compressions)
+        if compression is not None:
+            arguments.extend(["--compress", f"--compress-choice={compression}"])
+    if preserve_acls_xattrs and local.acls and other.acls:
+        arguments.append("--acls")
+    if preserve_acls_xattrs and local.xattrs and other.xattrs:
+        arguments.append("--xattrs")
+    return arguments
+
+
+def local_capabilities(ttl: float = PROBE_TTL) -> Optional[RsyncCapabilities]:
+    """:returns: The capabilities of the local rsync, or None if it could not be probed"""
+    return get_capabilities(LOCALHOST, _local_rsync_version, ttl)
+
+
+def get_capabilities(
+    host: str, rsync_version: Callable[[], Optional[str]], ttl: float = PROBE_TTL
+) -> Optional[RsyncCapabilities]:
+    """
+    Parse the output of `rsync_version()` for `host`, which is only called if
+    the cached output is older than `ttl` seconds. Failed probes are not cached.
+    """
+    cache = _read_cache()
+    entry = cache.get(host)
+    if entry is None or time.time() - entry["probed_at"] > ttl:
+        output = rsync_version()
+        if output is None:
+            logging.warning(f"Could not run rsync --version on {host}")
+            return None
+        entry = {"probed_at": time.time(), "output": output}
+        cache[host] = entry
+        _write_cache(cache)
+    return parse_rsync_version(entry["output"])
+
+
+def _local_rsync_version() -> Optional[str]:
+    try:
+        process = subprocess.run(RSYNC_VERSION_COMMAND, capture_output=True, text=True, check=False)
+    except OSError:
+        return None
+    return process.stdout if process.returncode == 0 else None
+
+
+def _read_cache() -> Dict[str, Dict]:
+    try:
+        with open(get_cache_dir() / PROBE_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache: Dict[str, Dict]) -> None:
+    path = get_cache_dir() / PROBE_CACHE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(cache))
+    tmp_path.replace(path)
+
+
+def _parse_list(lines: List[str]) -> List[str]:
+    # e.g. "xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none"
+    return [word for word in " ".join(lines).split() if not word.startswith("(")]
+
+
+def _first_common(preference: Tuple[str, ...], *supported: List[str]) -> Optional[str]:
+    for name in preference:
+        if all(name in names for names in supported):
+            return name
+    return None
@@ -0,0 +1,147 @@
+import re
+import subprocess
+from typing import List, Optional, Tuple
+
+from pisync.config.base_config import BackupType, InvalidPathError
+from pisync.config.filters import FilterSet
+from pisync.config.local_config import LocalConfig
+from pisync.config.probe import RSYNC_VERSION_COMMAND, choose_rsync_arguments, get_capabilities, local_capabilities
+from pisync.config.resources import ResourcePolicy
+
+# user@hostname:/absolute/path, the hostname may not contain a "/" like rsync requires
+REMOTE_SOURCE = re.compile(r"^(?P<host>[^/:]+):(?P<path>/.*)$")
+SSH_COMMAND = ["ssh"]
+# how long an idle ssh master connection is kept open for the next rsync run,
+# runs on an hourly or daily schedule each open a new one
+SSH_CONTROL_PERSIST = "10m"
+RSYNC_LIST_COMMAND = ["rsync", "--list-only", "--dirs"]
+
+
+def parse_remote_source(source: str) -> Tuple[str, str]:
+    """
+    :returns: The user@hostname and the path of a `user@hostname:/path` source
+    :raises:
+        ValueError: If source is not on a remote machine
+    """
+    match = REMOTE_SOURCE.match(source)
+    if match is None:
+        msg = f"{source!r} is not a remote source like user@hostname:/path"
+        raise ValueError(msg)
+    return match.group("host"), match.group("path")
+
+
+def is_remote_source(source: str) -> bool:
+    return REMOTE_SOURCE.match(source) is not None
+
+
+class PullConfig(LocalConfig):
+    """
+    Pulls `source` (`user@hostname:/path`) from a client into snapshots in the
+    local `destination_dir`, so a backup server can back up many clients
+    without logging in to each one to start a push. Snapshots use the same
+    `--link-dest` and `latest` symlink as every other config.
+
+    Only options rsync applies on the client are supported: exclude patterns
+    and ignore files, but not `exclude_caches`, seeding or the chunk store,
+    which read the source directly. `bwlimit` is an rsync `--bwlimit` in KiB
+    per second; with a `bwlimit_schedule` in `resources` the lower rate is used.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        destination_dir: str,
+        exclude_file_patterns: Optional[List[str]] = None,
+        log_file: Optional[str] = None,
+        *,
+        ignore_file_name: Optional[str] = None,
+        probe_rsync: bool = False,
+        preserve_acls_xattrs: bool = False,
+        resources: Optional[ResourcePolicy] = None,
+        bwlimit: Optional[int] = None,
+        ssh_control_path: Optional[str] = None,
+        check_paths: bool = True,
+    ):
+        self.client, self.source_path = parse_remote_source(source)
+        super().__init__(
+            source,
+            destination_dir,
+            exclude_file_patterns,
+            log_file,
+            probe_rsync=probe_rsync,
+            preserve_acls_xattrs=preserve_acls_xattrs,
+            resources=resources,
+            check_paths=False,
+        )
+        # patterns are anchored to the directory on the client
+        self.filters = FilterSet(self.source_path, exclude_file_patterns, ignore_file_name=ignore_file_name)
+        self.bwlimit = bwlimit
+        self.ssh_control_path = ssh_control_path
+        if check_paths:
+            self.check_paths()
+
+    def check_paths(self) -> None:
+        if not self._paths_checked:
+            self._ensure_source_exists()
+            self.ensure_dir_exists(self.destination_dir)
+            self._paths_checked = True
+
+    def _ensure_source_exists(self) -> None:
+        # listing the directory itself is one round trip and needs nothing but rsync on the client
+        source = f"{self.source_dir.rstrip('/')}/"
+        command = [*RSYNC_LIST_COMMAND, *self._rsh_arguments(), source]
+        process = subprocess.run(command, capture_output=True, text=True, check=False)
+        if process.returncode != 0:
+            msg = f"{self.source_dir} does not exist or is not a directory: {process.stderr.strip()}"
+            raise InvalidPathError(msg)
+
+    def get_rsync_command(self, new_backup_dir: str, backup_method: BackupType) -> List[str]:
+        option_arguments = self._rsh_arguments()
+
+        if backup_method == BackupType.Incremental:
+            option_arguments.append(f"--link-dest={self.link_dir}")
+
+        if self.resources is not None:
+            option_arguments.extend(self.resources.rsync_arguments(remote=True, bwlimit=self.bwlimit))
+        elif self.bwlimit is not None:
+            option_arguments.append(f"--bwlimit={self.bwlimit}")
+
+        if self.probe_rsync:
+            option_arguments.extend(self._probed_rsync_arguments())
+
+        option_arguments.extend(self.filters.rsync_arguments())
+
+        prefix = [] if self.resources is None else self.resources.local_command_prefix()
+        return [*prefix, "rsync", *self._optionless_rsync_arguments, *option_arguments, self.source_dir, new_backup_dir]
+
+    def _rsh_arguments(self) -> List[str]:
+        return [] if self.ssh_control_path is None else [f"--rsh={' '.join(self._ssh_command())}"]
+
+    def _ssh_command(self) -> List[str]:
+        if self.ssh_control_path is None:
+            return list(SSH_COMMAND)
+        # reuse one ssh master connection across rsync runs
+        return [
+            *SSH_COMMAND,
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.ssh_control_path}",
+            "-o",
+            f"ControlPersist={SSH_CONTROL_PERSIST}",
+        ]
+
+    def _probed_rsync_arguments(self) -> List[str]:
+        local = local_capabilities()
+        remote = get_capabilities(self.client, self._remote_rsync_version)
+        if local is None or remote is None:
+            return []
+        return choose_rsync_arguments(local, remote, preserve_acls_xattrs=self.preserve_acls_xattrs)
+
+    def _remote_rsync_version(self) -> Optional[str]:
+        command = [*self._ssh_command(), self.client, *RSYNC_VERSION_COMMAND]
+        try:
+            process = subprocess.run(command, capture_output=True, text=True, check=False)
+        except OSError:
+            return None
+        return process.stdout if process.returncode == 0 else None
@@ -1,43 +1,131 @@
+import contextlib
+import logging
+import os
+import queue
+import shlex
+import threading
 from pathlib import Path
-from typing import List, Optional
+from typing import IO, Any, Iterator, List, Optional, Sequence, Union
 
 from fabric import Connection
 
-from pisync.config.base_config import BackupType, BaseConfig, InvalidPathError
+from pisync.config.base_config import (
+    LOCK_FILE,
+    STATE_DIR,
+    BackupType,
+    BaseConfig,
+    DestinationLockedError,
+    InvalidPathError,
+    ScriptFailedError,
+    Source,
+    get_tar_create_command,
+    get_tar_extract_command,
+    split_sources,
+)
+from pisync.config.filters import make_filter_set
+from pisync.config.probe import choose_rsync_arguments, get_capabilities, local_capabilities
+from pisync.config.resources import ResourcePolicy
+from pisync.config.runner import CommandRunner, FabricRunner
 from pisync.util import get_time_stamp
 
+STREAM_BUFFER_SIZE = 1 << 20
+# how long an idle ssh master connection is kept open for the next rsync run,
+# runs on an hourly or daily schedule each open a new one
+SSH_CONTROL_PERSIST = "10m"
+# exit codes of `flock -n` when the lock is held and of the shell when flock is not installed
+FLOCK_CONFLICT = 1
+COMMAND_NOT_FOUND = 127
+
+
+class _Connection(Connection):
+    """
+    A fabric `Connection` that several threads can use at once, e.g. the jobs
+    of configs for the same host. fabric opens it on first use and two threads
+    opening it at the same time would both connect.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        # a plain attribute would become a config key of invoke
+        self._set(_open_lock=threading.RLock())
+
+    def open(self) -> Any:
+        with self._open_lock:
+            return super().open()
+
 
 class RemoteConfig(BaseConfig):
     def __init__(
         self,
         user_at_hostname: str,
-        source_dir: str,
+        source_dir: Union[str, Sequence[Source]],
         destination_dir: str,
         exclude_file_patterns: Optional[List[str]] = None,
         log_file: Optional[str] = None,
+        *,
+        exclude_caches: bool = False,
+        ignore_file_name: Optional[str] = None,
+        seed: bool = False,
+        seed_compression: Optional[str] = None,
+        probe_rsync: bool = False,
+        preserve_acls_xattrs: bool = False,
+        chunk_threshold: Optional[int] = None,
+        resources: Optional[ResourcePolicy] = None,
+        ssh_control_path: Optional[str] = None,
+        runner: Optional[CommandRunner] = None,
+        check_paths: bool = True,
     ):
         self.user_at_hostname = user_at_hostname
-        self.connection: Connection = Connection(user_at_hostname)
-        self._ensure_dir_exists_locally(source_dir)
-        self.ensure_dir_exists(destination_dir)
-        self.source_dir = source_dir
+        self.connection: Connection = _Connection(user_at_hostname)
+        self._runner = runner
+        self.source_dir, self.sources = split_sources(source_dir)
         self.destination_dir = destination_dir
         self.exclude_file_patterns = exclude_file_patterns
+        self.filters = make_filter_set(
+            self.source_dir,
+            self.sources,
+            exclude_file_patterns,
+            exclude_caches=exclude_caches,
+            ignore_file_name=ignore_file_name,
+        )
         if log_file is None:
             self.log_file = str(Path.home() / ".local/share/backup/rsync-backups.log")
         else:
             self.log_file = log_file
+        self.seed = seed
+        self.seed_compression = seed_compression
+        self.probe_rsync = probe_rsync
+        self.preserve_acls_xattrs = preserve_acls_xattrs
+        self.chunk_threshold = chunk_threshold
+        self.resources = resources
+        self.ssh_control_path = ssh_control_path
         self.link_dir = f"{self.destination_dir}/latest"
         self._optionless_rsync_arguments = [
             "--delete",  # delete extraneous files from dest dirs
             "--archive",  # archive mode is -rlptgoD (no -A,-X,-U,-N,-H)
             # NOTE: these options are linux specific and do not work on the
-            # macOS version of rsync.
+            # macOS version of rsync. They are added by `probe_rsync=True`
+            # and `preserve_acls_xattrs=True` when both sides support them.
             # "--acls",       # preserve ACLs (implies --perms)
             # "--xattrs",     # preserve extended attributes
             "--verbose",  # increase verbosity
             "--info=stats3",
         ]
+        self._paths_checked = False
+        if check_paths:
+            self.check_paths()
+
+    @property
+    def runner(self) -> CommandRunner:
+        """Runs the commands on the remote machine, over `connection` by default"""
+        return FabricRunner(self.connection) if self._runner is None else self._runner
+
+    def check_paths(self) -> None:
+        if not self._paths_checked:
+            for source_path in self.source_paths():
+                self._ensure_dir_exists_locally(source_path)
+            self.ensure_dir_exists(self.destination_dir)
+            self._paths_checked = True
 
     def _ensure_dir_exists_locally(self, path: str):
         _path = Path(path)
@@ -48,47 +136,78 @@ class RemoteConfig(BaseConfig):
             msg = f"{_path} is not a directory"
             raise InvalidPathError(msg)
 
+    @contextlib.contextmanager
+    def lock_destination(self) -> Iterator[None]:
+        """
+        flock holds the lock for as long as the command runs, which is until
+        its stdin is closed. It is released too if the connection drops.
+        """
+        state_dir = f"{self.destination_dir}/{STATE_DIR}"
+        lock_file = shlex.quote(f"{state_dir}/{LOCK_FILE}")
+        command = f"mkdir -p {shlex.quote(state_dir)} && exec flock -n {lock_file} sh -c 'echo locked && exec cat'"
+        with self.runner.start(command) as stream:
+            output = b""
+            while not output.endswith(b"\n"):
+                data = stream.read(64)
+                if not data:
+                    break
+                output += data
+            if output == b"locked\n":
+                try:
+                    yield
+                finally:
+                    stream.close_stdin()
+                    stream.wait()
+                return
+            exit_code = stream.wait()
+            if exit_code == FLOCK_CONFLICT and not stream.stderr():
+                msg = f"Another backup to {self.user_at_hostname}:{self.destination_dir} is running"
+                raise DestinationLockedError(msg)
+            if exit_code != COMMAND_NOT_FOUND:
+                msg = f"Locking {self.destination_dir} failed with exit code {exit_code}: {stream.stderr()}"
+                raise ScriptFailedError(msg)
+        logging.warning(f"flock is not installed on {self.user_at_hostname}, {self.destination_dir} is not locked")
+        yield
+
     def is_symlink(self, path: str) -> bool:
         """returns true if path is a symbolic link"""
-        return self.connection.run(f"test -L {path}", warn=True).ok
+        return self.runner.run(f"test -L {path}", warn=True).ok
 
     def is_empty_directory(self, path: str) -> bool:
         """returns true if path is a directory and contains no files"""
-        return self.connection.run(f'test -z "$(ls -A {path})"', warn=True).ok
+        return self.runner.run(f'test -z "$(ls -A {path} | grep -v -x -F {STATE_DIR})"', warn=True).ok
 
     def file_exists(self, path: str) -> bool:
         """returns true if the file or directory exists"""
-        return (
-            self.connection.run(f"test -d {path}", warn=True).ok or self.connection.run(f"test -f {path}", warn=True).ok
-        )
+        return self.runner.run(f"test -e {path}", warn=True).ok
 
     def unlink(self, path: str) -> None:
         """Remove this file or symbolic link."""
-        result = self.connection.run(f"rm {path}", warn=True)
+        result = self.runner.run(f"rm {path}", warn=True)
         if not result.ok:
             msg = f"Failed to remove {path}"
             raise FileNotFoundError(msg)
 
     def rmtree(self, path: str) -> None:
         """Recursively delete directory tree"""
-        return self.connection.run(f"rm -r {path}").ok
+        return self.runner.run(f"rm -r {path}").ok
 
     def symlink_to(self, symlink: str, file: str) -> None:
         """Make symlink a symbolic link to file."""
-        return self.connection.run(f"ln -s {file} {symlink}", warn=True).ok
+        return self.runner.run(f"ln -s {file} {symlink}", warn=True).ok
 
     def resolve(self, path: str) -> str:
         """Make the path absolute, resolving any symlinks."""
-        return self.connection.run(f"realpath {path}", warn=True).stdout.rstrip()
+        return self.runner.run(f"realpath {path}", warn=True).stdout.rstrip()
 
     def ensure_dir_exists(self, path: str) -> None:
-        result = self.connection.run(f"test -d {path}", warn=True)
+        result = self.runner.run(f"test -d {path}", warn=True)
         if not result.ok:
             msg = f"{path} is not a directory"
             raise InvalidPathError(msg)
 
     def _is_directory(self, path) -> bool:
-        return self.connection.run(f"test -d {path}", warn=True).ok
+        return self.runner.run(f"test -d {path}", warn=True).ok
 
     def generate_new_backup_dir_path(self) -> str:
         """
@@ -106,17 +225,149 @@ class RemoteConfig(BaseConfig):
         else:
             return str(new_backup_dir)
 
+    def run_script(self, script: str, args: List[str]) -> Iterator[str]:
+        """Run a python script with args using python3 on the remote machine"""
+        command = " ".join(shlex.quote(arg) for arg in ["python3", "-c", script, *args])
+        lines: queue.Queue[object] = queue.Queue()
+        out_stream = _LineWriter(lines)
+
+        def run():
+            try:
+                result = self.runner.run(command, warn=True, hide="err", out_stream=out_stream)
+            except Exception as e:  # re-raised in the calling thread
+                lines.put(e)
+                return
+            # the output may not end with a newline
+            out_stream.close()
+            lines.put(result)
+
+        threading.Thread(target=run, daemon=True).start()
+        while True:
+            item = lines.get()
+            if isinstance(item, str):
+                yield item
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                if not item.ok:  # type: ignore[attr-defined]
+                    msg = f"Script failed with exit code {item.exited}: {item.stderr}"  # type: ignore[attr-defined]
+                    raise ScriptFailedError(msg)
+                return
+
+    def read_tar(self, directory: str, paths: List[str], out: IO[bytes], *, recursive: bool = True) -> None:
+        """Stream a tar archive over a new channel of the existing ssh connection"""
+        command = " ".join(shlex.quote(arg) for arg in get_tar_create_command(directory, recursive=recursive))
+        file_list = b"".join(os.fsencode(path) + b"\0" for path in paths)
+        errors: List[Exception] = []
+        with self.runner.start(command) as stream:
+
+            def send_paths():
+                try:
+                    stream.write(file_list)
+                    stream.close_stdin()
+                except Exception as e:  # re-raised in the calling thread
+                    errors.append(e)
+
+            # tar writes the archive while it reads the paths, sending all of
+            # them before reading would block both sides once the window is full
+            sender = threading.Thread(target=send_paths, daemon=True)
+            sender.start()
+            for data in iter(lambda: stream.read(STREAM_BUFFER_SIZE), b""):
+                out.write(data)
+            sender.join()
+            if errors:
+                raise errors[0]
+            exit_status = stream.wait()
+            if exit_status != 0:
+                msg = f"tar failed with exit code {exit_status}: {stream.stderr()}"
+                raise ScriptFailedError(msg)
+
+    def write_tar(self, directory: str, archive: IO[bytes], *, compression: Optional[str] = None) -> None:
+        """Stream a tar archive over a new channel of the existing ssh connection"""
+        extract = " ".join(shlex.quote(arg) for arg in get_tar_extract_command(directory, compression))
+        with self.runner.start(f"mkdir -p {shlex.quote(directory)} && {extract}") as stream:
+            for data in iter(lambda: archive.read(STREAM_BUFFER_SIZE), b""):
+                stream.write(data)
+            stream.close_stdin()
+            exit_status = stream.wait()
+            if exit_status != 0:
+                msg = f"tar failed with exit code {exit_status}: {stream.stderr()}"
+                raise ScriptFailedError(msg)
+
     def get_rsync_command(self, new_backup_dir: str, backup_method: BackupType) -> List[str]:
         destination = f"{self.user_at_hostname}:{new_backup_dir}"
-        source = self.source_dir
         link_dest = self.link_dir
         option_arguments = []
 
         if backup_method == BackupType.Incremental:
             option_arguments.append(f"--link-dest={link_dest}")
+        elif backup_method == BackupType.Seeded:
+            # the seed keeps excluded paths with a newline or backslash, and
+            # rsync applies the rules of ignore files more exactly than the seed
+            option_arguments.append("--delete-excluded")
+
+        if self.ssh_control_path is not None:
+            # reuse one ssh master connection across rsync runs
+            option_arguments.append(
+                f"--rsh=ssh -o ControlMaster=auto -o ControlPath={self.ssh_control_path} "
+                f"-o ControlPersist={SSH_CONTROL_PERSIST}"
+            )
+
+        if self.chunk_threshold is not None:
+            # larger files are stored in the chunk store after rsync
+            option_arguments.append(f"--max-size={self.chunk_threshold}")
+
+        if self.resources is not None:
+            option_arguments.extend(self.resources.rsync_arguments(remote=True))
+
+        if self.probe_rsync:
+            option_arguments.extend(self._probed_rsync_arguments())
+
+        option_arguments.extend(self.filters.rsync_arguments())
+
+        prefix = [] if self.resources is None else self.resources.local_command_prefix()
+        return [
+            *prefix,
+            "rsync",
+            *self._optionless_rsync_arguments,
+            *option_arguments,
+            *self.rsync_source_arguments(),
+            destination,
+        ]
+
+    def _probed_rsync_arguments(self) -> List[str]:
+        local = local_capabilities()
+        remote = get_capabilities(self.user_at_hostname, self._remote_rsync_version)
+        if local is None or remote is None:
+            return []
+        return choose_rsync_arguments(local, remote, preserve_acls_xattrs=self.preserve_acls_xattrs)
+
+    def _remote_rsync_version(self) -> Optional[str]:
+        result = self.runner.run("rsync --version", hide=True, warn=True)
+        return result.stdout if result.ok else None
+
+
+class _LineWriter:
+    """
+    File-like object that puts each complete line written to it in a queue.
+    invoke flushes after every read from the channel, which can end in the
+    middle of a line, so only `close` puts the rest of the buffer.
+    """
+
+    def __init__(self, lines: "queue.Queue[object]"):
+        self.lines = lines
+        self.buffer = ""
+
+    def write(self, data: str) -> None:
+        self.buffer += data
+        *complete, self.buffer = self.buffer.split("\n")
+        for line in complete:
+            self.lines.put(line)
 
-        if self.exclude_file_patterns is not None:
-            for pattern in self.exclude_file_patterns:
-                option_arguments.append(f"--exclude={pattern}")
+    def flush(self) -> None:
+        pass
 
-        return ["rsync", *self._optionless_rsync_arguments, *option_arguments, source, destination]
+    def close(self) -> None:
+        if self.buffer:
+            self.lines.put(self.buffer)
+            self.buffer = ""
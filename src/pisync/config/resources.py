@@ -0,0 +1,190 @@
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+NICE_RANGE = range(-20, 20)
+IONICE_LEVELS = range(8)
+MINUTES_PER_HOUR = 60
+MINUTES_PER_DAY = 24 * MINUTES_PER_HOUR
+# an rsync --bwlimit rate: KiB per second, or a number with a suffix like 5m or 1.5GB
+RSYNC_RATE = re.compile(r"(\d+(?:\.\d*)?)(?:([kmgtp])(i?b)?)?", re.IGNORECASE)
+RATE_SUFFIXES = "kmgtp"
+# moves the shell into the cgroup given as $0 if it can, then replaces it with
+# the command. rsync runs either way, a failed move is only reported on stderr.
+CGROUP_WRAPPER = (
+    '{ echo $$ > "$0/cgroup.procs"; } 2>/dev/null'
+    ' || echo "Could not move rsync into cgroup $0, running it without" >&2; exec "$@"'
+)
+
+
+class ResourcePolicy:
+    """
+    Limits how much a backup competes with other work on the same machines.
+
+    `nice` and `ionice_class`/`ionice_level` apply to the local rsync and,
+    through `--rsync-path`, to the rsync on the remote machine. With `cgroup`
+    (a directory in the cgroup v2 hierarchy, e.g. `/sys/fs/cgroup/pisync`) the
+    local rsync runs in that cgroup with the optional `io_max` (e.g.
+    `"8:0 rbps=52428800"`) and `cpu_max` (e.g. `"50000 100000"`) limits.
+    `bwlimit_schedule` maps time ranges to an rsync `--bwlimit`, e.g.
+    `{"08:00-18:00": "5m", "18:00-23:00": "20m"}`; the range that contains the
+    start of the backup is used.
+    """
+
+    def __init__(
+        self,
+        *,
+        nice: Optional[int] = None,
+        ionice_class: Optional[str] = None,
+        ionice_level: Optional[int] = None,
+        cgroup: Optional[str] = None,
+        io_max: Optional[str] = None,
+        cpu_max: Optional[str] = None,
+        bwlimit_schedule: Optional[Dict[str, str]] = None,
+    ):
+        if nice is not None and nice not in NICE_RANGE:
+            msg = f"nice must be between {NICE_RANGE.start} and {NICE_RANGE.stop - 1}, not {nice}"
+            raise ValueError(msg)
+        if ionice_class is not None and ionice_class not in IONICE_CLASSES:
+            msg = f"ionice_class must be one of {sorted(IONICE_CLASSES)}, not {ionice_class!r}"
+            raise ValueError(msg)
+        if ionice_level is not None and ionice_level not in IONICE_LEVELS:
+            msg = f"ionice_level must be between 0 and {IONICE_LEVELS.stop - 1}, not {ionice_level}"
+            raise ValueError(msg)
+        if cgroup is None and (io_max is not None or cpu_max is not None):
+            msg = "io_max and cpu_max need a cgroup"
+            raise ValueError(msg)
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.cgroup = cgroup
+        self.io_max = io_max
+        self.cpu_max = cpu_max
+        self.bwlimit_schedule = bwlimit_schedule or {}
+        self._bwlimits = [(*_parse_time_range(time_range), rate) for time_range, rate in self.bwlimit_schedule.items()]
+        for rate in self.bwlimit_schedule.values():
+            rate_in_kib(rate)
+
+    def __repr__(self) -> str:
+        options = {name: value for name, value in vars(self).items() if not name.startswith("_") and value}
+        return f"ResourcePolicy({', '.join(f'{name}={value!r}' for name, value in options.items())})"
+
+    def priority_command(self) -> List[str]:
+        """:returns: The nice and ionice command to prefix rsync with"""
+        command = []
+        if self.nice is not None:
+            command.extend(["nice", "-n", str(self.nice)])
+        if self.ionice_class is not None or self.ionice_level is not None:
+            command.append("ionice")
+            if self.ionice_class is not None:
+                command.extend(["-c", IONICE_CLASSES[self.ionice_class]])
+            if self.ionice_level is not None:
+                command.extend(["-n", str(self.ionice_level)])
+        return command
+
+    def local_command_prefix(self) -> List[str]:
+        """
+        :returns: The command to prefix the local rsync with. The cgroup is
+        set up by `prepare_cgroup` when the backup starts, not here.
+        """
+        prefix = [] if self.cgroup is None else ["sh", "-c", CGROUP_WRAPPER, self.cgroup]
+        return [*prefix, *self.priority_command()]
+
+    def rsync_arguments(
+        self, *, remote: bool, now: Optional[datetime] = None, bwlimit: Optional[int] = None
+    ) -> List[str]:
+        """
+        :returns: The rsync options for a backup starting at `now`, with
+        `--rsync-path` if `remote`. rsync only uses the last `--bwlimit`, so a
+        `bwlimit` of the config in KiB per second is combined with the rate of
+        the schedule into a single one with the lower of both.
+        """
+        arguments = []
+        rate = self.bwlimit_at(datetime.now().astimezone() if now is None else now)
+        if bwlimit is not None and (rate is None or bwlimit < rate_in_kib(rate)):
+            rate = str(bwlimit)
+        if rate is not None:
+            arguments.append(f"--bwlimit={rate}")
+        priority_command = self.priority_command()
+        if remote and priority_command:
+            arguments.append(f"--rsync-path={' '.join(priority_command)} rsync")
+        return arguments
+
+    def bwlimit_at(self, when: datetime) -> Optional[str]:
+        minute = when.hour * MINUTES_PER_HOUR + when.minute
+        for start, end, rate in self._bwlimits:
+            in_range = start <= minute < end if start < end else minute >= start or minute < end
+            if in_range:
+                return rate
+        return None
+
+    def prepare_cgroup(self) -> bool:
+        """
+        Create the cgroup and write its limits. A backup is more important than
+        its limits, so failures are logged and the backup runs without them.
+
+        :returns: Whether the cgroup was set up
+        """
+        cgroup = str(self.cgroup)
+        limits = {"io.max": self.io_max, "cpu.max": self.cpu_max}
+        try:
+            os.makedirs(cgroup, exist_ok=True)
+            _enable_controllers(cgroup, [name.split(".")[0] for name, value in limits.items() if value is not None])
+            for name, value in limits.items():
+                if value is not None:
+                    with open(os.path.join(cgroup, name), "w") as f:
+                        f.write(value)
+        except OSError as e:
+            logging.warning(f"Could not set up cgroup {cgroup}, running rsync without it: {e}")
+            return False
+        return True
+
+
+def _enable_controllers(cgroup: str, controllers: List[str]) -> None:
+    """Enable controllers for the cgroup in its parent if they are not available yet"""
+    with open(os.path.join(cgroup, "cgroup.controllers")) as f:
+        available = f.read().split()
+    missing = [controller for controller in controllers if controller not in available]
+    if missing:
+        with open(os.path.join(os.path.dirname(cgroup.rstrip("/")), "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(f"+{controller}" for controller in missing))
+
+
+def rate_in_kib(rate: str) -> float:
+    """
+    :returns: An rsync `--bwlimit` rate in KiB per second
+    :raises:
+        ValueError: If rate is not a valid rsync rate
+    """
+    match = RSYNC_RATE.fullmatch(rate.strip())
+    if match is None:
+        msg = f"Invalid bandwidth limit {rate!r}, expected KiB per second or a number like 5m"
+        raise ValueError(msg)
+    number, suffix, unit = match.groups()
+    if suffix is None:
+        return float(number)
+    # like rsync, "KB" is 1000 bytes and "K" or "KiB" 1024
+    base = 1000 if unit is not None and unit.lower() == "b" else 1024
+    return float(number) * base ** (RATE_SUFFIXES.index(suffix.lower()) + 1) / 1024
+
+
+def _parse_time_range(time_range: str) -> Tuple[int, int]:
+    """:returns: The start and end of a "HH:MM-HH:MM" range in minutes since midnight"""
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*", time_range)
+    if match is None:
+        msg = f"Invalid time range {time_range!r}, expected HH:MM-HH:MM"
+        raise ValueError(msg)
+    start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+    start, end = start_hour * MINUTES_PER_HOUR + start_minute, end_hour * MINUTES_PER_HOUR + end_minute
+    if (
+        max(start_minute, end_minute) >= MINUTES_PER_HOUR
+        or start > MINUTES_PER_DAY
+        or end > MINUTES_PER_DAY
+        or start == end
+    ):
+        msg = f"Invalid time range {time_range!r}"
+        raise ValueError(msg)
+    return start, end
@@ -0,0 +1,137 @@
+from abc import ABC, abstractmethod
+from types import TracebackType
+from typing import Any, NamedTuple, Optional, TextIO, Type, Union
+
+
+class CommandResult(NamedTuple):
+    stdout: str
+    stderr: str
+    exited: int
+
+    @property
+    def ok(self) -> bool:
+        return self.exited == 0
+
+
+class CommandStream(ABC):
+    """
+    A command started by `CommandRunner.start` whose stdin and stdout are
+    streamed as bytes while it runs. Closing the stream stops the command if
+    it is still running.
+    """
+
+    @abstractmethod
+    def write(self, data: bytes) -> None:
+        """Write all of data to the stdin of the command"""
+
+    @abstractmethod
+    def close_stdin(self) -> None:
+        """Signal the end of stdin to the command"""
+
+    @abstractmethod
+    def read(self, size: int) -> bytes:
+        """:returns: Up to size bytes of stdout, or b"" once the command closed it"""
+
+    @abstractmethod
+    def wait(self) -> int:
+        """:returns: The exit code of the command once it exited"""
+
+    @abstractmethod
+    def stderr(self) -> str:
+        """:returns: What the command wrote to stderr, call after `wait`"""
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "CommandStream":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+class CommandRunner(ABC):
+    """
+    Runs shell commands on the remote machine of a `RemoteConfig`.
+
+    The result must have the `ok`, `stdout`, `stderr` and `exited` attributes
+    of a `CommandResult` (or a fabric `Result`). Every call is one round trip
+    to the remote machine, and so is every stream opened with `start`.
+    """
+
+    @abstractmethod
+    def run(
+        self,
+        command: str,
+        *,
+        warn: bool = False,
+        hide: Union[bool, str, None] = None,
+        out_stream: Optional[TextIO] = None,
+    ) -> Any:
+        """
+        Run `command` and write its stdout to `out_stream` as it arrives, if
+        given. `hide` is "out", "err" or True to not echo the output.
+
+        :raises: An exception if the command fails unless `warn` is True
+        """
+
+    @abstractmethod
+    def start(self, command: str) -> CommandStream:
+        """Start `command` and return a stream of its stdin and stdout, e.g. for a tar archive"""
+
+
+class FabricRunner(CommandRunner):
+    """Run commands over the ssh connection of a fabric `Connection`"""
+
+    def __init__(self, connection: Any):
+        self.connection = connection
+
+    def run(
+        self,
+        command: str,
+        *,
+        warn: bool = False,
+        hide: Union[bool, str, None] = None,
+        out_stream: Optional[TextIO] = None,
+    ) -> Any:
+        return self.connection.run(command, warn=warn, hide=hide, out_stream=out_stream)
+
+    def start(self, command: str) -> CommandStream:
+        channel = self.connection.create_session()
+        try:
+            channel.exec_command(command)
+        except Exception:
+            channel.close()
+            raise
+        return ChannelStream(channel)
+
+
+class ChannelStream(CommandStream):
+    """A command running on its own channel of an ssh connection"""
+
+    def __init__(self, channel: Any):
+        self.channel = channel
+
+    def write(self, data: bytes) -> None:
+        self.channel.sendall(data)
+
+    def close_stdin(self) -> None:
+        self.channel.shutdown_write()
+
+    def read(self, size: int) -> bytes:
+        return self.channel.recv(size)
+
+    def wait(self) -> int:
+        return self.channel.recv_exit_status()
+
+    def stderr(self) -> str:
+        return self.channel.makefile_stderr("rb").read().decode(errors="replace")
+
+    def close(self) -> None:
+        self.channel.close()
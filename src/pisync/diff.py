@@ -0,0 +1,35 @@
+from typing import Iterator, Tuple
+
+from pisync.config.base_config import BaseConfig
+from pisync.jobs import diff as diff_job
+from pisync.jobs import run_job
+
+DIFF_STATUS = {
+    diff_job.ADDED: "added",
+    diff_job.REMOVED: "removed",
+    diff_job.MODIFIED: "modified",
+    diff_job.UNCHANGED: "unchanged",
+}
+
+
+def diff_snapshots(
+    config: BaseConfig, old: str, new: str = "latest", *, include_unchanged: bool = False
+) -> Iterator[Tuple[str, str]]:
+    """
+    Compare two snapshots in `config.destination_dir` by inode without
+    reading any file contents. For a `RemoteConfig` the comparison runs on the
+    remote machine and the results are streamed back. Large files in the
+    chunk store are compared by their chunks and come last.
+
+    :param old: Name of the older snapshot directory, e.g. 2023-07-14-17-24-23
+    :param new: Name of the newer snapshot directory
+    :returns: (status, path) where status is added, removed, modified or
+    unchanged and path is relative to the snapshot directories
+    :raises:
+        ScriptFailedError: If either snapshot does not exist
+    """
+    args = [config.destination_dir, old, new]
+    if include_unchanged:
+        args.append("--unchanged")
+    for status, path in run_job(config, diff_job, args):
+        yield DIFF_STATUS[status], path
@@ -0,0 +1,26 @@
+"""
+Jobs are standalone scripts that run on the machine holding the snapshots,
+which is the remote machine for a `RemoteConfig`. They only use the standard
+library and write one JSON object per line to stdout.
+"""
+
+import inspect
+import json
+from types import ModuleType
+from typing import Any, Iterator, List
+
+from pisync.config.base_config import BaseConfig
+
+
+def run_job(config: BaseConfig, job: ModuleType, args: List[str]) -> Iterator[Any]:
+    """
+    Run the job module with `args` where `config.destination_dir` lives
+
+    :returns: The decoded JSON values the job writes, one per line, as they arrive
+    :raises:
+        ScriptFailedError: If the job exits with a non zero exit code
+    """
+    script = inspect.getsource(job)
+    for line in config.run_script(script, args):
+        if line:
+            yield json.loads(line)
@@ -0,0 +1,186 @@
+"""
+Store chunks of large files next to pisync snapshots and put the files back
+together.
+
+Chunks are stored once by their sha256 digest in `.pisync/chunks/` and every
+snapshot has a manifest in `.pisync/manifests/` listing the chunks of its large
+files. New chunks and the manifest are first streamed to
+`.pisync/incoming/<snapshot>/` and only moved into the store once their digests
+are checked, so an interrupted transfer never leaves a corrupt chunk behind.
+
+This script runs on the machine holding the snapshots and must only use the
+standard library.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from typing import Dict, Iterator, List, Optional, Set
+
+SNAPSHOT_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$")
+STATE_DIR = ".pisync"
+CHUNK_DIR = "chunks"
+MANIFEST_DIR = "manifests"
+INCOMING_DIR = "incoming"
+MANIFEST_FILE = "manifest.json"
+
+
+def chunk_path(destination: str, digest: str) -> str:
+    return os.path.join(destination, STATE_DIR, CHUNK_DIR, digest[:2], digest)
+
+
+def manifest_path(destination: str, snapshot: str) -> str:
+    return os.path.join(destination, STATE_DIR, MANIFEST_DIR, f"{snapshot}.json")
+
+
+def incoming_path(destination: str, snapshot: str) -> str:
+    return os.path.join(destination, STATE_DIR, INCOMING_DIR, snapshot)
+
+
+def read_manifest(path: str) -> Dict[str, Dict]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def missing_chunks(destination: str, snapshot: str) -> Iterator[Dict]:
+    """:returns: The chunks in the incoming manifest of `snapshot` that are not stored yet"""
+    manifest = read_manifest(os.path.join(incoming_path(destination, snapshot), MANIFEST_FILE))
+    seen: Set[str] = set()
+    for entry in manifest.values():
+        for digest, _ in entry["chunks"]:
+            if digest not in seen and not os.path.exists(chunk_path(destination, digest)):
+                yield {"event": "missing", "digest": digest}
+            seen.add(digest)
+
+
+def commit(destination: str, snapshot: str) -> Iterator[Dict]:
+    """
+    Move the received chunks of `snapshot` into the store after checking their
+    digests, install its manifest and delete chunks that no manifest of an
+    existing snapshot references anymore.
+    """
+    incoming = incoming_path(destination, snapshot)
+    received = os.path.join(incoming, CHUNK_DIR)
+    stored_chunks, stored_bytes = 0, 0
+    if os.path.isdir(received):
+        for entry in os.scandir(received):
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != entry.name:
+                yield {"event": "error", "error": f"chunk {entry.name} is corrupt"}
+                continue
+            path = chunk_path(destination, entry.name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(entry.path, path)
+            stored_chunks += 1
+            stored_bytes += len(data)
+
+    manifest = read_manifest(os.path.join(incoming, MANIFEST_FILE))
+    for relative_path, file_entry in manifest.items():
+        for digest, _ in file_entry["chunks"]:
+            if not os.path.exists(chunk_path(destination, digest)):
+                yield {"event": "error", "error": f"chunk {digest} of {relative_path} is missing"}
+                return
+    path = manifest_path(destination, snapshot)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(os.path.join(incoming, MANIFEST_FILE), path)
+    shutil.rmtree(incoming)
+
+    summary = collect_garbage(destination)
+    summary.update({"stored_chunks": stored_chunks, "stored_bytes": stored_bytes})
+    yield summary
+
+
+def collect_garbage(destination: str) -> Dict:
+    """
+    Delete the manifests of deleted snapshots and the chunks no manifest
+    references.
+
+    :returns: A summary with the size of the store and of the files in it
+    """
+    snapshots = {entry.name for entry in os.scandir(destination) if SNAPSHOT_NAME.match(entry.name)}
+    manifests = os.path.join(destination, STATE_DIR, MANIFEST_DIR)
+    referenced: Set[str] = set()
+    logical_bytes = 0
+    if os.path.isdir(manifests):
+        for entry in os.scandir(manifests):
+            snapshot = entry.name[: -len(".json")]
+            if snapshot not in snapshots:
+                os.unlink(entry.path)
+                continue
+            for file_entry in read_manifest(entry.path).values():
+                logical_bytes += file_entry["size"]
+                referenced.update(digest for digest, _ in file_entry["chunks"])
+
+    removed_chunks, removed_bytes, store_chunks, store_bytes = 0, 0, 0, 0
+    chunks = os.path.join(destination, STATE_DIR, CHUNK_DIR)
+    if os.path.isdir(chunks):
+        for directory in os.scandir(chunks):
+            for entry in os.scandir(directory.path):
+                size = entry.stat().st_size
+                if entry.name in referenced:
+                    store_chunks += 1
+                    store_bytes += size
+                else:
+                    os.unlink(entry.path)
+                    removed_chunks += 1
+                    removed_bytes += size
+    return {
+        "event": "summary",
+        "store_chunks": store_chunks,
+        "store_bytes": store_bytes,
+        "logical_bytes": logical_bytes,
+        "removed_chunks": removed_chunks,
+        "removed_bytes": removed_bytes,
+    }
+
+
+def assemble(destination: str, snapshot: str, paths: Optional[List[str]] = None) -> Iterator[Dict]:
+    """Write the files in the manifest of `snapshot` (default: all of them) into the snapshot"""
+    manifest = read_manifest(manifest_path(destination, snapshot))
+    for relative_path in paths or sorted(manifest):
+        entry = manifest.get(relative_path)
+        if entry is None:
+            yield {"event": "error", "path": relative_path, "error": "not in the manifest"}
+            continue
+        path = os.path.join(destination, snapshot, relative_path)
+        if os.path.isfile(path) and os.path.getsize(path) == entry["size"]:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.pisync.tmp"
+        with open(tmp_path, "wb") as out:
+            for digest, _ in entry["chunks"]:
+                with open(chunk_path(destination, digest), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.chmod(tmp_path, entry["mode"])
+        os.utime(tmp_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        os.replace(tmp_path, path)
+        yield {"event": "file", "path": relative_path, "size": entry["size"]}
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["missing", "commit", "assemble", "gc"])
+    parser.add_argument("destination")
+    parser.add_argument("snapshot", nargs="?")
+    parser.add_argument("--path", action="append", default=[])
+    args = parser.parse_args(argv)
+
+    if args.command == "missing":
+        events = missing_chunks(args.destination, args.snapshot)
+    elif args.command == "commit":
+        events = commit(args.destination, args.snapshot)
+    elif args.command == "assemble":
+        events = assemble(args.destination, args.snapshot, args.path)
+    else:
+        events = iter([collect_garbage(args.destination)])
+    for event in events:
+        sys.stdout.write(json.dumps(event) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Compare two pisync snapshots using only directory entries.
+
+Snapshots made with `--link-dest` hardlink unchanged files to the previous
+snapshot, so a file is unchanged exactly when both snapshots point to the same
+inode. The inode number comes from the directory entry, so no file is read
+or even stat'ed. Large files in the chunk store that were not assembled into
+a snapshot are compared by the chunks in the manifests of the snapshots, and
+reported after the other entries.
+
+Prints one compact JSON array per line: [status, path] where status is one of
+A (added), R (removed), M (modified) or U (unchanged).
+
+This script runs on the machine holding the snapshots and must only use the
+standard library.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+ADDED = "A"
+REMOVED = "R"
+MODIFIED = "M"
+UNCHANGED = "U"
+STATE_DIR = ".pisync"
+MANIFEST_DIR = "manifests"
+
+
+def _scan(directory: str) -> Dict[str, os.DirEntry]:
+    # a directory below the roots may be removed while the snapshot is pruned
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name: entry for entry in entries}
+    except FileNotFoundError:
+        return {}
+
+
+def _subtree(status: str, entry: os.DirEntry, path: str) -> Iterator[Tuple[str, str]]:
+    yield status, path
+    if entry.is_dir(follow_symlinks=False):
+        for name, child in sorted(_scan(entry.path).items()):
+            yield from _subtree(status, child, f"{path}/{name}")
+
+
+def chunked_files(root: str) -> Dict[str, Dict]:
+    """:returns: The manifest entries of the snapshot at root whose files were not assembled into it"""
+    destination, snapshot = os.path.split(os.path.realpath(root))
+    try:
+        with open(os.path.join(destination, STATE_DIR, MANIFEST_DIR, f"{snapshot}.json")) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {path: entry for path, entry in manifest.items() if not os.path.lexists(os.path.join(root, path))}
+
+
+def diff_chunked_files(old_root: str, new_root: str, *, include_unchanged: bool = False) -> Iterator[Tuple[str, str]]:
+    """:returns: (status, path) of the chunked files of either snapshot, like `diff_trees`"""
+    old_files = chunked_files(old_root)
+    new_files = chunked_files(new_root)
+    for path in sorted(old_files.keys() | new_files.keys()):
+        old = old_files.get(path)
+        new = new_files.get(path)
+        if old is None:
+            yield ADDED, path
+        elif new is None:
+            yield REMOVED, path
+        elif old["chunks"] != new["chunks"]:
+            yield MODIFIED, path
+        elif include_unchanged:
+            yield UNCHANGED, path
+
+
+def diff_trees(old_root: str, new_root: str, *, include_unchanged: bool = False) -> Iterator[Tuple[str, str]]:
+    """
+    Walk both trees in lockstep.
+
+    :returns: (status, path relative to the roots) for every entry that was
+    added, removed or modified, and for unchanged files if requested.
+    :raises:
+        NotADirectoryError: If either root is not a directory
+    """
+    for root in (old_root, new_root):
+        if not os.path.isdir(root):
+            msg = f"{root} is not a snapshot directory"
+            raise NotADirectoryError(msg)
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        old_entries = _scan(os.path.join(old_root, directory))
+        new_entries = _scan(os.path.join(new_root, directory))
+        subdirectories = []
+        for name in sorted(old_entries.keys() | new_entries.keys()):
+            path = f"{directory}/{name}" if directory else name
+            old = old_entries.get(name)
+            new = new_entries.get(name)
+            if old is None:
+                yield from _subtree(ADDED, new, path)  # type: ignore[arg-type]
+            elif new is None:
+                yield from _subtree(REMOVED, old, path)
+            else:
+                old_is_dir = old.is_dir(follow_symlinks=False)
+                new_is_dir = new.is_dir(follow_symlinks=False)
+                if old_is_dir and new_is_dir:
+                    subdirectories.append(path)
+                elif old_is_dir or new_is_dir:
+                    yield from _subtree(REMOVED, old, path)
+                    yield from _subtree(ADDED, new, path)
+                elif old.inode() != new.inode():
+                    yield MODIFIED, path
+                elif include_unchanged:
+                    yield UNCHANGED, path
+        # keep the output in sorted order
+        stack.extend(reversed(subdirectories))
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("destination")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--unchanged", action="store_true")
+    args = parser.parse_args(argv)
+
+    old_root = os.path.join(args.destination, args.old)
+    new_root = os.path.join(args.destination, args.new)
+    try:
+        for status, path in diff_trees(old_root, new_root, include_unchanged=args.unchanged):
+            sys.stdout.write(json.dumps([status, path], separators=(",", ":")) + "\n")
+        for status, path in diff_chunked_files(old_root, new_root, include_unchanged=args.unchanged):
+            sys.stdout.write(json.dumps([status, path], separators=(",", ":")) + "\n")
+    except NotADirectoryError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+"""
+Plan a parallel restore of a pisync snapshot.
+
+Splits the selected part of a snapshot into units of roughly equal size that
+can be streamed as separate tar archives. Directories larger than the unit
+size are split into batches of their children, and directories that are split
+or that contain a selected path are emitted as non recursive units so their
+metadata can be restored after their contents.
+
+Prints one JSON object per line: {"paths", "bytes", "files", "recursive"}, and
+{"chunked": [...]} with the selected large files that are in the chunk store
+and were not assembled into the snapshot, so they cannot be restored from it.
+
+This script runs on the machine holding the snapshots and must only use the
+standard library.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+STATE_DIR = ".pisync"
+MANIFEST_DIR = "manifests"
+
+
+class Node:
+    def __init__(self, path: str, *, is_dir: bool, size: int):
+        self.path = path
+        self.is_dir = is_dir
+        self.bytes = size
+        self.files = 0 if is_dir else 1
+        self.children: List[Node] = []
+
+
+def build_tree(root: str) -> Node:
+    """:returns: The tree under root with the total bytes and files of every directory"""
+    top = Node("", is_dir=True, size=0)
+    stack: List[Tuple[Node, str]] = [(top, root)]
+    directories = []
+    while stack:
+        node, directory = stack.pop()
+        directories.append(node)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                path = f"{node.path}/{entry.name}" if node.path else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                child = Node(path, is_dir=is_dir, size=0 if is_dir else entry.stat(follow_symlinks=False).st_size)
+                node.children.append(child)
+                if is_dir:
+                    stack.append((child, entry.path))
+    for node in reversed(directories):
+        for child in node.children:
+            node.bytes += child.bytes
+            node.files += child.files
+    return top
+
+
+def select(node: Node, patterns: List[str]) -> Iterator[Node]:
+    """:returns: The top-most nodes whose path matches one of the patterns"""
+    for child in node.children:
+        if any(fnmatch.fnmatchcase(child.path, pattern) for pattern in patterns):
+            yield child
+        elif child.is_dir:
+            yield from select(child, patterns)
+
+
+def split(node: Node, max_unit_bytes: int) -> Iterator[Tuple[List[Node], bool]]:
+    """
+    :returns: (nodes, recursive) units no larger than max_unit_bytes unless
+    they are a single file. The children of a split directory are grouped
+    into batches, so a huge flat directory becomes a few units and not one
+    per file.
+    """
+    if not node.is_dir or node.bytes <= max_unit_bytes or not node.children:
+        yield [node], True
+        return
+    yield [node], False
+    batch: List[Node] = []
+    batch_bytes = 0
+    for child in sorted(node.children, key=lambda c: c.path):
+        if child.is_dir and child.bytes > max_unit_bytes:
+            yield from split(child, max_unit_bytes)
+            continue
+        if batch and batch_bytes + child.bytes > max_unit_bytes:
+            yield batch, True
+            batch, batch_bytes = [], 0
+        batch.append(child)
+        batch_bytes += child.bytes
+    if batch:
+        yield batch, True
+
+
+def chunked_files(root: str, patterns: Optional[List[str]]) -> List[str]:
+    """:returns: The files in the manifest of the snapshot at root that match patterns and are not in it"""
+    destination, snapshot = os.path.split(os.path.realpath(root))
+    try:
+        with open(os.path.join(destination, STATE_DIR, MANIFEST_DIR, f"{snapshot}.json")) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return []
+    chunked = []
+    for path in sorted(manifest):
+        if os.path.lexists(os.path.join(root, path)):
+            continue
+        # a path is selected if it or one of its parents matches
+        parts = path.split("/")
+        prefixes = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if not patterns or any(fnmatch.fnmatchcase(p, pattern) for p in prefixes for pattern in patterns):
+            chunked.append(path)
+    return chunked
+
+
+def plan(root: str, patterns: Optional[List[str]], workers: int) -> Iterator[Dict]:
+    tree = build_tree(root)
+    selected = [tree] if not patterns else list(select(tree, patterns))
+    total_bytes = sum(node.bytes for node in selected)
+    max_unit_bytes = max(total_bytes // (workers * 4), 1)
+
+    # parents of the selection so that their metadata is restored too
+    ancestors = set()
+    for node in selected:
+        parts = node.path.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            ancestors.add("/".join(parts[:i]))
+    for path in sorted(ancestors):
+        yield {"paths": [path], "bytes": 0, "files": 0, "recursive": False}
+
+    for node in selected:
+        for nodes, recursive in split(node, max_unit_bytes):
+            yield {
+                "paths": [unit.path or "." for unit in nodes],
+                "bytes": sum(unit.bytes for unit in nodes) if recursive else 0,
+                "files": sum(unit.files for unit in nodes) if recursive else 0,
+                "recursive": recursive,
+            }
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root")
+    parser.add_argument("--pattern", action="append", default=[])
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    for unit in plan(args.root, args.pattern, args.workers):
+        sys.stdout.write(json.dumps(unit) + "\n")
+    chunked = chunked_files(args.root, args.pattern)
+    if chunked:
+        sys.stdout.write(json.dumps({"chunked": chunked}) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
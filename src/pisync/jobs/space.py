@@ -0,0 +1,173 @@
+"""
+Account for the disk space used by each pisync snapshot.
+
+Unchanged files are hardlinks shared between snapshots, so `du` cannot tell
+how much space deleting a snapshot would free. Instead, the number of links
+to every inode from every snapshot is kept in a sqlite database next to the
+snapshots. Bytes of an inode are exclusive to a snapshot when all of its
+links are in that snapshot and shared otherwise. Only snapshots that are new
+since the last run are scanned, and snapshots that disappeared have their
+links subtracted. Snapshots newer than `latest` may still be written to, they
+are not scanned until a backup completes them. Large files in the chunk store that were not assembled into
+a snapshot are not in its tree, they are reported separately.
+
+This script runs on the machine holding the snapshots and must only use the
+standard library.
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+SNAPSHOT_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$")
+STATE_DIR = ".pisync"
+LATEST = "latest"
+SPACE_STORE = "space.sqlite3"
+MANIFEST_DIR = "manifests"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS inodes (
+    dev INTEGER, ino INTEGER, size INTEGER, nlink INTEGER, PRIMARY KEY (dev, ino)
+);
+CREATE TABLE IF NOT EXISTS links (
+    snapshot TEXT, dev INTEGER, ino INTEGER, count INTEGER, PRIMARY KEY (snapshot, dev, ino)
+);
+"""
+
+
+def list_snapshots(destination: str) -> List[str]:
+    return sorted(
+        entry.name
+        for entry in os.scandir(destination)
+        if SNAPSHOT_NAME.match(entry.name) and entry.is_dir(follow_symlinks=False)
+    )
+
+
+def _is_complete(destination: str, snapshot: str) -> bool:
+    """:returns: True if snapshot is not newer than `latest`, a newer one may still be written to"""
+    latest = os.path.join(destination, LATEST)
+    if not os.path.islink(latest):
+        return False
+    return snapshot <= os.path.basename(os.path.realpath(latest))
+
+
+def count_links(root: str) -> Dict[Tuple[int, int], List[int]]:
+    """:returns: (dev, ino) -> [size, nlink, links in this tree] of every non-directory under root"""
+    inodes: Dict[Tuple[int, int], List[int]] = {}
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                key = (stat.st_dev, stat.st_ino)
+                if key in inodes:
+                    inodes[key][2] += 1
+                else:
+                    inodes[key] = [stat.st_size, stat.st_nlink, 1]
+    return inodes
+
+
+def _remove_snapshot(connection: sqlite3.Connection, snapshot: str) -> None:
+    connection.execute(
+        "UPDATE inodes SET nlink = nlink - ("
+        "SELECT count FROM links WHERE links.snapshot = ? AND links.dev = inodes.dev AND links.ino = inodes.ino"
+        ") WHERE EXISTS ("
+        "SELECT 1 FROM links WHERE links.snapshot = ? AND links.dev = inodes.dev AND links.ino = inodes.ino)",
+        (snapshot, snapshot),
+    )
+    connection.execute("DELETE FROM links WHERE snapshot = ?", (snapshot,))
+    connection.execute("DELETE FROM inodes WHERE nlink <= 0")
+    connection.execute("DELETE FROM snapshots WHERE name = ?", (snapshot,))
+
+
+def _add_snapshot(connection: sqlite3.Connection, destination: str, snapshot: str) -> None:
+    inodes = count_links(os.path.join(destination, snapshot))
+    connection.executemany(
+        "INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?)",
+        ((dev, ino, size, nlink) for (dev, ino), (size, nlink, _) in inodes.items()),
+    )
+    connection.executemany(
+        "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+        ((snapshot, dev, ino, count) for (dev, ino), (_, _, count) in inodes.items()),
+    )
+    connection.execute("INSERT INTO snapshots VALUES (?)", (snapshot,))
+
+
+def chunked_files(destination: str, snapshot: str) -> Tuple[int, int]:
+    """:returns: The number and size of the files in the manifest of snapshot that are not in it"""
+    try:
+        with open(os.path.join(destination, STATE_DIR, MANIFEST_DIR, f"{snapshot}.json")) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return 0, 0
+    root = os.path.join(destination, snapshot)
+    sizes = [entry["size"] for path, entry in manifest.items() if not os.path.lexists(os.path.join(root, path))]
+    return len(sizes), sum(sizes)
+
+
+def snapshot_space(destination: str) -> Iterator[Dict]:
+    """
+    Update the cached link counts and report the exclusive and shared bytes
+    of every snapshot.
+    """
+    snapshots = []
+    for snapshot in list_snapshots(destination):
+        if _is_complete(destination, snapshot):
+            snapshots.append(snapshot)
+        else:
+            yield {"event": "incomplete", "snapshot": snapshot}
+    if not snapshots:
+        return
+
+    os.makedirs(os.path.join(destination, STATE_DIR), exist_ok=True)
+    connection = sqlite3.connect(os.path.join(destination, STATE_DIR, SPACE_STORE))
+    connection.executescript(SCHEMA)
+    cached = {name for (name,) in connection.execute("SELECT name FROM snapshots")}
+
+    for snapshot in sorted(cached - set(snapshots)):
+        with connection:
+            _remove_snapshot(connection, snapshot)
+        yield {"event": "removed", "snapshot": snapshot}
+    for snapshot in snapshots:
+        if snapshot not in cached:
+            with connection:
+                _add_snapshot(connection, destination, snapshot)
+            yield {"event": "scanned", "snapshot": snapshot}
+
+    rows = connection.execute(
+        "SELECT links.snapshot, "
+        "SUM(CASE WHEN links.count >= inodes.nlink THEN inodes.size ELSE 0 END), "
+        "SUM(CASE WHEN links.count < inodes.nlink THEN inodes.size ELSE 0 END), "
+        "SUM(links.count) "
+        "FROM links JOIN inodes ON links.dev = inodes.dev AND links.ino = inodes.ino "
+        "GROUP BY links.snapshot"
+    )
+    space = {snapshot: (exclusive, shared, files) for snapshot, exclusive, shared, files in rows}
+    connection.close()
+    for snapshot in snapshots:
+        exclusive, shared, files = space.get(snapshot, (0, 0, 0))
+        yield {"event": "space", "snapshot": snapshot, "exclusive": exclusive, "shared": shared, "files": files}
+        chunked, chunked_bytes = chunked_files(destination, snapshot)
+        if chunked:
+            yield {"event": "chunked", "snapshot": snapshot, "files": chunked, "bytes": chunked_bytes}
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("destination")
+    args = parser.parse_args(argv)
+
+    for event in snapshot_space(args.destination):
+        sys.stdout.write(json.dumps(event) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,286 @@
+"""
+Hash the files in pisync snapshots.
+
+Snapshots made with `--link-dest` share inodes for unchanged files, so
+digests are stored by (device, inode, size, mtime) in a sqlite database next
+to the snapshots and each physical file is only hashed once. Snapshots do not
+change once they are complete, so the verified ones are recorded as well and
+not walked again. Large files kept in the chunk store are verified by hashing
+their chunks, whose names are their sha256 digests.
+
+This script runs on the machine holding the snapshots and must only use the
+standard library.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SNAPSHOT_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$")
+STATE_DIR = ".pisync"
+CHUNK_DIR = "chunks"
+MANIFEST_DIR = "manifests"
+LATEST = "latest"
+HASH_STORE = "hashes.sqlite3"
+BLOCK_SIZE = 1 << 20
+BATCH_SIZE = 1024
+
+Key = Tuple[int, int, int, int]
+
+
+class HashStore:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS verified (snapshot TEXT PRIMARY KEY)")
+
+    def get(self, key: Key) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?", key
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put_many(self, items: List[Tuple[Key, str]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", [(*key, digest) for key, digest in items]
+            )
+
+    def verified_snapshots(self) -> List[str]:
+        return [row[0] for row in self.connection.execute("SELECT snapshot FROM verified")]
+
+    def set_verified_snapshots(self, snapshots: List[str]) -> None:
+        """Record that snapshots were verified and forget the ones that were deleted"""
+        with self.connection:
+            self.connection.execute("DELETE FROM verified")
+            self.connection.executemany("INSERT INTO verified VALUES (?)", [(snapshot,) for snapshot in snapshots])
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def list_snapshots(destination: str) -> List[str]:
+    return sorted(
+        entry.name
+        for entry in os.scandir(destination)
+        if SNAPSHOT_NAME.match(entry.name) and entry.is_dir(follow_symlinks=False)
+    )
+
+
+def walk_files(root: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """:returns: (path relative to root, lstat) of every regular file under root"""
+    stack = [("", root)]
+    while stack:
+        relative_directory, directory = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((relative_path, entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    yield relative_path, entry.stat(follow_symlinks=False)
+
+
+def chunk_digests(destination: str, snapshot: str) -> Iterator[Tuple[str, str]]:
+    """:returns: (path relative to the snapshot, digest) of every chunk in the manifest of snapshot"""
+    try:
+        with open(os.path.join(destination, STATE_DIR, MANIFEST_DIR, f"{snapshot}.json")) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return
+    for relative_path, entry in manifest.items():
+        for digest, _ in entry["chunks"]:
+            yield relative_path, digest
+
+
+def file_key(stat: os.stat_result) -> Key:
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _try_hash_file(path: str) -> Tuple[str, str]:
+    """:returns: The digest of the file, or an error message if it could not be read"""
+    try:
+        return hash_file(path), ""
+    except OSError as e:
+        return "", str(e)
+
+
+def _hash_in_batches(
+    executor: ThreadPoolExecutor, items: Iterator[Tuple[Key, str]]
+) -> Iterator[Tuple[Key, str, str, str]]:
+    """:returns: (key, path, digest, error) for every (key, path), hashed in parallel"""
+    batch: List[Tuple[Key, str]] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            yield from _hash_batch(executor, batch)
+            batch = []
+    yield from _hash_batch(executor, batch)
+
+
+def _hash_batch(executor: ThreadPoolExecutor, batch: List[Tuple[Key, str]]):
+    results = executor.map(_try_hash_file, [path for _, path in batch])
+    for (key, path), (digest, error) in zip(batch, results):
+        yield key, path, digest, error
+
+
+def verify_snapshots(
+    destination: str, snapshots: Optional[List[str]] = None, *, full: bool = False, workers: int = 0
+) -> Iterator[Dict]:
+    """
+    Hash every inode in `snapshots` that is not in the hash store yet. By
+    default, only the snapshots that were not verified before are walked.
+    With `full`, every snapshot is walked and inodes already in the store are
+    hashed again and reported as corrupt if their digest changed.
+    """
+    store = HashStore(os.path.join(destination, STATE_DIR, HASH_STORE))
+    all_snapshots = list_snapshots(destination)
+    verified = set(store.verified_snapshots()) & set(all_snapshots)
+    if snapshots:
+        selected = snapshots
+    elif full:
+        selected = all_snapshots
+    else:
+        selected = [snapshot for snapshot in all_snapshots if snapshot not in verified]
+    summary: Dict[str, Any] = {
+        "event": "summary",
+        "snapshots": len(selected),
+        "skipped": 0 if snapshots else len(all_snapshots) - len(selected),
+        "files": 0,
+        "inodes": 0,
+        "hashed": 0,
+        "bytes": 0,
+    }
+
+    inodes: Dict[Key, str] = {}
+    # the digest a chunk must have, which is its name
+    chunks: Dict[Key, str] = {}
+    failed = False
+    for snapshot in selected:
+        for relative_path, stat in walk_files(os.path.join(destination, snapshot)):
+            summary["files"] += 1
+            inodes.setdefault(file_key(stat), f"{snapshot}/{relative_path}")
+        chunked_files = set()
+        for relative_path, chunk in chunk_digests(destination, snapshot):
+            chunked_files.add(relative_path)
+            path = os.path.join(STATE_DIR, CHUNK_DIR, chunk[:2], chunk)
+            try:
+                stat = os.stat(os.path.join(destination, path))
+            except OSError as e:
+                failed = True
+                yield {"event": "error", "path": f"{snapshot}/{relative_path}", "error": f"chunk {chunk}: {e}"}
+                continue
+            inodes.setdefault(file_key(stat), path)
+            chunks[file_key(stat)] = chunk
+        summary["files"] += len(chunked_files)
+    summary["inodes"] = len(inodes)
+
+    expected = {}
+    for key in inodes:
+        digest = store.get(key)
+        if digest is not None:
+            expected[key] = digest
+    pending = ((key, os.path.join(destination, path)) for key, path in inodes.items() if full or key not in expected)
+
+    new_digests = []
+    with ThreadPoolExecutor(max_workers=workers or None) as executor:
+        for key, _, digest, error in _hash_in_batches(executor, pending):
+            path = inodes[key]
+            if error:
+                failed = True
+                yield {"event": "error", "path": path, "error": error}
+                continue
+            summary["hashed"] += 1
+            summary["bytes"] += key[2]
+            wanted = expected.get(key, chunks.get(key))
+            if wanted is not None and wanted != digest:
+                yield {"event": "corrupt", "path": path, "expected": wanted, "actual": digest}
+            elif key not in expected:
+                new_digests.append((key, digest))
+            if len(new_digests) >= BATCH_SIZE:
+                store.put_many(new_digests)
+                new_digests = []
+    store.put_many(new_digests)
+    if not failed:
+        verified.update(snapshot for snapshot in selected if _is_complete(destination, snapshot))
+    store.set_verified_snapshots(sorted(verified))
+    store.close()
+    yield summary
+
+
+def _is_complete(destination: str, snapshot: str) -> bool:
+    """:returns: True if snapshot is not newer than `latest`, a newer one may still be written to"""
+    latest = os.path.join(destination, LATEST)
+    if not os.path.islink(latest):
+        return False
+    return snapshot <= os.path.basename(os.path.realpath(latest))
+
+
+def hash_tree(root: str, store_path: Optional[str] = None, workers: int = 0) -> Iterator[Dict]:
+    """
+    :returns: The digest, size and mtime of every file under root, reusing
+    digests from the hash store at `store_path` for inodes that did not change.
+    """
+    store = None if store_path is None else HashStore(store_path)
+    pending = []
+    for relative_path, stat in walk_files(root):
+        key = file_key(stat)
+        digest = None if store is None else store.get(key)
+        if digest is None:
+            pending.append((key, relative_path))
+        else:
+            yield {"event": "file", "path": relative_path, "digest": digest, "size": key[2], "mtime_ns": key[3]}
+
+    new_digests = []
+    with ThreadPoolExecutor(max_workers=workers or None) as executor:
+        items = ((key, os.path.join(root, relative_path)) for key, relative_path in pending)
+        for (key, _, digest, error), (_, relative_path) in zip(_hash_in_batches(executor, items), pending):
+            if error:
+                yield {"event": "error", "path": relative_path, "error": error}
+                continue
+            new_digests.append((key, digest))
+            yield {"event": "file", "path": relative_path, "digest": digest, "size": key[2], "mtime_ns": key[3]}
+    if store is not None:
+        store.put_many(new_digests)
+        store.close()
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("destination")
+    parser.add_argument("--snapshot", action="append", default=[])
+    parser.add_argument("--tree", help="hash the files of this snapshot subdirectory instead of verifying")
+    parser.add_argument("--full", action="store_true")
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.tree is not None:
+        store_path = os.path.join(args.destination, STATE_DIR, HASH_STORE)
+        events = hash_tree(os.path.join(args.destination, args.tree), store_path, args.workers)
+    else:
+        events = verify_snapshots(args.destination, args.snapshot, full=args.full, workers=args.workers)
+    for event in events:
+        sys.stdout.write(json.dumps(event) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+import asyncio
+import copy
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Union
+
+from pisync.config.pull_config import PullConfig
+from pisync.util import abackup
+
+
+async def apull_many(
+    configs: Iterable[PullConfig],
+    *,
+    max_concurrency: int = 4,
+    max_per_client: int = 1,
+    bwlimit: Optional[int] = None,
+    client_bwlimit: Optional[int] = None,
+) -> List[Union[str, BaseException]]:
+    """
+    Pull backups from many clients into this machine at once, with at most
+    `max_concurrency` pulls running in total and `max_per_client` from the
+    same client.
+
+    `bwlimit` limits all pulls together and `client_bwlimit` all pulls from one
+    client, in KiB per second. Each limit is split evenly between the pulls
+    that can run at the same time, so it holds even when all of them do. The
+    `bwlimit` of a config is kept if it is lower than its share.
+
+    :returns: The latest backup directory of each config, or the exception it
+    failed with, in the same order as `configs`.
+    """
+    configs = list(configs)
+    per_client = Counter(config.client for config in configs)
+    # the pulls that can run at once, with at most max_per_client from each client
+    slots = min(max_concurrency, sum(min(max_per_client, count) for count in per_client.values()))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    client_semaphores: Dict[str, asyncio.Semaphore] = {
+        client: asyncio.Semaphore(max_per_client) for client in per_client
+    }
+
+    async def run_one(config: PullConfig) -> str:
+        # wait for the client before taking one of the global slots, so a
+        # busy client does not keep pulls from other clients waiting
+        async with client_semaphores[config.client], semaphore:
+            limits = [
+                config.bwlimit,
+                _share(bwlimit, slots),
+                _share(client_bwlimit, min(max_per_client, per_client[config.client])),
+            ]
+            limited = copy.copy(config)
+            limited.bwlimit = min((limit for limit in limits if limit is not None), default=None)
+            return await abackup(limited)
+
+    return await asyncio.gather(*(run_one(config) for config in configs), return_exceptions=True)
+
+
+def _share(limit: Optional[int], parts: int) -> Optional[int]:
+    return None if limit is None else max(1, limit // max(1, parts))
@@ -0,0 +1,106 @@
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+from pisync.config.base_config import BaseConfig, get_tar_extract_command
+from pisync.jobs import restore as restore_job
+from pisync.jobs import run_job
+
+
+class RestoreFailedError(Exception):
+    pass
+
+
+class RestoreReport(NamedTuple):
+    files: int
+    bytes: int
+    streams: int
+    seconds: float
+
+
+def restore(
+    config: BaseConfig,
+    target: str,
+    snapshot: str = "latest",
+    patterns: Optional[List[str]] = None,
+    *,
+    workers: int = 4,
+) -> RestoreReport:
+    """
+    Restore a snapshot, or the paths in it matching shell-style `patterns`
+    (where `*` also matches `/`), into the local directory `target`.
+
+    The selection is split into `workers` groups of about the same size that
+    are streamed in parallel as tar archives, over separate channels of the
+    existing ssh connection for a `RemoteConfig`. Directory metadata is
+    restored last so that directory modification times are kept.
+
+    Large files in the chunk store are only restored if they were put back
+    into the snapshot with `pisync assemble`, a warning lists the others.
+    """
+    start_time = time.perf_counter()
+    root = f"{config.destination_dir}/{snapshot}"
+    args = [root, "--workers", str(workers)]
+    for pattern in patterns or []:
+        args.append(f"--pattern={pattern}")
+    units = []
+    for record in run_job(config, restore_job, args):
+        if "chunked" in record:
+            chunked = ", ".join(record["chunked"])
+            logging.warning(f"Not restoring the chunked files of {root}, run pisync assemble first: {chunked}")
+        else:
+            units.append(record)
+    if not units:
+        msg = f"Nothing in {root} matches {patterns}"
+        raise RestoreFailedError(msg)
+
+    os.makedirs(target, exist_ok=True)
+    groups = [group for group in _balance([u for u in units if u["recursive"]], workers) if group]
+    logging.info(f"Restoring {root} to {target} in {len(groups)} streams")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_transfer, config, root, target, group) for group in groups]
+        for future in futures:
+            future.result()
+
+    directories = [path for u in units if not u["recursive"] for path in u["paths"]]
+    if directories:
+        _transfer(config, root, target, directories, recursive=False)
+
+    report = RestoreReport(
+        files=sum(u["files"] for u in units),
+        bytes=sum(u["bytes"] for u in units),
+        streams=len(groups),
+        seconds=time.perf_counter() - start_time,
+    )
+    logging.info(f"Restored {report.files} files ({report.bytes} bytes) in {report.seconds} seconds")
+    return report
+
+
+def _balance(units: List[Dict], workers: int) -> List[List[str]]:
+    """Greedily assign the largest units to the group with the fewest bytes"""
+    groups: List[List[str]] = [[] for _ in range(workers)]
+    sizes = [0] * workers
+    for unit in sorted(units, key=lambda u: u["bytes"], reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].extend(unit["paths"])
+        sizes[smallest] += unit["bytes"]
+    return groups
+
+
+def _transfer(config: BaseConfig, root: str, target: str, paths: List[str], *, recursive: bool = True) -> None:
+    with tempfile.TemporaryFile() as stderr:
+        extract = subprocess.Popen(get_tar_extract_command(target), stdin=subprocess.PIPE, stderr=stderr)
+        # If the stdin argument was not PIPE, this attribute is None.
+        if extract.stdin is not None:
+            try:
+                config.read_tar(root, paths, extract.stdin, recursive=recursive)
+            finally:
+                extract.stdin.close()
+        if extract.wait() != 0:
+            stderr.seek(0)
+            msg = f"Extracting to {target} failed: {stderr.read().decode(errors='replace')}"
+            raise RestoreFailedError(msg)
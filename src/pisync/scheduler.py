@@ -0,0 +1,382 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+from collections import deque
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Deque, Dict, FrozenSet, Optional, Set, Tuple, cast
+
+from pisync.config.base_config import BaseConfig
+from pisync.config.config_file import ConfigFileError, load_config_file, load_schedules
+from pisync.util import abackup, get_cache_dir
+
+if TYPE_CHECKING:
+    from pisync.config.remote_config import RemoteConfig
+
+# (name, lowest value, highest value) of the five fields of a cron expression
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day of month", 1, 31),
+    ("month", 1, 12),
+    ("day of week", 0, 7),
+)
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+CRON_NAMES = {
+    "month": {name: number for number, name in enumerate("jan feb mar apr may jun jul aug sep oct nov dec".split(), 1)},
+    "day of week": {name: number for number, name in enumerate("sun mon tue wed thu fri sat".split())},
+}
+# give up looking for the next run of expressions like "0 0 30 2 *"
+MAX_SCHEDULE_YEARS = 5
+
+DestinationKey = Tuple[str, str]
+
+
+class CronSchedule:
+    """
+    A five field cron expression (minute, hour, day of month, month, day of
+    week) supporting `*`, lists, ranges, steps, month and weekday names and the
+    `@daily` style aliases. Like cron, a day matches if either the day of month
+    or the day of week matches when both are restricted.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            msg = f"Expected {len(CRON_FIELDS)} fields in cron expression {expression!r}"
+            raise ValueError(msg)
+        values = [_parse_cron_field(text, *field) for text, field in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, days_of_week = values
+        # 0 and 7 are both sunday
+        self.days_of_week = frozenset(day % 7 for day in days_of_week)
+        self._any_day = fields[2] == "*"
+        self._any_day_of_week = fields[4] == "*"
+
+    def __repr__(self) -> str:
+        return f"CronSchedule({self.expression!r})"
+
+    def matches(self, when: datetime) -> bool:
+        return when.minute in self.minutes and when.hour in self.hours and self._matches_day(when)
+
+    def next_after(self, when: datetime) -> Optional[datetime]:
+        """:returns: The first matching minute after `when`, or None if there is none"""
+        candidate = when.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end = candidate + timedelta(days=366 * MAX_SCHEDULE_YEARS)
+        while candidate < end:
+            if not self._matches_day(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        return None
+
+    def _matches_day(self, when: datetime) -> bool:
+        if when.month not in self.months:
+            return False
+        day = when.day in self.days
+        # datetime counts weekdays from monday, cron from sunday
+        day_of_week = (when.weekday() + 1) % 7 in self.days_of_week
+        if self._any_day or self._any_day_of_week:
+            return day and day_of_week
+        return day or day_of_week
+
+
+class BackupState:
+    """What the scheduler knows about one backup"""
+
+    def __init__(self, schedule: Optional[CronSchedule]):
+        self.schedule = schedule
+        self.state = "idle"
+        self.runs = 0
+        self.coalesced = 0
+        self.last_started: Optional[datetime] = None
+        self.last_finished: Optional[datetime] = None
+        self.last_result: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        next_run = None if self.schedule is None else self.schedule.next_after(_now())
+        return {
+            "state": self.state,
+            "schedule": None if self.schedule is None else self.schedule.expression,
+            "next_run": _isoformat(next_run),
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "last_started": _isoformat(self.last_started),
+            "last_finished": _isoformat(self.last_finished),
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+        }
+
+
+class Scheduler:
+    """
+    Run backups on cron schedules and on request from a single long-running
+    event loop.
+
+    Configs are kept for the lifetime of the scheduler, so their paths are only
+    checked once and remote configs for the same host share one ssh
+    connection, which their backups open under a lock. rsync reuses a single
+    ssh master connection per host as well, but it only persists for
+    `SSH_CONTROL_PERSIST` after a run, so backups on hourly or daily schedules
+    each connect again.
+    At most one backup runs per destination: triggering a backup that is
+    already running or waiting is coalesced into that run, and backups of other
+    configs with the same destination wait for their turn. A backup started by
+    another process fails on the lock `abackup` holds on the destination.
+    """
+
+    def __init__(
+        self,
+        configs: Dict[str, BaseConfig],
+        schedules: Optional[Dict[str, str]] = None,
+        *,
+        max_concurrency: int = 4,
+        ssh_control_dir: Optional[str] = None,
+    ):
+        schedules = {} if schedules is None else schedules
+        unknown = set(schedules) - set(configs)
+        if unknown:
+            msg = f"Schedules for unknown backups {sorted(unknown)}"
+            raise ValueError(msg)
+        self.configs = configs
+        self.states = {name: BackupState(_optional_schedule(schedules.get(name))) for name in configs}
+        self.max_concurrency = max_concurrency
+        self._queues: Dict[DestinationKey, Deque[str]] = {}
+        self._running: Dict[DestinationKey, str] = {}
+        self._drainers: Dict[DestinationKey, asyncio.Task[None]] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._share_connections(ssh_control_dir or str(get_cache_dir() / "ssh"))
+
+    def trigger(self, name: str) -> str:
+        """
+        Start the backup `name` as soon as its destination is free.
+
+        :returns: "started", "queued" if another backup is using the same
+        destination, or "coalesced" if the backup is already running or queued
+        :raises:
+            KeyError: If there is no backup called `name`
+        """
+        if name not in self.configs:
+            msg = f"No backup named {name!r}"
+            raise KeyError(msg)
+        key = _destination_key(self.configs[name])
+        queue = self._queues.setdefault(key, deque())
+        if name == self._running.get(key) or name in queue:
+            self.states[name].coalesced += 1
+            logging.info(f"Backup {name} is already running or queued")
+            return "coalesced"
+
+        queue.append(name)
+        self.states[name].state = "queued"
+        if key in self._drainers:
+            return "queued"
+        self._drainers[key] = asyncio.ensure_future(self._drain(key))
+        return "started"
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        return {name: state.as_dict() for name, state in self.states.items()}
+
+    async def serve(self, socket_path: str) -> None:
+        """Run scheduled backups and answer the control socket until cancelled"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        if task is not None:
+            loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)  # left behind by a daemon that was killed
+        server = await asyncio.start_unix_server(self._handle_client, path=socket_path)
+        os.chmod(socket_path, 0o600)
+        logging.info(f"Scheduler listening on {socket_path}")
+        try:
+            await self._run_schedules()
+        finally:
+            server.close()
+            await server.wait_closed()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+            await self.shutdown()
+
+    async def shutdown(self) -> None:
+        """Cancel running backups, which deletes their partial snapshots, and close connections"""
+        drainers = list(self._drainers.values())
+        for drainer in drainers:
+            drainer.cancel()
+        await asyncio.gather(*drainers, return_exceptions=True)
+        for config in self.configs.values():
+            if hasattr(config, "connection"):
+                cast("RemoteConfig", config).connection.close()
+
+    async def _run_schedules(self) -> None:
+        minute = _now().replace(second=0, microsecond=0)
+        while True:
+            # never go back to a minute that was already handled if sleep returns early,
+            # and pick up daylight saving time changes of the local timezone
+            minute = (max(minute, _now().replace(second=0, microsecond=0)) + timedelta(minutes=1)).astimezone()
+            await asyncio.sleep(max((minute - _now()).total_seconds(), 0))
+            for name, state in self.states.items():
+                if state.schedule is not None and state.schedule.matches(minute):
+                    self.trigger(name)
+
+    async def _drain(self, key: DestinationKey) -> None:
+        """Run the backups queued for one destination one after the other"""
+        queue = self._queues[key]
+        try:
+            while queue:
+                name = queue.popleft()
+                self._running[key] = name
+                try:
+                    await self._run_backup(name)
+                finally:
+                    del self._running[key]
+        finally:
+            # no await between the empty queue check and this, so trigger() never
+            # appends to a queue that is not drained anymore
+            del self._drainers[key]
+
+    async def _run_backup(self, name: str) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        state = self.states[name]
+        async with self._semaphore:
+            state.state = "running"
+            state.runs += 1
+            state.last_started = _now()
+            try:
+                state.last_result = await abackup(self.configs[name])
+                state.last_error = None
+            except Exception as e:
+                logging.exception(f"Backup {name} failed")
+                state.last_error = str(e)
+            finally:
+                state.state = "idle"
+                state.last_finished = _now()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        line = await reader.readline()
+        command, _, argument = line.decode(errors="replace").strip().partition(" ")
+        response: Dict[str, Any]
+        if command == "run":
+            try:
+                response = {"result": self.trigger(argument)}
+            except KeyError as e:
+                response = {"error": e.args[0]}
+        elif command == "status":
+            response = {"backups": self.status()}
+        else:
+            response = {"error": f"Unknown command {command!r}"}
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+        writer.close()
+
+    def _share_connections(self, ssh_control_dir: str) -> None:
+        connections: Dict[str, Any] = {}
+        for config in self.configs.values():
+            if hasattr(config, "user_at_hostname"):
+                remote_config = cast("RemoteConfig", config)
+                remote_config.connection = connections.setdefault(
+                    remote_config.user_at_hostname, remote_config.connection
+                )
+            # RemoteConfig and PullConfig run rsync over ssh
+            if hasattr(config, "ssh_control_path") and cast(Any, config).ssh_control_path is None:
+                Path(ssh_control_dir).mkdir(mode=0o700, parents=True, exist_ok=True)
+                cast(Any, config).ssh_control_path = f"{ssh_control_dir}/%C"
+
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "pisync.sock")
+    return str(get_cache_dir() / "pisync.sock")
+
+
+def send_command(socket_path: str, command: str) -> Dict[str, Any]:
+    """Send a command ("run <name>" or "status") to a running scheduler"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(command.encode() + b"\n")
+        with client.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def run_daemon(path: Optional[str] = None, socket_path: Optional[str] = None, max_concurrency: int = 4) -> None:
+    """
+    Run the backups in the config file at `path` on their schedules until the
+    process receives SIGINT or SIGTERM.
+
+    :raises:
+        ConfigFileError: If the config file or a schedule in it is not valid
+    """
+    configs = load_config_file(path)
+    schedules = load_schedules(path)
+    for name, expression in schedules.items():
+        try:
+            CronSchedule(expression)
+        except ValueError as e:
+            msg = f"Backup {name!r} has an invalid schedule: {e}"
+            raise ConfigFileError(msg) from e
+    scheduler = Scheduler(configs, schedules, max_concurrency=max_concurrency)
+    with contextlib.suppress(KeyboardInterrupt, asyncio.CancelledError):
+        asyncio.run(scheduler.serve(socket_path or default_socket_path()))
+
+
+def _now() -> datetime:
+    return datetime.now().astimezone()
+
+
+def _destination_key(config: BaseConfig) -> DestinationKey:
+    return getattr(config, "user_at_hostname", ""), os.path.normpath(str(config.destination_dir))
+
+
+def _optional_schedule(expression: Optional[str]) -> Optional[CronSchedule]:
+    return None if expression is None else CronSchedule(expression)
+
+
+def _isoformat(when: Optional[datetime]) -> Optional[str]:
+    return None if when is None else when.isoformat(timespec="seconds")
+
+
+def _parse_cron_field(text: str, field: str, low: int, high: int) -> FrozenSet[int]:
+    names = CRON_NAMES.get(field, {})
+    values: Set[int] = set()
+    for part in text.lower().split(","):
+        range_, slash, step_text = part.partition("/")
+        try:
+            step = int(step_text) if slash else 1
+            if range_ == "*":
+                start, end = low, high
+            elif "-" in range_:
+                first, _, last = range_.partition("-")
+                start, end = _cron_value(first, names), _cron_value(last, names)
+            else:
+                start = _cron_value(range_, names)
+                end = high if slash else start
+        except ValueError:
+            msg = f"Invalid {field} {part!r}"
+            raise ValueError(msg) from None
+        if not low <= start <= end <= high or step < 1:
+            msg = f"Invalid {field} {part!r}, expected values from {low} to {high}"
+            raise ValueError(msg)
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+def _cron_value(text: str, names: Dict[str, int]) -> int:
+    return names[text] if text in names else int(text)
@@ -0,0 +1,42 @@
+import logging
+from typing import List, NamedTuple
+
+from pisync.config.base_config import BaseConfig
+from pisync.jobs import run_job
+from pisync.jobs import space as space_job
+
+
+class SnapshotSpace(NamedTuple):
+    snapshot: str
+    # bytes that deleting this snapshot would free
+    exclusive_bytes: int
+    # bytes hardlinked with other snapshots
+    shared_bytes: int
+    files: int
+
+
+def snapshot_space(config: BaseConfig) -> List[SnapshotSpace]:
+    """
+    Compute the exclusive and shared bytes of every snapshot in
+    `config.destination_dir` from inode link counts.
+
+    Link counts are cached in `destination_dir/.pisync/` so only snapshots
+    created or deleted since the last call are scanned. For a `RemoteConfig`
+    the accounting runs on the remote machine. Snapshots newer than `latest`
+    are left out, a backup may still be writing them. Large files in the chunk store
+    are not counted, a warning gives their size for each snapshot.
+    """
+    space = []
+    for event in run_job(config, space_job, [config.destination_dir]):
+        if event["event"] == "space":
+            space.append(SnapshotSpace(event["snapshot"], event["exclusive"], event["shared"], event["files"]))
+        elif event["event"] == "chunked":
+            logging.warning(
+                f"{event['files']} chunked files ({event['bytes']} bytes) of snapshot {event['snapshot']} "
+                "are in the chunk store and not counted"
+            )
+        elif event["event"] == "incomplete":
+            logging.info(f"Snapshot {event['snapshot']} is newer than latest and not counted yet")
+        else:
+            logging.info(f"Space accounting {event['event']} snapshot {event['snapshot']}")
+    return space
@@ -1,19 +1,63 @@
+import asyncio
+import contextlib
+import functools
 import logging
+import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
-from pisync.config.base_config import BackupType, BaseConfig
+import pisync.chunks
+from pisync.config.base_config import (
+    TAR_COMPRESSION,
+    BackupType,
+    BaseConfig,
+    DestinationLockedError,
+    ScriptFailedError,
+)
+
+# seconds to wait for rsync to exit after SIGTERM before sending SIGKILL
+RSYNC_TERMINATE_TIMEOUT = 10
+# labels of the `--info=stats3` summary of rsync and the `RsyncStats` fields they fill
+RSYNC_STATS_FIELDS = {
+    "Number of regular files transferred": "files_transferred",
+    "Total file size": "total_file_bytes",
+    "Total transferred file size": "transferred_file_bytes",
+    "Literal data": "literal_bytes",
+    "Total bytes sent": "sent_bytes",
+    "Total bytes received": "received_bytes",
+}
 
 
 class BackupFailedError(Exception):
     pass
 
 
+class RsyncStats(NamedTuple):
+    files_transferred: int = 0
+    total_file_bytes: int = 0
+    # size of the files that were updated and of the data that actually had to be sent for them
+    transferred_file_bytes: int = 0
+    literal_bytes: int = 0
+    sent_bytes: int = 0
+    received_bytes: int = 0
+    seconds: float = 0.0
+
+    @property
+    def file_bytes_per_second(self) -> float:
+        return self.transferred_file_bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def wire_bytes_per_second(self) -> float:
+        return (self.sent_bytes + self.received_bytes) / self.seconds if self.seconds else 0.0
+
+
 def backup(config: BaseConfig) -> str:
     """
     Returns the path to the latest backup directory
@@ -21,6 +65,114 @@ def backup(config: BaseConfig) -> str:
     enforce_system_requirements()
     configure_logging(config.log_file)
 
+    with _locked_destination(config):
+        latest_backup_path, backup_method = _prepare_backup(config)
+
+        if backup_method == BackupType.Complete and config.seed:
+            backup_method = _seed_backup(config, latest_backup_path)
+
+        rsync_command = config.get_rsync_command(latest_backup_path, backup_method=backup_method)
+
+        exit_code = run_rsync(rsync_command)
+
+        return _finish_backup(config, latest_backup_path, exit_code)
+
+
+async def abackup(config: BaseConfig) -> str:
+    """
+    Asyncio version of `backup`. Returns the path to the latest backup directory
+
+    Rsync runs as an asyncio subprocess. The (possibly remote) checks on
+    `config` and building the rsync command, which may probe the remote
+    machine, run in the event loop's default executor so that they do not
+    block the loop. Cancelling the task terminates rsync and deletes the
+    partial backup, just like a failed rsync run.
+
+    The destination is locked for the whole backup, so a backup to the same
+    destination from another process fails instead of interleaving with it.
+    """
+    enforce_system_requirements()
+    configure_logging(config.log_file)
+    loop = asyncio.get_running_loop()
+
+    stack = contextlib.ExitStack()
+    try:
+        locking = loop.run_in_executor(None, stack.enter_context, _locked_destination(config))
+        try:
+            await asyncio.shield(locking)
+        except asyncio.CancelledError:
+            # wait for the lock to be taken so that closing the stack releases it
+            with contextlib.suppress(Exception):
+                await locking
+            raise
+
+        latest_backup_path, backup_method = await loop.run_in_executor(None, _prepare_backup, config)
+
+        try:
+            if backup_method == BackupType.Complete and config.seed:
+                backup_method = await _aseed_backup(config, latest_backup_path)
+            rsync_command = await loop.run_in_executor(
+                None, functools.partial(config.get_rsync_command, latest_backup_path, backup_method=backup_method)
+            )
+            exit_code = await arun_rsync(rsync_command)
+        except asyncio.CancelledError:
+            logging.fatal("Backup cancelled")
+            await loop.run_in_executor(None, _remove_failed_backup, config, latest_backup_path)
+            raise
+
+        return await loop.run_in_executor(None, _finish_backup, config, latest_backup_path, exit_code)
+    finally:
+        # releasing a remote lock is a round trip too
+        await loop.run_in_executor(None, stack.close)
+
+
+async def abackup_many(configs: Iterable[BaseConfig], max_concurrency: int = 4) -> List[Union[str, BaseException]]:
+    """
+    Run `abackup` for every config on the current event loop with at most
+    `max_concurrency` backups running at once.
+
+    :returns: The latest backup directory of each config, or the exception it
+    failed with, in the same order as `configs`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(config: BaseConfig) -> str:
+        async with semaphore:
+            return await abackup(config)
+
+    return await asyncio.gather(*(run_one(config) for config in configs), return_exceptions=True)
+
+
+@contextlib.contextmanager
+def _locked_destination(config: BaseConfig) -> Iterator[None]:
+    """
+    Lock the destination of config for the duration of a backup.
+
+    :raises:
+        BackupFailedError: If another backup to the destination is running
+        InvalidPathError: If source_dir or destination_dir is not a directory
+    """
+    config.check_paths()
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(config.lock_destination())
+        except DestinationLockedError as e:
+            logging.error(str(e))
+            raise BackupFailedError(str(e)) from e
+        yield
+
+
+def _prepare_backup(config: BaseConfig) -> Tuple[str, BackupType]:
+    """
+    :returns: The new backup directory and whether the backup is complete or
+    incremental.
+    :raises:
+        BackupFailedError: If a previous backup exists without a `latest` symlink
+        InvalidPathError: If source_dir or destination_dir is not a directory
+    """
+    config.check_paths()
+    if config.resources is not None and config.resources.cgroup is not None:
+        config.resources.prepare_cgroup()
     latest_backup_path = config.generate_new_backup_dir_path()
 
     prev_backup_exists = not config.is_empty_directory(config.destination_dir)
@@ -40,17 +192,143 @@ create the necessary symlink at {config.link_dir}.
 
     if prev_backup_exists:
         backup_method = BackupType.Incremental
-        logging.info(f"Starting incremental backup from {config.resolve(config.link_dir)}")
+        logging.info(f"Starting incremental backup from {config.link_dir}")
     else:
         backup_method = BackupType.Complete
         logging.info(f"No previous backup found at {config.destination_dir}")
-        logging.info(f"Starting a fresh complete backup from {config.source_dir} to {config.destination_dir}")
+        sources = ", ".join(config.source_paths())
+        logging.info(f"Starting a fresh complete backup from {sources} to {config.destination_dir}")
+
+    return latest_backup_path, backup_method
+
+
+class _SeedCancellation:
+    """Lets the event loop kill the tar process of a seed running in the executor"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.processes: List[subprocess.Popen] = []
+
+    def register(self, process: subprocess.Popen) -> None:
+        self.processes.append(process)
+        if self.cancelled.is_set():
+            process.kill()
 
-    rsync_command = config.get_rsync_command(latest_backup_path, backup_method=backup_method)
+    def cancel(self) -> None:
+        self.cancelled.set()
+        for process in list(self.processes):
+            process.kill()
 
-    exit_code = run_rsync(rsync_command)
 
+async def _aseed_backup(config: BaseConfig, latest_backup_path: str) -> BackupType:
+    """
+    Run `_seed_backup` in the default executor. If the task is cancelled, tar
+    is killed and the seed is waited for, so that the partial backup can be
+    removed afterwards.
+    """
+    loop = asyncio.get_running_loop()
+    cancellation = _SeedCancellation()
+    seeding = loop.run_in_executor(None, _seed_backup, config, latest_backup_path, cancellation)
+    try:
+        return await asyncio.shield(seeding)
+    except asyncio.CancelledError:
+        cancellation.cancel()
+        with contextlib.suppress(Exception):
+            await seeding
+        raise
+
+
+def _seed_backup(
+    config: BaseConfig, latest_backup_path: str, cancellation: Optional[_SeedCancellation] = None
+) -> BackupType:
+    """
+    Copy the source into the new backup directory with a single tar stream,
+    which is much faster than rsync for a first backup of many small files.
+    Excluded files are left out of the stream. rsync still runs afterwards to
+    reconcile any differences.
+
+    :returns: The backup type for the reconciliation rsync run
+    :raises:
+        BackupFailedError: If the tar stream fails
+    """
+    source_dir = str(config.source_dir)
+    if config.sources:
+        # the same layout as rsync --relative
+        directory, members = source_dir, [os.path.relpath(path, source_dir) for path in config.source_paths()]
+    elif source_dir.endswith("/"):
+        directory, members = source_dir, ["."]
+    else:
+        directory, members = str(Path(source_dir).parent), [Path(source_dir).name]
+    compression = [] if config.seed_compression is None else TAR_COMPRESSION[config.seed_compression]
+    # tar names the members "./path" when it archives "."
+    prefix = "./" if members == ["."] else ""
+    # GNU tar (checked with 1.34) only applies the first entry of a NUL
+    # separated --exclude-from, also with --null, so paths are written as
+    # lines. Paths with a newline cannot be, and those with a backslash are
+    # left out so no tar version reads them as an escape; --delete-excluded
+    # removes both.
+    excluded = [
+        os.fsencode(f"{prefix}{path}\n") for path in config.filters.excluded_paths() if not set(path) & {"\n", "\\"}
+    ]
+
+    start_time = time.perf_counter()
+    with tempfile.NamedTemporaryFile() as exclude_file, tempfile.TemporaryFile() as stderr:
+        exclude_file.writelines(excluded)
+        exclude_file.flush()
+        exclude_arguments = ["--anchored", "--no-wildcards", f"--exclude-from={exclude_file.name}"] if excluded else []
+        tar_command = [
+            "tar",
+            "-c",
+            "-f",
+            "-",
+            "-C",
+            directory,
+            "--numeric-owner",
+            *compression,
+            *exclude_arguments,
+            *members,
+        ]
+        logging.info(f"Seeding {latest_backup_path} with {tar_command}")
+        process = subprocess.Popen(tar_command, stdout=subprocess.PIPE, stderr=stderr)
+        if cancellation is not None:
+            cancellation.register(process)
+        finished = False
+        try:
+            # If the stdout argument was not PIPE, this attribute is None.
+            if process.stdout is not None:
+                config.write_tar(latest_backup_path, process.stdout, compression=config.seed_compression)
+            finished = True
+        except ScriptFailedError as e:
+            msg = f"Seeding {latest_backup_path} failed: {e}"
+            logging.fatal(msg)
+            raise BackupFailedError(msg) from e
+        finally:
+            if not finished:
+                process.kill()
+                process.wait()
+                _remove_failed_backup(config, latest_backup_path)
+        return_code = process.wait()
+        stderr.seek(0)
+        for line in stderr.read().decode(errors="replace").splitlines():
+            logging.warning(f"TAR: {line}")
+
+    # GNU tar exits with 1 if files changed while they were read, which the
+    # reconciliation rsync run fixes
+    if return_code not in (0, 1):
+        _remove_failed_backup(config, latest_backup_path)
+        msg = f"Seeding {latest_backup_path} failed. Tar exit code: {return_code}"
+        logging.fatal(msg)
+        raise BackupFailedError(msg)
+
+    end_time = time.perf_counter()
+    logging.info(f"Seeded {latest_backup_path} in {end_time - start_time} seconds")
+    return BackupType.Seeded
+
+
+def _finish_backup(config: BaseConfig, latest_backup_path: str, exit_code: int) -> str:
     if exit_code == 0:
+        if config.chunk_threshold is not None:
+            _store_large_files(config, latest_backup_path)
         logging.info("Finished backup successfully")
         if config.file_exists(config.link_dir):
             config.unlink(config.link_dir)
@@ -60,19 +338,46 @@ create the necessary symlink at {config.link_dir}.
     else:
         msg = f"Backup failed. Rsync exit code: {exit_code}"
         logging.fatal(msg)
-        # backup failed, we should delete the most recent backup
-        if config.file_exists(latest_backup_path):
-            logging.fatal(f"Deleting failed backup at {latest_backup_path}")
-            config.rmtree(latest_backup_path)
+        _remove_failed_backup(config, latest_backup_path)
         raise BackupFailedError(msg)
 
 
+def _store_large_files(config: BaseConfig, latest_backup_path: str) -> None:
+    """
+    :raises:
+        BackupFailedError: If the large files could not be stored in the chunk store
+    """
+    try:
+        pisync.chunks.store_large_files(config, latest_backup_path)
+    except (ScriptFailedError, pisync.chunks.ChunkStoreError, OSError) as e:
+        _remove_failed_backup(config, latest_backup_path)
+        msg = f"Storing the large files of {latest_backup_path} failed: {e}"
+        logging.fatal(msg)
+        raise BackupFailedError(msg) from e
+
+
+def _remove_failed_backup(config: BaseConfig, latest_backup_path: str) -> None:
+    # backup failed, we should delete the most recent backup
+    if config.file_exists(latest_backup_path):
+        logging.fatal(f"Deleting failed backup at {latest_backup_path}")
+        config.rmtree(latest_backup_path)
+
+
 def get_time_stamp() -> str:
     now = datetime.now().astimezone()
     stamp = now.strftime("%Y-%m-%d-%H-%M-%S")
     return str(stamp)
 
 
+def get_cache_dir() -> Path:
+    """
+    :returns: The directory pisync keeps generated files and cached results in
+    """
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+    cache_home = Path(xdg_cache_home) if xdg_cache_home else Path.home() / ".cache"
+    return cache_home / "pisync"
+
+
 def configure_logging(filename: str):
     _filename = Path(filename)
     if not _filename.parent.exists():
@@ -99,10 +404,13 @@ def run_rsync(rsync_command: List[str]) -> int:
 
     process = subprocess.Popen(rsync_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
+    stats_lines = []
     # If the stdout argument was not PIPE, this attribute is None.
     if process.stdout is not None:
         for line in process.stdout:
             logging.info(f"RSYNC: {line.rstrip()}")
+            if _is_stats_line(line):
+                stats_lines.append(line)
 
     # If the stderr argument was not PIPE, this attribute is None.
     if process.stderr is not None:
@@ -113,5 +421,74 @@ def run_rsync(rsync_command: List[str]) -> int:
 
     end_time = time.perf_counter()
     logging.info(f"Time elapsed {end_time - start_time} seconds")
+    _log_throughput(parse_rsync_stats(stats_lines, end_time - start_time))
 
     return return_code
+
+
+async def arun_rsync(rsync_command: List[str]) -> int:
+    """
+    Asyncio version of `run_rsync`. If the calling task is cancelled, rsync is
+    terminated before the cancellation propagates.
+    """
+    logging.info(f"Running {rsync_command}")
+    start_time = time.perf_counter()
+
+    process = await asyncio.create_subprocess_exec(
+        *rsync_command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+
+    stats_lines = []
+
+    async def log_stream(stream: Optional[asyncio.StreamReader], level: int) -> None:
+        if stream is None:
+            return
+        async for raw_line in stream:
+            line = raw_line.decode(errors="replace")
+            logging.log(level, f"RSYNC: {line.rstrip()}")
+            if _is_stats_line(line):
+                stats_lines.append(line)
+
+    try:
+        await asyncio.gather(log_stream(process.stdout, logging.INFO), log_stream(process.stderr, logging.ERROR))
+        return_code = await process.wait()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            logging.fatal(f"Terminating rsync (pid {process.pid})")
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=RSYNC_TERMINATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        raise
+
+    end_time = time.perf_counter()
+    logging.info(f"Time elapsed {end_time - start_time} seconds")
+    _log_throughput(parse_rsync_stats(stats_lines, end_time - start_time))
+
+    return return_code
+
+
+def parse_rsync_stats(lines: Iterable[str], seconds: float) -> RsyncStats:
+    """:returns: The numbers in the `--info=stats3` summary of rsync, missing ones are 0"""
+    values: Dict[str, int] = {}
+    for line in lines:
+        label, _, value = line.partition(":")
+        field = RSYNC_STATS_FIELDS.get(label.strip())
+        number = value.split()[0].replace(",", "") if value.split() else ""
+        if field is not None and number.isdigit():
+            values[field] = int(number)
+    return RsyncStats(seconds=seconds, **values)
+
+
+def _is_stats_line(line: str) -> bool:
+    return line.partition(":")[0].strip() in RSYNC_STATS_FIELDS
+
+
+def _log_throughput(stats: RsyncStats) -> None:
+    logging.info(
+        f"Throughput: {stats.files_transferred} files, {stats.transferred_file_bytes} bytes updated "
+        f"({stats.file_bytes_per_second / 1e6:.2f} MB/s), {stats.sent_bytes + stats.received_bytes} bytes on the wire "
+        f"({stats.wire_bytes_per_second / 1e6:.2f} MB/s)"
+    )
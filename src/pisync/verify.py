@@ -0,0 +1,116 @@
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+from pisync.config.base_config import BaseConfig
+from pisync.jobs import run_job
+from pisync.jobs import verify as verify_job
+from pisync.util import get_cache_dir
+
+SOURCE_HASH_STORE = "source-hashes.sqlite3"
+
+
+class VerifyReport(NamedTuple):
+    snapshots: int
+    # snapshots that were verified before and not walked again
+    skipped: int
+    files: int
+    inodes: int
+    hashed: int
+    bytes: int
+    corrupt: List[str]
+    errors: List[str]
+
+
+def verify(
+    config: BaseConfig, snapshots: Optional[List[str]] = None, *, full: bool = False, workers: int = 0
+) -> VerifyReport:
+    """
+    Hash the inodes in `snapshots` (default: the ones not verified before)
+    that were not seen by a previous verification and record their digests
+    next to `config.destination_dir`. With `full`, every snapshot is walked and
+    every inode is hashed again and reported as corrupt if its content no
+    longer matches the recorded digest. Large files in the chunk store are
+    verified by hashing their chunks.
+
+    For a `RemoteConfig`, the hashing runs as a single job on the remote
+    machine.
+    """
+    args = [config.destination_dir, "--workers", str(workers)]
+    for snapshot in snapshots or []:
+        args.extend(["--snapshot", snapshot])
+    if full:
+        args.append("--full")
+
+    corrupt = []
+    errors = []
+    summary: Dict = {}
+    for event in run_job(config, verify_job, args):
+        if event["event"] == "corrupt":
+            logging.error(f"Corrupt file {event['path']}: expected {event['expected']}, got {event['actual']}")
+            corrupt.append(event["path"])
+        elif event["event"] == "error":
+            logging.error(f"Could not hash {event['path']}: {event['error']}")
+            errors.append(event["path"])
+        elif event["event"] == "summary":
+            summary = event
+    return VerifyReport(
+        snapshots=summary["snapshots"],
+        skipped=summary["skipped"],
+        files=summary["files"],
+        inodes=summary["inodes"],
+        hashed=summary["hashed"],
+        bytes=summary["bytes"],
+        corrupt=corrupt,
+        errors=errors,
+    )
+
+
+def verify_against_source(config: BaseConfig, snapshot: Optional[str] = None, workers: int = 0) -> List[str]:
+    """
+    Compare the content of the files in `snapshot` (default: latest) with
+    `config.source_dir`, or every source of a config with several. Only files
+    whose size and modification time did not change since the backup are
+    compared, since `--archive` preserves both.
+
+    :returns: The paths relative to the source directory (to the root
+    directory with several sources) that differ
+    """
+    if snapshot is None:
+        snapshot = os.path.basename(config.resolve(config.link_dir))
+    if config.sources:
+        relative_paths = [os.path.relpath(path, config.source_dir) for path in config.source_paths()]
+        trees = [
+            (path, f"{snapshot}/{relative}", f"{relative}/")
+            for path, relative in zip(config.source_paths(), relative_paths)
+        ]
+    else:
+        source_dir = str(config.source_dir)
+        tree = snapshot if source_dir.endswith("/") else f"{snapshot}/{os.path.basename(source_dir)}"
+        trees = [(source_dir, tree, "")]
+
+    differ: List[str] = []
+    for source_dir, tree, prefix in trees:
+        differ.extend(f"{prefix}{path}" for path in _compare_tree(config, source_dir, tree, workers))
+    return differ
+
+
+def _compare_tree(config: BaseConfig, source_dir: str, tree: str, workers: int) -> List[str]:
+    """:returns: The paths relative to `source_dir` whose content differs from `tree` in the destination"""
+    source_files = {}
+    store_path = str(get_cache_dir() / SOURCE_HASH_STORE)
+    for event in verify_job.hash_tree(source_dir, store_path, workers):
+        if event["event"] == "file":
+            source_files[event["path"]] = event
+
+    differ = []
+    for event in run_job(config, verify_job, [config.destination_dir, "--tree", tree, "--workers", str(workers)]):
+        if event["event"] != "file":
+            continue
+        source = source_files.get(event["path"])
+        if source is None or (source["size"], source["mtime_ns"]) != (event["size"], event["mtime_ns"]):
+            continue
+        if source["digest"] != event["digest"]:
+            logging.error(f"{event['path']} differs between {source_dir} and {tree}")
+            differ.append(event["path"])
+    return differ
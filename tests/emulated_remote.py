@@ -0,0 +1,109 @@
+"""
+A `CommandRunner` that emulates a remote machine by running the commands of a
+`RemoteConfig` locally, with optional latency and bandwidth limits, and
+records every call so tests can assert how many round trips an operation
+takes.
+"""
+
+import subprocess
+import tempfile
+import time
+from typing import List, NamedTuple, Optional, TextIO, Union
+
+from pisync.config.runner import CommandResult, CommandRunner, CommandStream
+
+
+class RecordedCall(NamedTuple):
+    phase: str
+    command: str
+    seconds: float
+
+
+# invoke reads the output of a command in pieces of this size, and writes and
+# flushes each one to out_stream as it arrives
+INVOKE_READ_SIZE = 1000
+
+
+class EmulatedRemote(CommandRunner):
+    def __init__(self, latency: float = 0.0, bandwidth: Optional[float] = None, read_size: int = INVOKE_READ_SIZE):
+        """
+        :param latency: Seconds added to every call
+        :param bandwidth: Bytes per second for the command and its output
+        :param read_size: Characters of output written to out_stream at a time
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.read_size = read_size
+        self.phase = "setup"
+        self.calls: List[RecordedCall] = []
+
+    def run(
+        self,
+        command: str,
+        *,
+        warn: bool = False,
+        hide: Union[bool, str, None] = None,  # noqa: ARG002
+        out_stream: Optional[TextIO] = None,
+    ) -> CommandResult:
+        start_time = time.perf_counter()
+        time.sleep(self.latency)
+        process = subprocess.run(command, shell=True, capture_output=True, text=True, check=False)  # noqa: S602
+        if self.bandwidth is not None:
+            time.sleep((len(command) + len(process.stdout) + len(process.stderr)) / self.bandwidth)
+        if out_stream is not None:
+            for start in range(0, len(process.stdout), self.read_size):
+                out_stream.write(process.stdout[start : start + self.read_size])
+                out_stream.flush()
+        self.calls.append(RecordedCall(self.phase, command, time.perf_counter() - start_time))
+
+        if not warn and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, process.stdout, process.stderr)
+        return CommandResult(process.stdout, process.stderr, process.returncode)
+
+    def start(self, command: str) -> CommandStream:
+        time.sleep(self.latency)
+        self.calls.append(RecordedCall(self.phase, command, self.latency))
+        return PopenStream(command)
+
+    def round_trips(self, phase: str) -> int:
+        return sum(1 for call in self.calls if call.phase == phase)
+
+    def commands(self, phase: str) -> List[str]:
+        return [call.command for call in self.calls if call.phase == phase]
+
+
+class PopenStream(CommandStream):
+    """A command started with `EmulatedRemote.start`, running in a local shell"""
+
+    def __init__(self, command: str):
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(  # noqa: S602
+            command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr
+        )
+
+    def write(self, data: bytes) -> None:
+        if self.process.stdin is not None:
+            self.process.stdin.write(data)
+
+    def close_stdin(self) -> None:
+        if self.process.stdin is not None:
+            self.process.stdin.close()
+
+    def read(self, size: int) -> bytes:
+        return b"" if self.process.stdout is None else self.process.stdout.read1(size)  # type: ignore[attr-defined]
+
+    def wait(self) -> int:
+        return self.process.wait()
+
+    def stderr(self) -> str:
+        self._stderr.seek(0)
+        return self._stderr.read().decode(errors="replace")
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            if pipe is not None:
+                pipe.close()
+        self._stderr.close()
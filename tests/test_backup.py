@@ -1,6 +1,10 @@
+import asyncio
 import getpass
 import os
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
 from pathlib import Path
 from time import sleep
@@ -9,7 +13,9 @@ from unittest.mock import Mock, patch
 import pytest
 
 from pisync.config import LocalConfig, RemoteConfig
-from pisync.util import BackupFailedError, backup, run_rsync
+from pisync.config.base_config import LOCK_FILE, STATE_DIR
+from pisync.config.filters import CACHEDIR_TAG, CACHEDIR_TAG_SIGNATURE
+from pisync.util import BackupFailedError, _seed_backup, abackup, abackup_many, arun_rsync, backup, run_rsync
 
 
 @pytest.fixture
@@ -29,6 +35,26 @@ class RunRsyncTests(unittest.TestCase):
         self.assertNotEqual(exit_code, 0)
 
 
+class ArunRsyncTests(unittest.TestCase):
+    def test_fake_command_exit_zero(self):
+        exit_code = asyncio.run(arun_rsync(["ls", "-al"]))
+        self.assertEqual(exit_code, 0)
+
+    def test_fake_command_exit_non_zero(self):
+        exit_code = asyncio.run(arun_rsync(["ls", "-z"]))
+        self.assertNotEqual(exit_code, 0)
+
+    def test_cancel_terminates_process(self):
+        async def run_and_cancel():
+            task = asyncio.ensure_future(arun_rsync(["sleep", "60"]))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run_and_cancel())
+
+
 class BackupTests(unittest.TestCase):
     def setUp(self):
         self.src_dir = tempfile.TemporaryDirectory()
@@ -133,3 +159,199 @@ def test_remote_backup_rsync_fails_removes_previous_failed_backup(tmp_path, user
     with pytest.raises(BackupFailedError):
         backup(config)
         assert config.rmtree.called is True
+
+
+async def _sleep_forever(_rsync_command):
+    await asyncio.sleep(3600)
+
+
+@patch("pisync.util.arun_rsync", _sleep_forever)
+def test_cancelled_async_backup_removes_partial_backup(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    source_dir.mkdir()
+    dest_dir.mkdir()
+
+    config = LocalConfig(source_dir, dest_dir)
+    config.rmtree = Mock()
+    config.file_exists = Mock(return_value=True)
+
+    async def run_and_cancel():
+        task = asyncio.ensure_future(abackup(config))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run_and_cancel())
+    assert config.rmtree.called is True
+
+
+def test_abackup_many_limits_concurrency(tmp_path):
+    running = 0
+    max_running = 0
+
+    async def fake_arun_rsync(_rsync_command):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.1)
+        running -= 1
+        return 0
+
+    configs = []
+    for i in range(6):
+        source_dir = tmp_path / f"source{i}"
+        dest_dir = tmp_path / f"dest{i}"
+        source_dir.mkdir()
+        dest_dir.mkdir()
+        configs.append(LocalConfig(source_dir, dest_dir))
+
+    with patch("pisync.util.arun_rsync", fake_arun_rsync):
+        results = asyncio.run(abackup_many(configs, max_concurrency=2))
+
+    assert max_running == 2
+    for config, result in zip(configs, results):
+        assert result == str(Path(config.link_dir).resolve())
+
+
+def test_abackup_builds_rsync_command_off_the_event_loop(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    source_dir.mkdir()
+    dest_dir.mkdir()
+    config = LocalConfig(source_dir, dest_dir)
+    threads = []
+    get_rsync_command = config.get_rsync_command
+
+    def record_thread(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return get_rsync_command(*args, **kwargs)
+
+    config.get_rsync_command = record_thread  # type: ignore[method-assign]
+
+    async def fake_arun_rsync(_rsync_command):
+        return 0
+
+    with patch("pisync.util.arun_rsync", fake_arun_rsync):
+        asyncio.run(abackup(config))
+
+    assert threads
+    assert threading.main_thread() not in threads
+
+
+HOLD_LOCK = """
+import fcntl, sys
+with open(sys.argv[1], "a") as lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    print("locked", flush=True)
+    sys.stdin.read()
+"""
+
+
+@patch("pisync.util.run_rsync", Mock(return_value=0))
+def test_destination_locked_by_another_process(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    source_dir.mkdir()
+    (dest_dir / STATE_DIR).mkdir(parents=True)
+    config = LocalConfig(source_dir, dest_dir)
+
+    holder = subprocess.Popen(
+        [sys.executable, "-c", HOLD_LOCK, str(dest_dir / STATE_DIR / LOCK_FILE)],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert holder.stdout is not None
+        assert holder.stdout.readline() == "locked\n"
+        with pytest.raises(BackupFailedError, match="Another backup"):
+            asyncio.run(abackup(config))
+        assert os.listdir(dest_dir) == [STATE_DIR]
+    finally:
+        holder.communicate()
+
+    # a first backup, the state directory does not count as a previous one
+    assert backup(config) == str(Path(config.link_dir).resolve())
+
+
+@pytest.mark.parametrize("seed_compression", [None, "gzip"])
+def test_complete_backup_is_seeded_with_tar_stream(tmp_path, seed_compression):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    (source_dir / "dir").mkdir(parents=True)
+    dest_dir.mkdir()
+    (source_dir / "dir" / "file.txt").write_text("hello")
+
+    config = LocalConfig(f"{source_dir}/", str(dest_dir), seed=True, seed_compression=seed_compression)
+    with patch("pisync.util.run_rsync", Mock(return_value=0)) as run_rsync_mock:
+        latest_backup_path = backup(config)
+
+    assert (Path(latest_backup_path) / "dir" / "file.txt").read_text() == "hello"
+    rsync_command = run_rsync_mock.call_args[0][0]
+    assert "--delete-excluded" in rsync_command
+    assert not any(argument.startswith("--link-dest") for argument in rsync_command)
+
+
+def test_seed_leaves_out_excluded_files(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    for directory in ("node_modules/pkg", "build", "src"):
+        (source_dir / directory).mkdir(parents=True)
+        (source_dir / directory / "file").write_text(directory)
+    (source_dir / "build" / CACHEDIR_TAG).write_bytes(CACHEDIR_TAG_SIGNATURE)
+    dest_dir.mkdir()
+
+    config = LocalConfig(
+        f"{source_dir}/", str(dest_dir), ["node_modules/"], log_file=str(tmp_path / "log"), exclude_caches=True
+    )
+    snapshot = dest_dir / "2023-07-14-17-24-23"
+    _seed_backup(config, str(snapshot))
+
+    assert sorted(str(path.relative_to(snapshot)) for path in snapshot.rglob("*")) == ["src", "src/file"]
+
+
+def test_cancelled_seed_kills_tar_and_removes_partial_backup(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    source_dir.mkdir()
+    dest_dir.mkdir()
+    (source_dir / "large").write_bytes(os.urandom(10 << 20))
+    config = LocalConfig(f"{source_dir}/", str(dest_dir), log_file=str(tmp_path / "log"), seed=True)
+
+    def slow_write_tar(directory, archive, *, compression=None):  # noqa: ARG001
+        os.makedirs(directory)
+        for _ in iter(lambda: archive.read(4096), b""):
+            sleep(0.01)
+
+    config.write_tar = slow_write_tar  # type: ignore[method-assign]
+
+    async def run_and_cancel():
+        task = asyncio.ensure_future(abackup(config))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(run_and_cancel())
+    assert os.listdir(dest_dir) == [STATE_DIR]
+
+
+def test_seed_removes_partial_backup_on_any_error(tmp_path):
+    source_dir = tmp_path / "source"
+    dest_dir = tmp_path / "dest"
+    source_dir.mkdir()
+    dest_dir.mkdir()
+    (source_dir / "file").write_text("file")
+    config = LocalConfig(f"{source_dir}/", str(dest_dir), log_file=str(tmp_path / "log"))
+
+    def failing_write_tar(directory, archive, *, compression=None):  # noqa: ARG001
+        os.makedirs(directory)
+        msg = "connection lost"
+        raise OSError(msg)
+
+    config.write_tar = failing_write_tar  # type: ignore[method-assign]
+    with pytest.raises(OSError, match="connection lost"):
+        _seed_backup(config, str(dest_dir / "2023-07-14-17-24-23"))
+    assert list(dest_dir.iterdir()) == []
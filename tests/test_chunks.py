@@ -0,0 +1,163 @@
+import hashlib
+import io
+import os
+import shutil
+
+import pytest
+
+import pisync.chunks
+from pisync.chunks import CHUNK_AVERAGE_SIZE, CHUNK_MAX_SIZE, CHUNK_MIN_SIZE, iter_chunks, store_large_files
+from pisync.cli import main
+from pisync.config import BackupType, LocalConfig
+from pisync.diff import diff_snapshots
+from pisync.restore import restore
+from pisync.space import snapshot_space
+from pisync.verify import verify
+
+THRESHOLD = 1024 * 1024
+
+
+def _random_bytes(size):
+    return hashlib.shake_256(b"pisync").digest(size)
+
+
+def test_chunks_are_content_defined(tmp_path):
+    fastcdc = pytest.importorskip("fastcdc.fastcdc_cy")
+    # larger than a window, the chunks match those of the whole file
+    data = _random_bytes(pisync.chunks.CHUNK_WINDOW_SIZE + 6 * 1024 * 1024)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+    with open(path, "rb") as f:
+        chunks = list(iter_chunks(f))
+    assert b"".join(chunks) == data
+    assert all(CHUNK_MIN_SIZE <= len(chunk) <= CHUNK_MAX_SIZE for chunk in chunks[:-1])
+    whole = fastcdc.fastcdc_cy(
+        data, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVERAGE_SIZE, max_size=CHUNK_MAX_SIZE, fat=True
+    )
+    assert chunks == [bytes(chunk.data) for chunk in whole]
+
+    # inserting bytes only changes the chunk they are inserted into
+    path.write_bytes(data[:1000] + b"inserted" + data[1000:])
+    with open(path, "rb") as f:
+        shifted = list(iter_chunks(f))
+    assert len(set(chunks) - set(shifted)) == 1
+
+    path.write_bytes(b"")
+    with open(path, "rb") as f:
+        assert list(iter_chunks(f)) == []
+
+
+def test_fixed_size_chunks_without_fastcdc(monkeypatch):
+    monkeypatch.setattr(pisync.chunks, "fastcdc_cy", None)
+    data = _random_bytes(3 * CHUNK_AVERAGE_SIZE + 1000)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    assert b"".join(chunks) == data
+    assert [len(chunk) for chunk in chunks] == [CHUNK_AVERAGE_SIZE] * 3 + [1000]
+
+
+def _snapshot(config, name):
+    path = os.path.join(config.destination_dir, name)
+    os.makedirs(path)
+    return path
+
+
+def test_large_files_are_stored_once(tmp_path):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    original = _random_bytes(8 * 1024 * 1024)
+    image = bytearray(original)
+    (source / "image").write_bytes(image)
+    (source / "small").write_bytes(b"small")
+    config = LocalConfig(str(source), str(destination), chunk_threshold=THRESHOLD)
+
+    rsync_command = config.get_rsync_command(str(destination / "new"), backup_method=BackupType.Complete)
+    assert f"--max-size={THRESHOLD}" in rsync_command
+
+    first = store_large_files(config, _snapshot(config, "2023-01-01-00-00-00"))
+    assert (first.files, first.bytes) == (1, len(image))
+    assert first.new_chunks == first.chunks
+    assert first.chunked_bytes == len(image)
+
+    # change a few bytes in place, like a VM image or database file
+    image[2_000_000:2_000_010] = b"x" * 10
+    (source / "image").write_bytes(image)
+    second = store_large_files(config, _snapshot(config, "2023-01-02-00-00-00"))
+    assert second.new_chunks == 1
+    assert second.new_bytes <= CHUNK_MAX_SIZE
+    assert second.logical_bytes == 2 * len(image)
+    assert second.dedup_ratio > 1.5
+
+    # unchanged files are not chunked again
+    third = store_large_files(config, _snapshot(config, "2023-01-03-00-00-00"))
+    assert third.new_chunks == 0
+    assert third.chunked_bytes == 0
+
+    assert main(["assemble", str(destination), "--snapshot", "2023-01-01-00-00-00"]) == 0
+    assert (destination / "2023-01-01-00-00-00" / "source" / "image").read_bytes() == original
+
+    # chunks only the deleted snapshots referenced are removed by the next backup
+    shutil.rmtree(destination / "2023-01-01-00-00-00")
+    shutil.rmtree(destination / "2023-01-02-00-00-00")
+    fourth = store_large_files(config, _snapshot(config, "2023-01-04-00-00-00"))
+    assert fourth.logical_bytes == 2 * len(image)
+    assert fourth.store_bytes == len(image)
+    assert os.listdir(destination / ".pisync" / "manifests") != []
+
+
+def test_files_changed_while_chunked_are_chunked_again(tmp_path, monkeypatch, caplog):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    (source / "image").write_bytes(_random_bytes(3 * 1024 * 1024))
+    changed = b"changed" * 500_000
+    chunk_file = pisync.chunks.chunk_file
+
+    def chunk_and_change(path):
+        chunks = chunk_file(path)
+        with open(path, "wb") as f:
+            f.write(changed)
+        return chunks
+
+    monkeypatch.setattr(pisync.chunks, "chunk_file", chunk_and_change)
+    config = LocalConfig(str(source), str(destination), chunk_threshold=THRESHOLD)
+    report = store_large_files(config, _snapshot(config, "2023-01-01-00-00-00"))
+    assert "changed while it was chunked, chunking it again" in caplog.text
+    assert (report.files, report.bytes) == (1, len(changed))
+
+    assert main(["assemble", str(destination), "--snapshot", "2023-01-01-00-00-00"]) == 0
+    assert (destination / "2023-01-01-00-00-00" / "source" / "image").read_bytes() == changed
+
+
+def test_chunked_files_in_other_commands(tmp_path, caplog):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    image = bytearray(_random_bytes(3 * 1024 * 1024))
+    (source / "image").write_bytes(image)
+    config = LocalConfig(str(source), str(destination), chunk_threshold=THRESHOLD)
+    old = _snapshot(config, "2023-01-01-00-00-00")
+    store_large_files(config, old)
+    image[:10] = b"x" * 10
+    (source / "image").write_bytes(image)
+    new = _snapshot(config, "2023-01-02-00-00-00")
+    store_large_files(config, new)
+
+    assert list(diff_snapshots(config, os.path.basename(old), os.path.basename(new))) == [("modified", "source/image")]
+
+    report = verify(config)
+    assert (report.files, report.corrupt, report.errors) == (2, [], [])
+    chunk = next((destination / ".pisync" / "chunks").glob("*/*"))
+    chunk.write_bytes(b"bit rot")
+    assert verify(config, full=True).corrupt == [f".pisync/chunks/{chunk.parent.name}/{chunk.name}"]
+
+    (destination / "2023-01-02-00-00-00" / "small").write_text("small")
+    restore(config, str(tmp_path / "target"), snapshot="2023-01-02-00-00-00")
+    assert "run pisync assemble first: source/image" in caplog.text
+
+    (destination / "latest").symlink_to(new)
+    snapshot_space(config)
+    assert f"1 chunked files ({len(image)} bytes) of snapshot 2023-01-02-00-00-00" in caplog.text
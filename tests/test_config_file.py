@@ -0,0 +1,98 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from pisync.cli import main
+from pisync.config import InvalidPathError, LocalConfig, RemoteConfig
+from pisync.config.config_file import ConfigFileError, load_config_file
+from pisync.util import backup
+
+EXAMPLE_CONFIG_FILE = Path(__file__).parent.parent / "examples" / "pisync.toml"
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / "pisync.toml"
+    path.write_text(f"""
+[defaults]
+log_file = "{tmp_path}/backups.log"
+exclude_caches = true
+
+[[backup]]
+name = "local"
+source_dir = "{tmp_path}"
+destination_dir = "/does/not/exist"
+exclude_file_patterns = ["*.bak"]
+
+[[backup]]
+name = "remote"
+host = "user@example.invalid"
+source_dir = "{tmp_path}"
+destination_dir = "/does/not/exist/either"
+exclude_caches = false
+""")
+    return path
+
+
+def test_load_config_file(config_file, tmp_path):
+    configs = load_config_file(str(config_file))
+    assert list(configs) == ["local", "remote"]
+
+    local = configs["local"]
+    assert isinstance(local, LocalConfig)
+    assert local.exclude_file_patterns == ["*.bak"]
+    assert local.log_file == f"{tmp_path}/backups.log"
+    assert local.filters.exclude_caches is True
+
+    remote = configs["remote"]
+    assert isinstance(remote, RemoteConfig)
+    assert remote.user_at_hostname == "user@example.invalid"
+    assert remote.filters.exclude_caches is False
+
+
+def test_paths_are_checked_when_backup_runs(config_file):
+    config = load_config_file(str(config_file))["local"]
+    with pytest.raises(InvalidPathError):
+        backup(config)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        '[[backup]]\nsource_dir = "/"\ndestination_dir = "/"',
+        '[[backup]]\nname = "a"\nsource_dir = "/"',
+        '[[backup]]\nname = "a"\nsource_dir = "/"\ndestination_dir = "/"\ncolour = "blue"',
+        (
+            '[[backup]]\nname = "a"\nsource_dir = "/"\ndestination_dir = "/"\n'
+            '[[backup]]\nname = "a"\nsource_dir = "/"\ndestination_dir = "/"'
+        ),
+        "[backups]",
+        "not toml",
+    ],
+)
+def test_invalid_config_file(tmp_path, content):
+    path = tmp_path / "pisync.toml"
+    path.write_text(content)
+    with pytest.raises(ConfigFileError):
+        load_config_file(str(path))
+
+
+def test_example_config_file_is_valid():
+    assert len(load_config_file(str(EXAMPLE_CONFIG_FILE))) == 3
+
+
+def test_list_and_validate_cli(config_file, capsys):
+    assert main(["list", "-c", str(config_file)]) == 0
+    assert capsys.readouterr().out.splitlines()[1].startswith("remote\t")
+
+    assert main(["validate", "-c", str(config_file), "local"]) == 0
+    assert main(["validate", "-c", str(config_file), "--check-paths", "local"]) == 1
+    assert main(["validate", "-c", str(config_file), "missing"]) == 2
+
+
+def test_local_backups_do_not_import_fabric():
+    code = "import sys, pisync, pisync.cli; pisync.LocalConfig, pisync.backup; print('fabric' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False"
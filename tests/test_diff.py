@@ -0,0 +1,70 @@
+import os
+import shutil
+
+import pytest
+
+from pisync.cli import main
+from pisync.config import LocalConfig
+from pisync.config.base_config import ScriptFailedError
+from pisync.diff import diff_snapshots
+
+
+def make_snapshots(destination):
+    old = destination / "2023-01-01-00-00-00"
+    new = destination / "2023-01-02-00-00-00"
+    (old / "dir" / "gone").mkdir(parents=True)
+    (old / "dir" / "gone" / "file").write_text("gone")
+    (old / "unchanged").write_text("same")
+    (old / "modified").write_text("old")
+    (old / "removed").write_text("removed")
+    (old / "became_dir").write_text("file")
+
+    (new / "dir" / "added").mkdir(parents=True)
+    (new / "dir" / "added" / "file").write_text("added")
+    os.link(old / "unchanged", new / "unchanged")
+    shutil.copy2(old / "modified", new / "modified")
+    (new / "became_dir").mkdir()
+    return old.name, new.name
+
+
+def test_diff_snapshots(tmp_path):
+    old, new = make_snapshots(tmp_path)
+    config = LocalConfig(str(tmp_path), str(tmp_path))
+
+    assert list(diff_snapshots(config, old, new)) == [
+        ("removed", "became_dir"),
+        ("added", "became_dir"),
+        ("modified", "modified"),
+        ("removed", "removed"),
+        ("added", "dir/added"),
+        ("added", "dir/added/file"),
+        ("removed", "dir/gone"),
+        ("removed", "dir/gone/file"),
+    ]
+
+
+def test_diff_snapshots_include_unchanged(tmp_path):
+    old, new = make_snapshots(tmp_path)
+    config = LocalConfig(str(tmp_path), str(tmp_path))
+
+    diff = list(diff_snapshots(config, old, new, include_unchanged=True))
+    assert ("unchanged", "unchanged") in diff
+    assert ("unchanged", "modified") not in diff
+
+
+def test_diff_cli(tmp_path, capsys):
+    old, new = make_snapshots(tmp_path)
+    (tmp_path / "latest").symlink_to(tmp_path / new)
+
+    assert main(["diff", str(tmp_path), old]) == 0
+    assert capsys.readouterr().out.splitlines()[:3] == ["R became_dir", "A became_dir", "M modified"]
+
+
+def test_diff_missing_snapshot(tmp_path, capsys):
+    old, _ = make_snapshots(tmp_path)
+    config = LocalConfig(str(tmp_path), str(tmp_path))
+
+    with pytest.raises(ScriptFailedError, match="2023-01-03-00-00-00 is not a snapshot directory"):
+        list(diff_snapshots(config, old, "2023-01-03-00-00-00"))
+    assert main(["diff", str(tmp_path), "2022-12-31-00-00-00", old]) == 1
+    assert "2022-12-31-00-00-00 is not a snapshot directory" in capsys.readouterr().err
@@ -0,0 +1,113 @@
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from pisync.config import BackupType, FilterSet, LocalConfig
+from pisync.config.filters import (
+    CACHEDIR_TAG,
+    CACHEDIR_TAG_SIGNATURE,
+    EXCLUDE_FILE_MAX_AGE,
+    normalize_patterns,
+    write_exclude_file,
+)
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "alice" / ".cache").mkdir(parents=True)
+    (source / "alice" / ".cache" / "blob").write_bytes(b"x" * 100)
+    (source / "alice" / "project" / "node_modules" / "pkg").mkdir(parents=True)
+    (source / "alice" / "project" / "node_modules" / "pkg" / "index.js").write_bytes(b"x" * 10)
+    (source / "alice" / "project" / "main.py").write_bytes(b"x" * 5)
+    (source / "alice" / "build").mkdir()
+    (source / "alice" / "build" / CACHEDIR_TAG).write_bytes(CACHEDIR_TAG_SIGNATURE + b"\n")
+    (source / "alice" / "build" / "out.o").write_bytes(b"x" * 1000)
+    (source / "alice" / "notes.txt").write_bytes(b"x" * 7)
+    (source / "alice" / "notes.bak").write_bytes(b"x" * 3)
+    return source
+
+
+class TestNormalizePatterns:
+    def test_deduplicates_and_strips_comments(self):
+        patterns = ["foo/", "  foo/ ", "# comment", "", "bar"]
+        assert normalize_patterns(patterns) == ["foo/", "bar"]
+
+    def test_collapses_slashes_and_double_stars(self):
+        assert normalize_patterns(["a//b", "**/**/c"]) == ["a/b", "**/c"]
+
+    def test_anchors_absolute_patterns_inside_source_with_trailing_slash(self):
+        assert normalize_patterns(["/home/*/.cache/"], "/home/") == ["/*/.cache/"]
+
+    def test_keeps_absolute_patterns_for_source_without_trailing_slash(self):
+        assert normalize_patterns(["/home/*/.cache/"], "/home") == ["/home/*/.cache/"]
+
+
+class TestFilterSet:
+    def test_no_patterns_no_arguments(self, source_tree):
+        assert FilterSet(str(source_tree)).rsync_arguments() == []
+
+    def test_ignore_file_is_merged_by_rsync(self, source_tree):
+        filters = FilterSet(str(source_tree), ignore_file_name=".pisyncignore")
+        assert filters.rsync_arguments() == ["--filter=dir-merge,- .pisyncignore"]
+
+    def test_exclude_from_file_is_reused(self, source_tree):
+        first = FilterSet(str(source_tree), ["a", "b"]).rsync_arguments()
+        second = FilterSet(str(source_tree), ["a", "b", "a"]).rsync_arguments()
+        assert first == second
+
+    def test_finds_cache_directories(self, source_tree):
+        filters = FilterSet(f"{source_tree}/", exclude_caches=True)
+        assert filters.find_cache_directories() == ["alice/build"]
+        exclude_from = filters.rsync_arguments()[0].split("=", 1)[1]
+        assert Path(exclude_from).read_text() == "/alice/build/\n"
+
+    def test_skips_excluded_and_nested_cache_directories(self, source_tree):
+        for directory in ("alice/build/nested", "alice/project/node_modules/pkg"):
+            (source_tree / directory).mkdir(exist_ok=True)
+            (source_tree / directory / CACHEDIR_TAG).write_bytes(CACHEDIR_TAG_SIGNATURE + b"\n")
+        (source_tree / "alice" / "notes" / CACHEDIR_TAG).mkdir(parents=True)
+        (source_tree / "alice" / "project" / CACHEDIR_TAG).write_bytes(b"not a cache directory")
+        filters = FilterSet(str(source_tree), ["node_modules/"], exclude_caches=True)
+        assert filters.find_cache_directories() == ["source/alice/build"]
+
+    def test_prune_report(self, source_tree):
+        patterns = ["**/node_modules/", f"{source_tree}/*/.cache/", "*.bak", "*.unused"]
+        filters = FilterSet(f"{source_tree}/", patterns, exclude_caches=True)
+        report = {stats.rule: (stats.files, stats.bytes) for stats in filters.prune_report()}
+        assert report == {
+            "/*/.cache/": (1, 100),
+            "**/node_modules/": (1, 10),
+            "*.bak": (1, 3),
+            CACHEDIR_TAG: (2, 1000 + len(CACHEDIR_TAG_SIGNATURE) + 1),
+        }
+
+    def test_prune_report_with_ignore_file(self, source_tree):
+        (source_tree / "alice" / ".pisyncignore").write_text("notes.txt\n/project/\n")
+        filters = FilterSet(f"{source_tree}/", ignore_file_name=".pisyncignore")
+        report = {stats.rule: (stats.files, stats.bytes) for stats in filters.prune_report()}
+        assert report == {
+            "alice/.pisyncignore: notes.txt": (1, 7),
+            "alice/.pisyncignore: /project/": (2, 15),
+        }
+
+
+def test_unused_exclude_files_are_removed():
+    old = Path(write_exclude_file(["old"]))
+    reused = Path(write_exclude_file(["reused"]))
+    long_ago = time.time() - EXCLUDE_FILE_MAX_AGE - 1
+    for path in (old, reused):
+        os.utime(path, (long_ago, long_ago))
+
+    assert write_exclude_file(["reused"]) == str(reused)
+    assert reused.exists()
+    assert not old.exists()
+
+
+def test_config_uses_filter_set(source_tree, tmp_path):
+    config = LocalConfig(str(source_tree), str(tmp_path), ["*.bak"], ignore_file_name=".pisyncignore")
+    rsync_cmd = config.get_rsync_command(str(tmp_path / "new"), backup_method=BackupType.Complete)
+    assert "--filter=dir-merge,- .pisyncignore" in rsync_cmd
+    assert any(argument.startswith("--exclude-from=") for argument in rsync_cmd)
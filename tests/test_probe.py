@@ -0,0 +1,127 @@
+import pytest
+
+import pisync.config.local_config
+from pisync.config import BackupType, LocalConfig
+from pisync.config.probe import choose_rsync_arguments, get_capabilities, parse_rsync_version
+
+RSYNC_3_2 = """\
+rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Web site: https://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, symlinks, symtimes, hardlinks, hardlink-specials,
+    hardlink-symlinks, IPv6, atimes, batchfiles, inplace, append, ACLs,
+    xattrs, optional secluded-args, iconv, prealloc, stop-at, no crtimes
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none
+Compress list:
+    zstd lz4 zlibx zlib none
+Daemon auth list:
+    sha512 sha256 sha1 md5 md4
+
+rsync comes with ABSOLUTELY NO WARRANTY.  This is free software, and you
+are welcome to redistribute it under certain conditions.
+"""
+
+RSYNC_3_1 = """\
+rsync  version 3.1.3  protocol version 31
+Copyright (C) 1996-2018 by Andrew Tridgell, Wayne Davison, and others.
+Web site: http://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, hardlinks, symlinks, IPv6, batchfiles, inplace,
+    append, ACLs, xattrs, iconv, symtimes, prealloc
+"""
+
+RSYNC_MACOS = """\
+rsync  version 2.6.9  protocol version 29
+Copyright (C) 1996-2006 by Andrew Tridgell, Wayne Davison, and others.
+<http://rsync.samba.org/>
+Capabilities: 64-bit files, socketpairs, hard links, symlinks, batchfiles,
+              inplace, IPv6, 64-bit system inums, 64-bit internal inums
+"""
+
+
+def test_parse_rsync_version():
+    capabilities = parse_rsync_version(RSYNC_3_2)
+    assert capabilities is not None
+    assert capabilities.version == (3, 2, 7)
+    assert capabilities.protocol == 31
+    assert capabilities.checksums == ["xxh128", "xxh3", "xxh64", "md5", "md4", "sha1", "none"]
+    assert capabilities.compressions == ["zstd", "lz4", "zlibx", "zlib", "none"]
+    assert capabilities.acls
+    assert capabilities.xattrs
+
+    old = parse_rsync_version(RSYNC_3_1)
+    assert old is not None
+    assert old.version == (3, 1, 3)
+    assert old.checksums == []
+    assert old.acls
+
+    macos = parse_rsync_version(RSYNC_MACOS)
+    assert macos is not None
+    assert not macos.acls
+    assert not macos.xattrs
+
+    assert parse_rsync_version("openrsync: protocol version 29") is None
+
+
+@pytest.mark.parametrize(
+    ("local", "remote", "expected"),
+    [
+        (RSYNC_3_2, None, ["--checksum-choice=xxh128"]),
+        (RSYNC_3_2, RSYNC_3_2, ["--checksum-choice=xxh128", "--compress", "--compress-choice=zstd"]),
+        (RSYNC_3_2, RSYNC_3_1, []),
+        (RSYNC_3_2, RSYNC_MACOS, []),
+    ],
+)
+def test_choose_rsync_arguments(local, remote, expected):
+    remote_capabilities = None if remote is None else parse_rsync_version(remote)
+    assert choose_rsync_arguments(parse_rsync_version(local), remote_capabilities) == expected
+
+
+@pytest.mark.parametrize(
+    ("remote", "expected"),
+    [(RSYNC_3_1, ["--acls", "--xattrs"]), (RSYNC_MACOS, [])],
+)
+def test_acls_and_xattrs_are_opt_in(remote, expected):
+    local = parse_rsync_version(RSYNC_3_2)
+    arguments = choose_rsync_arguments(local, parse_rsync_version(remote), preserve_acls_xattrs=True)
+    assert arguments == expected
+
+
+def test_probe_results_are_cached():
+    calls = []
+
+    def rsync_version():
+        calls.append(1)
+        return RSYNC_3_2
+
+    assert get_capabilities("user@host", rsync_version) == parse_rsync_version(RSYNC_3_2)
+    assert get_capabilities("user@host", rsync_version) == parse_rsync_version(RSYNC_3_2)
+    assert len(calls) == 1
+    get_capabilities("user@host", rsync_version, ttl=-1)
+    assert len(calls) == 2
+
+    # failed probes are retried
+    assert get_capabilities("user@other", lambda: None) is None
+    assert get_capabilities("user@other", rsync_version) is not None
+
+
+def test_probed_arguments_are_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(pisync.config.local_config, "local_capabilities", lambda: parse_rsync_version(RSYNC_3_2))
+    new_backup_dir = str(tmp_path / "new")
+
+    config = LocalConfig(str(tmp_path), str(tmp_path))
+    assert "--acls" not in config.get_rsync_command(new_backup_dir, backup_method=BackupType.Complete)
+
+    config = LocalConfig(str(tmp_path), str(tmp_path), probe_rsync=True)
+    rsync_command = config.get_rsync_command(new_backup_dir, backup_method=BackupType.Complete)
+    assert rsync_command[-3:] == ["--checksum-choice=xxh128", str(tmp_path), new_backup_dir]
+
+    config = LocalConfig(str(tmp_path), str(tmp_path), probe_rsync=True, preserve_acls_xattrs=True)
+    rsync_command = config.get_rsync_command(new_backup_dir, backup_method=BackupType.Complete)
+    assert rsync_command[-5:] == ["--checksum-choice=xxh128", "--acls", "--xattrs", str(tmp_path), new_backup_dir]
@@ -0,0 +1,162 @@
+import asyncio
+import getpass
+import os
+from collections import Counter
+
+import pytest
+
+import pisync.pull
+from pisync.config import BackupType, PullConfig
+from pisync.config.config_file import ConfigFileError, load_config_file
+from pisync.config.pull_config import parse_remote_source
+from pisync.config.resources import ResourcePolicy
+from pisync.pull import apull_many
+from pisync.util import backup
+
+
+def _pull_config(tmp_path, source, **kwargs):
+    return PullConfig(source, str(tmp_path), check_paths=False, **kwargs)
+
+
+def test_parse_remote_source():
+    assert parse_remote_source("ethan@laptop.local:/home/") == ("ethan@laptop.local", "/home/")
+    assert parse_remote_source("laptop:/") == ("laptop", "/")
+    for source in ("/home/", "laptop:home", "./a:/b"):
+        with pytest.raises(ValueError):
+            parse_remote_source(source)
+
+
+def test_rsync_command(tmp_path):
+    config = _pull_config(tmp_path, "ethan@laptop:/home/", exclude_file_patterns=["/home/ethan/.cache"])
+    new_backup_dir = str(tmp_path / "2023-07-14-17-24-23")
+
+    complete = config.get_rsync_command(new_backup_dir, BackupType.Complete)
+    assert complete[0] == "rsync"
+    assert complete[-2:] == ["ethan@laptop:/home/", new_backup_dir]
+    assert not any(argument.startswith(("--link-dest", "--rsh", "--bwlimit")) for argument in complete)
+    assert config.filters.patterns == ["/ethan/.cache"]
+
+    incremental = config.get_rsync_command(new_backup_dir, BackupType.Incremental)
+    assert f"--link-dest={tmp_path / 'latest'}" in incremental
+
+
+def test_rsync_command_with_limits(tmp_path):
+    config = _pull_config(
+        tmp_path,
+        "ethan@laptop:/home/",
+        resources=ResourcePolicy(nice=19),
+        bwlimit=2048,
+        ssh_control_path="/run/pisync/ssh/%C",
+    )
+    command = config.get_rsync_command(str(tmp_path / "new"), BackupType.Complete)
+    assert command[:4] == ["nice", "-n", "19", "rsync"]
+    assert "--rsync-path=nice -n 19 rsync" in command
+    assert "--bwlimit=2048" in command
+    assert "--rsh=ssh -o ControlMaster=auto -o ControlPath=/run/pisync/ssh/%C -o ControlPersist=10m" in command
+
+
+@pytest.mark.parametrize(("bwlimit", "expected"), [(2048, "--bwlimit=2048"), (10000, "--bwlimit=5m")])
+def test_rsync_command_uses_the_lower_bwlimit(tmp_path, bwlimit, expected):
+    # 5m is 5120 KiB per second
+    resources = ResourcePolicy(bwlimit_schedule={"00:00-24:00": "5m"})
+    config = _pull_config(tmp_path, "ethan@laptop:/home/", resources=resources, bwlimit=bwlimit)
+    command = config.get_rsync_command(str(tmp_path / "new"), BackupType.Complete)
+    assert [argument for argument in command if argument.startswith("--bwlimit")] == [expected]
+
+
+def test_pull_backups_share_unchanged_files(tmp_path):
+    source = tmp_path / "client"
+    destination = tmp_path / "server"
+    source.mkdir()
+    destination.mkdir()
+    (source / "file.txt").write_text("unchanged")
+    config = PullConfig(f"{getpass.getuser()}@localhost:{source}/", str(destination), log_file=str(tmp_path / "log"))
+
+    first = backup(config)
+    second = backup(config)
+
+    assert os.path.realpath(destination / "latest") == second
+    assert os.path.samefile(os.path.join(first, "file.txt"), os.path.join(second, "file.txt"))
+
+
+@pytest.fixture
+def fake_abackup(monkeypatch):
+    """Replace abackup with one that records how many pulls run at once"""
+    running: Counter = Counter()
+    peaks = {"total": 0, "per_client": 0}
+    bwlimits = {}
+
+    async def abackup(config):
+        running[config.client] += 1
+        peaks["total"] = max(peaks["total"], sum(running.values()))
+        peaks["per_client"] = max(peaks["per_client"], running[config.client])
+        bwlimits[config.source_dir] = config.bwlimit
+        await asyncio.sleep(0.01)
+        running[config.client] -= 1
+        if config.source_path == "/fail/":
+            msg = "rsync failed"
+            raise RuntimeError(msg)
+        return f"{config.destination_dir}/snapshot"
+
+    monkeypatch.setattr(pisync.pull, "abackup", abackup)
+    return peaks, bwlimits
+
+
+def test_apull_many_limits(tmp_path, fake_abackup):
+    peaks, bwlimits = fake_abackup
+    configs = [
+        _pull_config(tmp_path / f"{client}{path}", f"{client}:/{path}/", bwlimit=bwlimit)
+        for client, bwlimit in (("a", None), ("b", 100), ("c", None))
+        for path in ("home", "etc", "fail")
+    ]
+
+    results = asyncio.run(apull_many(configs, max_concurrency=2, max_per_client=1, bwlimit=1000, client_bwlimit=300))
+
+    assert peaks == {"total": 2, "per_client": 1}
+    assert results[0] == f"{tmp_path / 'ahome'}/snapshot"
+    assert isinstance(results[2], RuntimeError)
+    # the global limit is split between 2 slots, the client limit is lower
+    assert bwlimits["a:/home/"] == 300
+    assert bwlimits["b:/etc/"] == 100
+    # the configs themselves are not changed
+    assert configs[0].bwlimit is None
+
+
+def test_apull_many_splits_client_limit(tmp_path, fake_abackup):
+    peaks, bwlimits = fake_abackup
+    configs = [_pull_config(tmp_path / path, f"a:/{path}/") for path in ("home", "etc", "srv")]
+
+    asyncio.run(apull_many(configs, max_concurrency=4, max_per_client=2, client_bwlimit=300))
+
+    assert peaks == {"total": 2, "per_client": 2}
+    assert set(bwlimits.values()) == {150}
+
+
+def test_apull_many_splits_global_limit_between_pulls_that_can_run(tmp_path, fake_abackup):
+    peaks, bwlimits = fake_abackup
+    configs = [_pull_config(tmp_path / path, f"a:/{path}/") for path in ("home", "etc", "srv")]
+
+    # only one pull of the single client runs at a time, so it gets all of bwlimit
+    asyncio.run(apull_many(configs, max_concurrency=4, max_per_client=1, bwlimit=900))
+
+    assert peaks == {"total": 1, "per_client": 1}
+    assert set(bwlimits.values()) == {900}
+
+
+def test_config_file_pull(tmp_path):
+    path = tmp_path / "pisync.toml"
+    path.write_text(f"""
+[[backup]]
+name = "laptop"
+source_dir = "ethan@laptop:/home/"
+destination_dir = "{tmp_path}"
+bwlimit = 1024
+""")
+    config = load_config_file(str(path))["laptop"]
+    assert isinstance(config, PullConfig)
+    assert config.client == "ethan@laptop"
+    assert config.bwlimit == 1024
+
+    path.write_text(path.read_text() + "seed = true\n")
+    with pytest.raises(ConfigFileError):
+        load_config_file(str(path))
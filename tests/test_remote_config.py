@@ -83,13 +83,16 @@ class TestGetRsyncCommand:
 
         # For example: /tmp/2023-07-14-17-24-23
         assert new_backup_dir.startswith(str(tmp.parts[0]))
+        exclude_from = rsync_cmd[-3]
         assert rsync_cmd == [
             "rsync",
             *optionless_arguments,
-            *(f"--exclude={p}" for p in exclude_file_patterns),
+            exclude_from,
             home,
             f"{user_at_localhost}:{new_backup_dir}",
         ]
+        assert exclude_from.startswith("--exclude-from=")
+        assert Path(exclude_from.split("=", 1)[1]).read_text().splitlines() == exclude_file_patterns
 
 
 class TestPathOperations:
@@ -0,0 +1,163 @@
+import subprocess
+from datetime import datetime, timezone
+
+import pytest
+
+from pisync.config import BackupType, LocalConfig, RemoteConfig
+from pisync.config.config_file import ConfigFileError, load_config_file
+from pisync.config.resources import CGROUP_WRAPPER, ResourcePolicy, rate_in_kib
+from pisync.util import parse_rsync_stats
+
+STATS3_OUTPUT = """\
+Number of files: 1,204 (reg: 1,100, dir: 104)
+Number of created files: 12 (reg: 12)
+Number of deleted files: 0
+Number of regular files transferred: 17
+Total file size: 2,147,483,648 bytes
+Total transferred file size: 52,428,800 bytes
+Literal data: 1,048,576 bytes
+Matched data: 51,380,224 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1,150,000
+Total bytes received: 850,000
+
+sent 1,150,000 bytes  received 850,000 bytes  400,000.00 bytes/sec
+total size is 2,147,483,648  speedup is 1,073.74
+"""
+
+
+def _at(hour: int, minute: int = 0) -> datetime:
+    return datetime(2023, 7, 14, hour, minute, tzinfo=timezone.utc)
+
+
+def test_priority_command():
+    policy = ResourcePolicy(nice=10, ionice_class="idle")
+    assert policy.priority_command() == ["nice", "-n", "10", "ionice", "-c", "3"]
+    assert ResourcePolicy(ionice_class="best-effort", ionice_level=7).priority_command() == [
+        "ionice",
+        "-c",
+        "2",
+        "-n",
+        "7",
+    ]
+    assert ResourcePolicy().priority_command() == []
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"nice": 20},
+        {"ionice_class": "lowest"},
+        {"ionice_level": 8},
+        {"io_max": "8:0 rbps=1000"},
+        {"bwlimit_schedule": {"8-18": "5m"}},
+        {"bwlimit_schedule": {"08:00-08:00": "5m"}},
+        {"bwlimit_schedule": {"08:75-09:00": "5m"}},
+        {"bwlimit_schedule": {"08:00-09:00": "fast"}},
+    ],
+)
+def test_invalid_policy(kwargs):
+    with pytest.raises(ValueError):
+        ResourcePolicy(**kwargs)
+
+
+def test_bwlimit_schedule():
+    policy = ResourcePolicy(bwlimit_schedule={"08:00-18:00": "5m", "22:00-06:00": "50m"})
+    assert policy.bwlimit_at(_at(8)) == "5m"
+    assert policy.bwlimit_at(_at(17, 59)) == "5m"
+    assert policy.bwlimit_at(_at(18)) is None
+    assert policy.bwlimit_at(_at(23, 30)) == "50m"
+    assert policy.bwlimit_at(_at(3)) == "50m"
+    assert policy.bwlimit_at(_at(6)) is None
+    assert policy.rsync_arguments(remote=False, now=_at(12)) == ["--bwlimit=5m"]
+    assert policy.rsync_arguments(remote=False, now=_at(19)) == []
+    assert policy.rsync_arguments(remote=False, now=_at(12), bwlimit=100) == ["--bwlimit=100"]
+    assert policy.rsync_arguments(remote=False, now=_at(19), bwlimit=100) == ["--bwlimit=100"]
+
+
+def test_rate_in_kib():
+    assert rate_in_kib("300") == 300
+    assert rate_in_kib("5m") == 5 * 1024
+    assert rate_in_kib("1.5GiB") == 1.5 * 1024 * 1024
+    assert rate_in_kib("2kb") == 2000 / 1024
+
+
+def test_local_config_rsync_command(tmp_path):
+    policy = ResourcePolicy(nice=19, ionice_class="idle")
+    config = LocalConfig(str(tmp_path), str(tmp_path), resources=policy, check_paths=False)
+    command = config.get_rsync_command(str(tmp_path / "new"), BackupType.Complete)
+    assert command[: command.index("rsync")] == ["nice", "-n", "19", "ionice", "-c", "3"]
+    assert not any(argument.startswith("--rsync-path") for argument in command)
+
+
+def test_remote_config_runs_remote_rsync_with_priority(tmp_path):
+    policy = ResourcePolicy(nice=19, ionice_class="idle")
+    config = RemoteConfig("user@localhost", str(tmp_path), "/backups", resources=policy, check_paths=False)
+    command = config.get_rsync_command("/backups/new", BackupType.Complete)
+    assert "--rsync-path=nice -n 19 ionice -c 3 rsync" in command
+
+
+def test_cgroup_prefix(tmp_path):
+    parent = tmp_path / "cgroup"
+    cgroup = parent / "pisync"
+    cgroup.mkdir(parents=True)
+    (cgroup / "cgroup.controllers").write_text("cpu io memory\n")
+    policy = ResourcePolicy(nice=5, cgroup=str(cgroup), io_max="8:0 wbps=1048576", cpu_max="50000 100000")
+
+    # building the command has no side effects
+    assert policy.local_command_prefix() == ["sh", "-c", CGROUP_WRAPPER, str(cgroup), "nice", "-n", "5"]
+    assert not (cgroup / "io.max").exists()
+
+    assert policy.prepare_cgroup()
+    assert (cgroup / "io.max").read_text() == "8:0 wbps=1048576"
+    assert (cgroup / "cpu.max").read_text() == "50000 100000"
+    assert not (parent / "cgroup.subtree_control").exists()
+
+
+def test_cgroup_failure_runs_without_it(tmp_path):
+    # not a cgroup directory: there is no cgroup.controllers file
+    cgroup = tmp_path / "pisync"
+    policy = ResourcePolicy(cgroup=str(cgroup), cpu_max="50000 100000")
+    assert not policy.prepare_cgroup()
+
+    # cgroup.procs cannot be written to
+    (cgroup / "cgroup.procs").mkdir()
+    command = [*policy.local_command_prefix(), "echo", "rsync ran"]
+    process = subprocess.run(command, capture_output=True, text=True, check=False)
+    assert (process.returncode, process.stdout) == (0, "rsync ran\n")
+    assert "Could not move rsync into cgroup" in process.stderr
+
+
+def test_parse_rsync_stats():
+    stats = parse_rsync_stats(STATS3_OUTPUT.splitlines(), 5.0)
+    assert stats.files_transferred == 17
+    assert stats.total_file_bytes == 2_147_483_648
+    assert stats.transferred_file_bytes == 52_428_800
+    assert stats.literal_bytes == 1_048_576
+    assert stats.file_bytes_per_second == 52_428_800 / 5
+    assert stats.wire_bytes_per_second == 400_000
+    assert parse_rsync_stats([], 0.0).wire_bytes_per_second == 0.0
+
+
+def test_config_file_resources(tmp_path):
+    path = tmp_path / "pisync.toml"
+    path.write_text(f"""
+[[backup]]
+name = "home"
+source_dir = "{tmp_path}"
+destination_dir = "{tmp_path}"
+
+[backup.resources]
+nice = 19
+bwlimit_schedule = {{ "08:00-18:00" = "5m" }}
+""")
+    (config,) = load_config_file(str(path)).values()
+    assert config.resources is not None
+    assert config.resources.nice == 19
+    assert config.resources.bwlimit_schedule == {"08:00-18:00": "5m"}
+
+    path.write_text(path.read_text().replace("nice = 19", "nice = 99"))
+    with pytest.raises(ConfigFileError):
+        load_config_file(str(path))
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from pisync.cli import main
+from pisync.config import LocalConfig
+from pisync.jobs.restore import plan
+from pisync.restore import RestoreFailedError, restore
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    destination = tmp_path / "destination"
+    snapshot = destination / "2023-01-01-00-00-00"
+    for i in range(3):
+        directory = snapshot / f"dir{i}" / "sub"
+        directory.mkdir(parents=True)
+        for j in range(5):
+            (directory / f"file{j}.txt").write_text(f"{i} {j}" * (i + 1))
+    (snapshot / "big.bin").write_bytes(b"x" * 10000)
+    (snapshot / "link").symlink_to("big.bin")
+    os.chmod(snapshot / "dir1" / "sub" / "file0.txt", 0o600)
+    os.utime(snapshot / "dir2" / "sub", (1000000000, 1000000000))
+    (destination / "latest").symlink_to(snapshot)
+    return destination, snapshot
+
+
+def test_restore_whole_snapshot(snapshot, tmp_path):
+    destination, snapshot_dir = snapshot
+    target = tmp_path / "target"
+    config = LocalConfig(str(destination), str(destination))
+
+    report = restore(config, str(target), workers=3)
+
+    assert report.files == 17
+    restored = sorted(str(p.relative_to(target)) for p in target.rglob("*"))
+    expected = sorted(str(p.relative_to(snapshot_dir)) for p in snapshot_dir.rglob("*"))
+    assert restored == expected
+    assert (target / "link").is_symlink()
+    assert (target / "dir1" / "sub" / "file0.txt").stat().st_mode & 0o777 == 0o600
+    assert (target / "dir2" / "sub").stat().st_mtime == 1000000000
+
+
+def test_restore_selected_paths(snapshot, tmp_path):
+    destination, _ = snapshot
+    target = tmp_path / "target"
+    config = LocalConfig(str(destination), str(destination))
+
+    restore(config, str(target), "2023-01-01-00-00-00", ["dir1/*/file[12].txt"])
+
+    assert sorted(str(p.relative_to(target)) for p in target.rglob("*")) == [
+        "dir1",
+        "dir1/sub",
+        "dir1/sub/file1.txt",
+        "dir1/sub/file2.txt",
+    ]
+
+
+def test_flat_directory_is_split_into_batches(tmp_path):
+    flat = tmp_path / "flat"
+    flat.mkdir()
+    for i in range(1000):
+        (flat / f"file{i:04}").write_bytes(b"x" * 10)
+
+    units = list(plan(str(tmp_path), None, 4))
+
+    recursive = [unit for unit in units if unit["recursive"]]
+    assert len(recursive) == 17
+    assert all(unit["bytes"] <= 10000 // 16 for unit in recursive)
+    assert sorted(path for unit in recursive for path in unit["paths"]) == [f"flat/file{i:04}" for i in range(1000)]
+
+
+def test_restore_nothing_matches(snapshot, tmp_path):
+    destination, _ = snapshot
+    config = LocalConfig(str(destination), str(destination))
+    with pytest.raises(RestoreFailedError):
+        restore(config, str(tmp_path / "target"), patterns=["nothing*"])
+
+
+def test_restore_cli(snapshot, tmp_path, capsys):
+    destination, _ = snapshot
+    target = tmp_path / "target"
+    assert main(["restore", str(destination), str(target), "big.bin"]) == 0
+    assert (target / "big.bin").stat().st_size == 10000
+    assert capsys.readouterr().out.startswith("Restored 1 files")
@@ -0,0 +1,167 @@
+"""
+Round trip budgets of a remote `backup()`. Every remote command costs at least
+one network round trip, so these are a performance contract: raise a budget
+only together with a reason why the extra call cannot be avoided.
+"""
+
+import getpass
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import pisync.util
+from pisync.config import RemoteConfig
+from pisync.config.base_config import STATE_DIR, ScriptFailedError
+from pisync.util import BackupFailedError, backup
+from pisync.verify import verify
+
+from .emulated_remote import EmulatedRemote
+
+# (preflight, finalize) round trips. Preflight includes the stream that holds
+# the destination lock, which is needed for as long as the backup runs.
+COMPLETE_BACKUP_BUDGET = (3, 2)
+INCREMENTAL_BACKUP_BUDGET = (4, 3)
+FAILED_BACKUP_BUDGET = (3, 2)
+CHECK_PATHS_BUDGET = 1
+
+
+@pytest.fixture
+def remote():
+    return EmulatedRemote()
+
+
+@pytest.fixture
+def fake_rsync(monkeypatch, remote):
+    """
+    Replace rsync with a fake that only creates the new backup directory, and
+    switch the phase of the emulated remote from preflight to finalize.
+    """
+    exit_codes = []
+
+    def run_rsync(rsync_command):
+        remote.phase = "finalize"
+        destination = rsync_command[-1].split(":", 1)[1]
+        os.makedirs(destination)
+        return exit_codes.pop(0) if exit_codes else 0
+
+    monkeypatch.setattr(pisync.util, "run_rsync", run_rsync)
+    return exit_codes
+
+
+def _backup(config, remote):
+    remote.phase = "preflight"
+    result = backup(config)
+    remote.phase = "done"
+    return result
+
+
+def _assert_within_budget(remote, budget):
+    preflight, finalize = budget
+    assert remote.round_trips("preflight") <= preflight, remote.commands("preflight")
+    assert remote.round_trips("finalize") <= finalize, remote.commands("finalize")
+
+
+def _config(tmp_path, remote, **kwargs):
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    source.mkdir(exist_ok=True)
+    destination.mkdir(exist_ok=True)
+    return RemoteConfig(
+        f"{getpass.getuser()}@localhost",
+        str(source),
+        str(destination),
+        log_file=str(tmp_path / "backup.log"),
+        runner=remote,
+        **kwargs,
+    )
+
+
+def test_check_paths_budget(tmp_path, remote):
+    config = _config(tmp_path, remote)
+    assert remote.round_trips("setup") == CHECK_PATHS_BUDGET
+    config.check_paths()
+    assert remote.round_trips("setup") == CHECK_PATHS_BUDGET
+
+
+def test_complete_and_incremental_backup_budgets(tmp_path, remote, fake_rsync):
+    config = _config(tmp_path, remote)
+
+    first = _backup(config, remote)
+    _assert_within_budget(remote, COMPLETE_BACKUP_BUDGET)
+    assert Path(config.link_dir).resolve() == Path(first)
+
+    remote.calls.clear()
+    time.sleep(1)  # snapshot names have a resolution of one second
+    second = _backup(config, remote)
+    _assert_within_budget(remote, INCREMENTAL_BACKUP_BUDGET)
+    assert Path(config.link_dir).resolve() == Path(second)
+    assert fake_rsync == []
+
+
+def test_failed_backup_budget(tmp_path, remote, fake_rsync):
+    config = _config(tmp_path, remote)
+    fake_rsync.append(23)
+
+    with pytest.raises(BackupFailedError):
+        _backup(config, remote)
+    _assert_within_budget(remote, FAILED_BACKUP_BUDGET)
+    assert os.listdir(config.destination_dir) == [STATE_DIR]
+
+
+def test_scripts_are_one_round_trip(tmp_path, remote):
+    config = _config(tmp_path, remote, check_paths=False)
+    remote.phase = "verify"
+    # the emulated remote runs commands with the local python3
+    try:
+        verify(config)
+    except ScriptFailedError:
+        pytest.skip("python3 is not installed")
+    assert remote.round_trips("verify") == 1
+
+
+def test_script_lines_are_not_split_by_flushes(tmp_path):
+    config = _config(tmp_path, EmulatedRemote(read_size=100), check_paths=False)
+    script = "for i in range(50):\n    print(str(i) * 330)\nprint('no newline', end='')"
+    try:
+        lines = list(config.run_script(script, []))
+    except ScriptFailedError:
+        pytest.skip("python3 is not installed")
+    assert lines == [str(i) * 330 for i in range(50)] + ["no newline"]
+
+
+def test_tar_streams_are_recorded(tmp_path, remote):
+    config = _config(tmp_path, remote, check_paths=False)
+    (tmp_path / "source" / "file.txt").write_text("restore me")
+    archive = tmp_path / "archive.tar"
+    remote.phase = "streams"
+
+    with open(archive, "wb") as out:
+        config.read_tar(str(tmp_path / "source"), ["file.txt"], out)
+    with open(archive, "rb") as archive_file:
+        config.write_tar(str(tmp_path / "destination" / "restored"), archive_file)
+
+    assert (tmp_path / "destination" / "restored" / "file.txt").read_text() == "restore me"
+    assert [command.split()[:2] for command in remote.commands("streams")] == [["tar", "-c"], ["mkdir", "-p"]]
+
+
+def test_latency_is_added_to_every_call(tmp_path):
+    remote = EmulatedRemote(latency=0.05, bandwidth=10_000)
+    config = _config(tmp_path, remote, check_paths=False)
+    start_time = time.perf_counter()
+    assert config.file_exists(config.destination_dir)
+    assert not config.file_exists(f"{config.destination_dir}/missing")
+    assert time.perf_counter() - start_time >= 2 * 0.05
+    assert [call.seconds >= 0.05 for call in remote.calls] == [True, True]
+
+
+@pytest.mark.usefixtures("fake_rsync")
+def test_remote_destination_lock(tmp_path, remote):
+    config = _config(tmp_path, remote)
+    other = _config(tmp_path, EmulatedRemote())
+
+    with other.lock_destination():
+        with pytest.raises(BackupFailedError, match="Another backup"):
+            _backup(config, remote)
+    assert Path(_backup(config, remote)) == Path(config.link_dir).resolve()
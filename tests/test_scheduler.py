@@ -0,0 +1,207 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import fabric
+import pytest
+
+import pisync.scheduler
+from pisync.cli import main
+from pisync.config import LocalConfig, RemoteConfig
+from pisync.config.config_file import load_schedules
+from pisync.scheduler import CronSchedule, Scheduler, send_command
+
+
+def _at(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize(
+    ("expression", "when", "expected"),
+    [
+        ("* * * * *", _at(2024, 5, 17, 13, 37), True),
+        ("30 2 * * *", _at(2024, 5, 17, 2, 30), True),
+        ("30 2 * * *", _at(2024, 5, 17, 2, 31), False),
+        ("*/15 * * * *", _at(2024, 5, 17, 2, 45), True),
+        ("*/15 * * * *", _at(2024, 5, 17, 2, 50), False),
+        ("0 9-17/4 * * *", _at(2024, 5, 17, 13, 0), True),
+        ("0 9-17/4 * * *", _at(2024, 5, 17, 15, 0), False),
+        ("0 0 * * mon-fri", _at(2024, 5, 17, 0, 0), True),  # a friday
+        ("0 0 * * sat,sun", _at(2024, 5, 17, 0, 0), False),
+        ("0 0 * * 7", _at(2024, 5, 19, 0, 0), True),  # a sunday
+        ("0 0 1 jan *", _at(2024, 1, 1, 0, 0), True),
+        ("@daily", _at(2024, 5, 17, 0, 0), True),
+        # cron matches either day field when both are restricted
+        ("0 0 1 * fri", _at(2024, 5, 17, 0, 0), True),
+        ("0 0 1 * fri", _at(2024, 5, 16, 0, 0), False),
+    ],
+)
+def test_cron_schedule_matches(expression, when, expected):
+    assert CronSchedule(expression).matches(when) is expected
+
+
+def test_cron_schedule_next_after():
+    assert CronSchedule("30 2 * * *").next_after(_at(2024, 5, 17, 2, 30)) == _at(2024, 5, 18, 2, 30)
+    assert CronSchedule("0 0 29 2 *").next_after(_at(2024, 3, 1)) == _at(2028, 2, 29)
+    assert CronSchedule("0 0 30 2 *").next_after(_at(2024, 3, 1)) is None
+
+
+@pytest.mark.parametrize(
+    "expression", ["* * * *", "60 * * * *", "* * 0 * *", "5-1 * * * *", "*/0 * * * *", "x * * * *"]
+)
+def test_invalid_cron_schedule(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+@pytest.fixture
+def fake_abackup(monkeypatch):
+    """Replace abackup with one that waits until the test releases it"""
+    runs = []
+    release = {}
+
+    async def abackup(config):
+        release[config.source_dir] = asyncio.Event()
+        runs.append(config.source_dir)
+        await release[config.source_dir].wait()
+        return f"{config.destination_dir}/snapshot"
+
+    monkeypatch.setattr(pisync.scheduler, "abackup", abackup)
+    return runs, release
+
+
+def _config(tmp_path, name, destination):
+    (tmp_path / name).mkdir(exist_ok=True)
+    return LocalConfig(str(tmp_path / name), str(destination), check_paths=False)
+
+
+def test_overlapping_runs_are_coalesced(tmp_path, fake_abackup):
+    runs, release = fake_abackup
+    configs = {
+        "a": _config(tmp_path, "a", tmp_path / "backups"),
+        "b": _config(tmp_path, "b", tmp_path / "backups"),
+        "c": _config(tmp_path, "c", tmp_path / "other"),
+    }
+
+    async def scenario():
+        scheduler = Scheduler(configs)
+        assert scheduler.trigger("a") == "started"
+        assert scheduler.trigger("b") == "queued"
+        assert scheduler.trigger("c") == "started"
+        await asyncio.sleep(0.1)
+        assert sorted(runs) == [str(tmp_path / "a"), str(tmp_path / "c")]
+
+        assert scheduler.trigger("a") == "coalesced"
+        assert scheduler.trigger("b") == "coalesced"
+        release[str(tmp_path / "a")].set()
+        release[str(tmp_path / "c")].set()
+        await asyncio.sleep(0.1)
+        # b only starts after a released the destination
+        assert runs[-1] == str(tmp_path / "b")
+        assert scheduler.states["b"].state == "running"
+        release[str(tmp_path / "b")].set()
+        await asyncio.sleep(0.1)
+        return scheduler.status()
+
+    status = asyncio.run(scenario())
+    assert [status[name]["runs"] for name in "abc"] == [1, 1, 1]
+    assert [status[name]["coalesced"] for name in "abc"] == [1, 1, 0]
+    assert status["a"]["last_result"] == f"{tmp_path / 'backups'}/snapshot"
+    assert all(backup["state"] == "idle" for backup in status.values())
+
+
+def test_shared_connection_is_opened_once(tmp_path, monkeypatch):
+    opening = []
+    opened = []
+
+    def open_connection(connection):
+        if connection.is_connected:
+            return
+        opening.append(connection)
+        time.sleep(0.1)
+        assert opening == [connection]
+        opening.remove(connection)
+        opened.append(connection)
+        monkeypatch.setattr(type(connection), "is_connected", True)
+
+    monkeypatch.setattr(fabric.Connection, "open", open_connection)
+    configs = {name: RemoteConfig("user@host", str(tmp_path), f"/backups/{name}", check_paths=False) for name in "ab"}
+    Scheduler(configs, ssh_control_dir=str(tmp_path / "ssh"))
+    connection = configs["a"].connection
+    assert configs["b"].connection is connection
+    assert configs["a"].ssh_control_path == f"{tmp_path / 'ssh'}/%C"
+
+    threads = [threading.Thread(target=config.connection.open) for config in configs.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert opened == [connection]
+
+
+def test_control_socket(tmp_path, fake_abackup):
+    _, release = fake_abackup
+    socket_path = str(tmp_path / "pisync.sock")
+    scheduler = Scheduler({"a": _config(tmp_path, "a", tmp_path / "backups")}, {"a": "@hourly"})
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        serve = asyncio.ensure_future(scheduler.serve(socket_path))
+        while not os.path.exists(socket_path):
+            await asyncio.sleep(0.01)
+        responses = [
+            await loop.run_in_executor(None, send_command, socket_path, "run a"),
+            await loop.run_in_executor(None, send_command, socket_path, "run a"),
+            await loop.run_in_executor(None, send_command, socket_path, "run nope"),
+            await loop.run_in_executor(None, send_command, socket_path, "status"),
+        ]
+        release[str(tmp_path / "a")].set()
+        serve.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await serve
+        return responses
+
+    started, coalesced, unknown, status = asyncio.run(scenario())
+    assert started == {"result": "started"}
+    assert coalesced == {"result": "coalesced"}
+    assert "error" in unknown
+    assert status["backups"]["a"]["state"] == "running"
+    assert status["backups"]["a"]["schedule"] == "@hourly"
+    assert not os.path.exists(socket_path)
+
+
+def test_load_schedules(tmp_path):
+    path = tmp_path / "pisync.toml"
+    path.write_text(f"""
+[[backup]]
+name = "nightly"
+source_dir = "{tmp_path}"
+destination_dir = "{tmp_path}"
+schedule = "30 2 * * *"
+
+[[backup]]
+name = "manual"
+source_dir = "{tmp_path}"
+destination_dir = "{tmp_path}"
+""")
+    assert load_schedules(str(path)) == {"nightly": "30 2 * * *"}
+
+
+def test_daemon_rejects_invalid_schedule(tmp_path, capsys):
+    path = tmp_path / "pisync.toml"
+    path.write_text(f"""
+[[backup]]
+name = "nightly"
+source_dir = "{tmp_path}"
+destination_dir = "{tmp_path}"
+schedule = "30 25 * * *"
+""")
+    assert main(["daemon", "-c", str(path)]) == 2
+    assert "invalid schedule" in capsys.readouterr().err
+
+
+def test_trigger_without_daemon(tmp_path, capsys):
+    assert main(["trigger", "--socket", str(tmp_path / "missing.sock"), "home"]) == 1
+    assert "Could not connect" in capsys.readouterr().err
@@ -0,0 +1,167 @@
+import os
+
+import pytest
+
+from pisync.config import BackupType, LocalConfig, RemoteConfig, Source
+from pisync.config.base_config import split_sources
+from pisync.config.config_file import ConfigFileError, load_config_file
+from pisync.config.filters import CACHEDIR_TAG, CACHEDIR_TAG_SIGNATURE, MultiSourceFilterSet
+from pisync.util import _seed_backup, backup
+from pisync.verify import verify_against_source
+
+
+@pytest.fixture
+def sources(tmp_path):
+    home = tmp_path / "home"
+    (home / "alice" / ".cache").mkdir(parents=True)
+    (home / "alice" / ".cache" / "blob").write_bytes(b"x" * 100)
+    (home / "alice" / "notes.txt").write_bytes(b"x" * 7)
+    (home / "alice" / "disk.iso").write_bytes(b"x" * 50)
+    data = tmp_path / "mnt" / "hd2"
+    (data / "movies").mkdir(parents=True)
+    (data / "movies" / "film.iso").write_bytes(b"x" * 1000)
+    (data / "build").mkdir()
+    (data / "build" / CACHEDIR_TAG).write_bytes(CACHEDIR_TAG_SIGNATURE + b"\n")
+    (data / ".cache").mkdir()
+    return [Source(f"{home}/", ["/*/.cache/"]), Source(f"{data}/", ["*.iso"])]
+
+
+def _relative(path):
+    return str(path).strip("/")
+
+
+@pytest.mark.parametrize(
+    "paths",
+    [
+        [],
+        ["home/"],
+        ["/home/", "/home/alice/"],
+        ["/home/", "/home"],
+    ],
+)
+def test_invalid_sources(paths):
+    with pytest.raises(ValueError):
+        split_sources([Source(path) for path in paths])
+
+
+def test_single_source_is_unchanged():
+    assert split_sources("/home") == ("/home", [])
+
+
+def test_patterns_only_match_inside_their_source(sources):
+    home, data = (_relative(source.path) for source in sources)
+    filters = MultiSourceFilterSet(sources, ["**/node_modules/"], exclude_caches=True)
+
+    assert filters.patterns == [
+        f"/{home}/node_modules/",
+        f"/{home}/**/node_modules/",
+        f"/{home}/*/.cache/",
+        f"/{data}/node_modules/",
+        f"/{data}/**/node_modules/",
+        f"/{data}/*.iso",
+        f"/{data}/**/*.iso",
+        f"/{data}/build/",
+    ]
+    report = {stats.rule: stats.files for stats in filters.prune_report()}
+    # /*/.cache/ of home does not match .cache in the root of hd2, *.iso of hd2 does not match in home
+    assert report == {"/*/.cache/": 1, "*.iso": 1, CACHEDIR_TAG: 1}
+    large_files = sorted(relative_path for relative_path, _, _ in filters.large_files(0))
+    assert large_files == [f"{home}/alice/disk.iso", f"{home}/alice/notes.txt"]
+
+
+def test_common_absolute_patterns_apply_to_their_source(sources):
+    home = sources[0].path.rstrip("/")
+    filters = MultiSourceFilterSet(sources, [f"{home}/alice/notes.txt"])
+    assert filters.filter_sets[0].patterns[0] == "/alice/notes.txt"
+    assert "/alice/notes.txt" not in filters.filter_sets[1].patterns
+
+
+def test_rsync_command_uses_relative(tmp_path, sources):
+    config = LocalConfig(sources, str(tmp_path / "backups"), check_paths=False)
+    command = config.get_rsync_command(str(tmp_path / "backups" / "new"), BackupType.Incremental)
+    assert command[-4:] == ["--relative", sources[0].path, sources[1].path, str(tmp_path / "backups" / "new")]
+    assert config.source_dir == "/"
+
+
+def test_check_paths_checks_every_source(tmp_path, sources):
+    (tmp_path / "backups").mkdir()
+    LocalConfig(sources, str(tmp_path / "backups"))
+    with pytest.raises(Exception, match="does not exist"):
+        LocalConfig([*sources, Source(str(tmp_path / "missing"))], str(tmp_path / "backups"))
+
+
+def test_seed_uses_the_layout_of_relative(tmp_path, sources):
+    config = LocalConfig(sources, str(tmp_path / "backups"), log_file=str(tmp_path / "log"), check_paths=False)
+    snapshot = tmp_path / "backups" / "2023-07-14-17-24-23"
+
+    assert _seed_backup(config, str(snapshot)) == BackupType.Seeded
+
+    home, data = (_relative(source.path) for source in sources)
+    assert (snapshot / home / "alice" / "notes.txt").read_bytes() == b"x" * 7
+    assert (snapshot / data / "build" / CACHEDIR_TAG).exists()
+    # the patterns of each source are applied to the tar stream
+    assert not (snapshot / home / "alice" / ".cache").exists()
+    assert not (snapshot / data / "movies" / "film.iso").exists()
+
+
+def test_verify_against_every_source(tmp_path, sources):
+    (tmp_path / "backups").mkdir()
+    config = LocalConfig(sources, str(tmp_path / "backups"), log_file=str(tmp_path / "log"))
+    snapshot = tmp_path / "backups" / "2023-07-14-17-24-23"
+    _seed_backup(config, str(snapshot))
+    (tmp_path / "backups" / "latest").symlink_to(snapshot)
+
+    # tar keeps whole seconds, give the snapshot the exact times of the sources
+    home = _relative(sources[0].path)
+    for source in sources:
+        for directory, _, names in os.walk(source.path):
+            for name in names:
+                stat = os.stat(os.path.join(directory, name))
+                relative = os.path.relpath(os.path.join(directory, name), "/")
+                if (snapshot / relative).exists():
+                    os.utime(snapshot / relative, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    notes = snapshot / home / "alice" / "notes.txt"
+    stat = notes.stat()
+    notes.write_bytes(b"y" * 7)
+    os.utime(notes, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert verify_against_source(config) == [f"{home}/alice/notes.txt"]
+
+
+def test_one_snapshot_for_all_sources(tmp_path, sources):
+    (tmp_path / "backups").mkdir()
+    config = LocalConfig(sources, str(tmp_path / "backups"), log_file=str(tmp_path / "log"))
+
+    first = backup(config)
+    second = backup(config)
+
+    home, data = (_relative(source.path) for source in sources)
+    assert os.path.realpath(tmp_path / "backups" / "latest") == second
+    assert os.path.isfile(os.path.join(second, home, "alice", "notes.txt"))
+    assert not os.path.exists(os.path.join(second, home, "alice", ".cache"))
+    assert not os.path.exists(os.path.join(second, data, "movies", "film.iso"))
+    assert os.path.samefile(
+        os.path.join(first, home, "alice", "notes.txt"), os.path.join(second, home, "alice", "notes.txt")
+    )
+
+
+def test_config_file_sources(tmp_path):
+    path = tmp_path / "pisync.toml"
+    path.write_text("""
+[[backup]]
+name = "hydrogen"
+host = "ethan@hydrogen.local"
+destination_dir = "/mnt/hd/sulfur"
+
+[backup.sources]
+"/home/" = ["/*/.cache/"]
+"/mnt/hd2/" = []
+""")
+    config = load_config_file(str(path))["hydrogen"]
+    assert isinstance(config, RemoteConfig)
+    assert config.sources == [Source("/home/", ["/*/.cache/"]), Source("/mnt/hd2/", None)]
+    assert config.source_paths() == ["/home/", "/mnt/hd2/"]
+
+    path.write_text(path.read_text().replace('"/mnt/hd2/"', '"/home/ethan/"'))
+    with pytest.raises(ConfigFileError):
+        load_config_file(str(path))
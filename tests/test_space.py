@@ -0,0 +1,52 @@
+import os
+import shutil
+
+from pisync.cli import main
+from pisync.config import LocalConfig
+from pisync.space import SnapshotSpace, snapshot_space
+
+
+def test_snapshot_space_is_updated_incrementally(tmp_path):
+    config = LocalConfig(str(tmp_path), str(tmp_path))
+    first = tmp_path / "2023-01-01-00-00-00"
+    second = tmp_path / "2023-01-02-00-00-00"
+    third = tmp_path / "2023-01-03-00-00-00"
+    first.mkdir()
+    (first / "shared").write_bytes(b"s" * 100)
+    (first / "old").write_bytes(b"o" * 10)
+    latest = tmp_path / "latest"
+    latest.symlink_to(first)
+
+    assert snapshot_space(config) == [SnapshotSpace(first.name, 110, 0, 2)]
+
+    second.mkdir()
+    os.link(first / "shared", second / "shared")
+    (second / "new").write_bytes(b"n" * 20)
+    # the backup writing second has not moved latest yet, it is not cached
+    assert snapshot_space(config) == [SnapshotSpace(first.name, 110, 0, 2)]
+
+    latest.unlink()
+    latest.symlink_to(second)
+    assert snapshot_space(config) == [
+        SnapshotSpace(first.name, 10, 100, 2),
+        SnapshotSpace(second.name, 20, 100, 2),
+    ]
+
+    third.mkdir()
+    os.link(second / "new", third / "new")
+    shutil.rmtree(first)
+    latest.unlink()
+    latest.symlink_to(third)
+    assert snapshot_space(config) == [
+        SnapshotSpace(second.name, 100, 20, 2),
+        SnapshotSpace(third.name, 0, 20, 1),
+    ]
+
+
+def test_space_cli(tmp_path, capsys):
+    (tmp_path / "2023-01-01-00-00-00").mkdir()
+    (tmp_path / "2023-01-01-00-00-00" / "file").write_bytes(b"x" * 2048)
+    (tmp_path / "latest").symlink_to(tmp_path / "2023-01-01-00-00-00")
+
+    assert main(["space", str(tmp_path)]) == 0
+    assert "2023-01-01-00-00-00" in capsys.readouterr().out
@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import pytest
+
+from pisync.config import LocalConfig
+from pisync.verify import verify, verify_against_source
+
+
+@pytest.fixture
+def snapshots(tmp_path):
+    """A source directory and two snapshots of it sharing unchanged inodes"""
+    source = tmp_path / "source"
+    destination = tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    (source / "unchanged.txt").write_text("same")
+    (source / "changed.txt").write_text("new")
+    (source / "dir").mkdir()
+    (source / "dir" / "nested.txt").write_text("nested")
+
+    first = destination / "2023-01-01-00-00-00"
+    second = destination / "2023-01-02-00-00-00"
+    shutil.copytree(source, first)
+    (first / "changed.txt").write_text("old")
+    second.mkdir()
+    os.link(first / "unchanged.txt", second / "unchanged.txt")
+    (second / "dir").mkdir()
+    os.link(first / "dir" / "nested.txt", second / "dir" / "nested.txt")
+    shutil.copy2(source / "changed.txt", second / "changed.txt")
+    (destination / "latest").symlink_to(second)
+    return source, destination, second
+
+
+def test_each_inode_is_hashed_once(snapshots):
+    source, destination, _ = snapshots
+    config = LocalConfig(f"{source}/", str(destination))
+
+    report = verify(config)
+    assert report.snapshots == 2
+    assert report.files == 6
+    assert report.inodes == 4
+    assert report.hashed == 4
+    assert report.corrupt == []
+
+    report = verify(config)
+    assert report.hashed == 0
+
+
+def test_verified_snapshots_are_not_walked_again(snapshots):
+    source, destination, second = snapshots
+    config = LocalConfig(f"{source}/", str(destination))
+    verify(config)
+
+    third = destination / "2023-01-03-00-00-00"
+    shutil.copytree(second, third)
+    report = verify(config)
+    assert (report.snapshots, report.skipped, report.files, report.hashed) == (1, 2, 3, 3)
+    # newer than latest, the backup may still be running
+    assert verify(config).snapshots == 1
+
+    (destination / "latest").unlink()
+    (destination / "latest").symlink_to(third)
+    verify(config)
+    assert verify(config).snapshots == 0
+    assert verify(config, full=True).snapshots == 3
+
+
+def test_full_verify_detects_bit_rot(snapshots):
+    source, destination, second = snapshots
+    config = LocalConfig(f"{source}/", str(destination))
+    verify(config)
+
+    rotten = second / "dir" / "nested.txt"
+    stat = rotten.stat()
+    rotten.write_text("nestee")
+    os.utime(rotten, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert verify(config).corrupt == []
+    report = verify(config, full=True)
+    assert report.hashed == 4
+    assert len(report.corrupt) == 1
+    assert report.corrupt[0].endswith("dir/nested.txt")
+
+
+def test_verify_against_source(snapshots):
+    source, destination, second = snapshots
+    config = LocalConfig(f"{source}/", str(destination))
+    changed = second / "changed.txt"
+    stat = changed.stat()
+    changed.write_text("bad")
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert verify_against_source(config) == ["changed.txt"]
+
+
+def test_verify_against_source_matches(snapshots):
+    source, destination, _ = snapshots
+    config = LocalConfig(f"{source}/", str(destination))
+    assert verify_against_source(config) == []